@@ -8,8 +8,29 @@ echo "Database is ready!"
 
 cd xclera_backend
 
+# TRACK_CONFIRMATIONS=true runs the confirmation tracker instead of the
+# web server; it settles transactions the API recorded as PENDING. The web
+# container owns the migrations, so wait for them instead of racing it
+if [ "${TRACK_CONFIRMATIONS:-false}" = "true" ]; then
+  until python manage.py migrate --check > /dev/null 2>&1; do
+    echo "Waiting for migrations..."
+    sleep 2
+  done
+  exec python manage.py track_confirmations
+fi
+
 python manage.py migrate
 
 python manage.py collectstatic --noinput
 
+if [ -z "${CACHE_LOCATION}" ]; then
+  echo "Warning: CACHE_LOCATION is not set; level and company wallet changes made by other processes will not reach the workers" >&2
+fi
+
+# ASGI=true serves blockchain.asgi with uvicorn workers so the async
+# registration/upgrade endpoints can overlap their RPC waits
+if [ "${ASGI:-false}" = "true" ]; then
+  exec gunicorn blockchain.asgi:application --bind 0.0.0.0:8000 --workers 3 -k uvicorn.workers.UvicornWorker
+fi
+
 exec gunicorn blockchain.wsgi:application --bind 0.0.0.0:8000 --workers 3
\ No newline at end of file
@@ -22,6 +22,18 @@ export interface TransactionFilter {
   toDate?: string;
 }
 
+// Follow the keyset pages' `next` links and return every row
+const getAllPages = async (url: string): Promise<Transaction[]> => {
+  const rows: Transaction[] = [];
+  let next: string | null = url;
+  while (next) {
+    const response = await api.get(next);
+    rows.push(...(response.data.results || []));
+    next = response.data.next;
+  }
+  return rows;
+};
+
 export const useTransactionService = () => {
   const getTransactions = async (filters?: TransactionFilter): Promise<Transaction[]> => {
     try {
@@ -57,8 +69,8 @@ export const useTransactionService = () => {
       }
       
       const queryString = queryParams.toString() ? `?${queryParams.toString()}` : "";
-      const response = await api.get(`/api/profiles/${userId}/transactions/${queryString}`);
-      return response.data || [];
+      // The whole history, as the endpoint returned before it was paged
+      return await getAllPages(`/api/profiles/${userId}/transactions/${queryString}`);
     } catch (error) {
       console.error(`Error fetching transactions for user ${userId}:`, error);
       return [];
@@ -44,6 +44,7 @@ class UserProfileAdmin(ReadOnlyModelAdmin):
         "is_registered_on_chain",
         "direct_referrals_count",
         "max_referral_depth",
+        "team_size",
         "current_level",
     )
 
@@ -56,6 +57,7 @@ class UserProfileAdmin(ReadOnlyModelAdmin):
         "current_level",
         "direct_referrals_count",
         "max_referral_depth",
+        "team_size",
         # Editable profile fields
         "username",
         "email",
@@ -11,6 +11,10 @@ class MyappConfig(AppConfig):
         Import signals or perform other initialization
         when the app is ready
         """
-        # Import signals if you have any
-        # import matrix.signals
-        pass
+        from django.db.models.signals import post_delete, post_save
+        from .models import Level
+        from .services.level_catalog import level_changed
+
+        # Keep every worker's level catalog in step with the Level table
+        post_save.connect(level_changed, sender=Level, dispatch_uid="level_catalog_save")
+        post_delete.connect(level_changed, sender=Level, dispatch_uid="level_catalog_delete")
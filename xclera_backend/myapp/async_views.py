@@ -0,0 +1,175 @@
+import asyncio
+from asgiref.sync import sync_to_async
+from rest_framework import permissions, status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from .services.async_blockchain import get_async_blockchain_service
+from .views import (
+    complete_registration,
+    complete_upgrade,
+    failed_transaction_response,
+    pending_registration,
+    pending_upgrade,
+    prepared_transaction_response,
+    registration_candidate,
+    replayed_response,
+    upgrade_candidate,
+    wallet_error,
+)
+
+
+class AsyncAPIView(APIView):
+    """
+    APIView whose handlers are coroutines
+
+    DRF's own dispatch is synchronous, so authentication, permission and
+    throttle checks run through sync_to_async here and the handler is
+    awaited. Served over ASGI, a worker keeps running other requests
+    while one waits on the blockchain node.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(
+                    self, request.method.lower(), self.http_method_not_allowed
+                )
+            else:
+                handler = self.http_method_not_allowed
+
+            response = handler(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+
+class AsyncRegistrationView(AsyncAPIView):
+    """Async variant of RegistrationView, POST only"""
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    async def post(self, request):
+        error = wallet_error(request)
+        if error is not None:
+            return error
+
+        # A retried submission gets the stored result back
+        replay = await sync_to_async(replayed_response)(request, "REGISTRATION")
+        if replay is not None:
+            return replay
+
+        profile, error = await sync_to_async(registration_candidate)(
+            request.data["wallet_address"]
+        )
+        if error is not None:
+            return error
+
+        try:
+            blockchain_service = await get_async_blockchain_service()
+
+            if "signed_transaction" in request.data:
+                tx_result = await blockchain_service.submit_transaction(
+                    request.data["signed_transaction"]
+                )
+                return await sync_to_async(pending_registration)(
+                    profile, tx_result["transaction_hash"]
+                )
+
+            if "transaction_hash" in request.data:
+                tx_result = await blockchain_service.verify_transaction(
+                    request.data["transaction_hash"]
+                )
+                if tx_result["status"] == "pending":
+                    return await sync_to_async(pending_registration)(
+                        profile, tx_result["transaction_hash"]
+                    )
+                if tx_result["status"] != "success":
+                    return failed_transaction_response("registration", tx_result)
+                return await sync_to_async(complete_registration)(
+                    profile, tx_result["transaction_hash"]
+                )
+
+            # Just prepare the transaction for the frontend to sign
+            return prepared_transaction_response(
+                await blockchain_service.build_register_transaction(
+                    user_wallet=profile.wallet_address,
+                    referrer_wallet=profile.referrer.wallet_address,
+                )
+            )
+        except Exception as e:
+            return Response(
+                {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+class AsyncUpgradeLevelView(AsyncAPIView):
+    """Async variant of UpgradeLevelView, POST only"""
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    async def post(self, request):
+        error = wallet_error(request)
+        if error is not None:
+            return error
+
+        # A retried submission gets the stored result back
+        replay = await sync_to_async(replayed_response)(request, "UPGRADE")
+        if replay is not None:
+            return replay
+
+        candidate, error = await sync_to_async(upgrade_candidate)(
+            request.data["wallet_address"]
+        )
+        if error is not None:
+            return error
+        profile, target_level, upline_wallet = candidate
+
+        try:
+            blockchain_service = await get_async_blockchain_service()
+
+            if "signed_transaction" in request.data:
+                tx_result = await blockchain_service.submit_transaction(
+                    request.data["signed_transaction"]
+                )
+                return await sync_to_async(pending_upgrade)(
+                    profile, target_level, tx_result["transaction_hash"]
+                )
+
+            if "transaction_hash" in request.data:
+                tx_result = await blockchain_service.verify_transaction(
+                    request.data["transaction_hash"]
+                )
+                if tx_result["status"] == "pending":
+                    return await sync_to_async(pending_upgrade)(
+                        profile, target_level, tx_result["transaction_hash"]
+                    )
+                if tx_result["status"] != "success":
+                    return failed_transaction_response("upgrade", tx_result)
+                return await sync_to_async(complete_upgrade)(
+                    profile, target_level, tx_result["transaction_hash"]
+                )
+
+            # Just prepare the transaction for the frontend to sign
+            return prepared_transaction_response(
+                await blockchain_service.build_upgrade_transaction(
+                    user_wallet=profile.wallet_address,
+                    new_level=target_level,
+                    upline_wallet=upline_wallet,
+                )
+            )
+        except Exception as e:
+            return Response(
+                {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
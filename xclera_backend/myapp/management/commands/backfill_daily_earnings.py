@@ -0,0 +1,70 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from myapp.models import UserProfile, Transaction, DailyEarnings
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the DailyEarnings rollup from the Transaction history. '
+        'Each batch of users is rebuilt in its own transaction, so the command can be re-run '
+        'after an interruption; run it while no ledger rows are being written.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Users rebuilt per transaction',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        self.stdout.write('Rebuilding daily earnings...')
+
+        started = time.perf_counter()
+        last_pk = 0
+        users = rollup_rows = 0
+        while True:
+            batch = list(
+                UserProfile.objects.filter(pk__gt=last_pk)
+                .order_by('pk')
+                .values_list('pk', flat=True)[:batch_size]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1]
+
+            with transaction.atomic():
+                rows = [
+                    DailyEarnings(
+                        user_id=user_id,
+                        transaction_type=transaction_type,
+                        day=day,
+                        total=total,
+                        count=count,
+                    )
+                    for user_id, transaction_type, day, total, count in (
+                        Transaction.objects.filter(user_id__gte=batch[0], user_id__lte=last_pk)
+                        .annotate(day=TruncDate('created_at'))
+                        .order_by()
+                        .values_list('user_id', 'transaction_type', 'day')
+                        .annotate(total=Sum('amount'), count=Count('pk'))
+                    )
+                ]
+                DailyEarnings.objects.filter(
+                    user_id__gte=batch[0], user_id__lte=last_pk
+                ).delete()
+                DailyEarnings.objects.bulk_create(rows, batch_size=batch_size)
+
+            users += len(batch)
+            rollup_rows += len(rows)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'Rebuilt {users} users, {rollup_rows} rollup rows ({users / elapsed:.0f} users/sec)'
+            )
+
+        self.stdout.write(self.style.SUCCESS(f'Daily earnings rebuilt for {users} users'))
@@ -0,0 +1,79 @@
+import json
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from web3 import Web3
+from myapp.services.blockchain import get_blockchain_service, reset_blockchain_service
+
+
+def per_request_setup():
+    """What every registration/upgrade request used to pay before its first real call"""
+    with open(settings.CONTRACT_ABI_PATH, 'r') as abi_file:
+        contract_abi = json.load(abi_file)
+    w3 = Web3(Web3.HTTPProvider(settings.WEB3_PROVIDER_URL))
+    if not w3.is_connected():
+        raise ConnectionError('Cannot connect to Ethereum node')
+    return w3.eth.contract(
+        address=Web3.to_checksum_address(settings.CONTRACT_ADDRESS), abi=contract_abi
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        'Time the blockchain service setup a registration or upgrade request pays: '
+        'a fresh service per request against the shared per-process service. '
+        'Needs the configured RPC node and ABI file.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=200,
+            help='Simulated requests per variant',
+        )
+        parser.add_argument(
+            '--with-call',
+            action='store_true',
+            help='Also make one eth_blockNumber call per request, as a view would',
+        )
+
+    def handle(self, *args, **options):
+        count = options['requests']
+        with_call = options['with_call']
+
+        def fresh(_):
+            contract = per_request_setup()
+            if with_call:
+                contract.w3.eth.block_number
+
+        def shared(_):
+            service = get_blockchain_service()
+            if with_call:
+                service.w3.eth.block_number
+
+        reset_blockchain_service()
+        get_blockchain_service()  # built once per worker, outside the timed loop
+        results = [
+            ('per-request service', self.measure(fresh, count)),
+            ('shared service', self.measure(shared, count)),
+        ]
+
+        for name, seconds in results:
+            self.stdout.write(
+                f'{name:>20}: {seconds / count * 1000:.3f} ms/request '
+                f'({count} requests in {seconds:.2f}s)'
+            )
+        before, after = results[0][1], results[1][1]
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Saved {(before - after) / count * 1000:.3f} ms per request '
+                f'({before / after if after else 0:.1f}x faster)'
+            )
+        )
+
+    def measure(self, setup, count):
+        started = time.perf_counter()
+        for i in range(count):
+            setup(i)
+        return time.perf_counter() - started
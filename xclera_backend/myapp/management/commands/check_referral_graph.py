@@ -0,0 +1,39 @@
+import time
+from django.core.management.base import BaseCommand
+from myapp.services.referral_graph import ReferralGraph
+
+
+class Command(BaseCommand):
+    help = 'Load the in-memory referral graph and check it against the closure table'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--show',
+            type=int,
+            default=20,
+            help='Number of mismatched profile ids to print',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Loading referral graph...')
+        started = time.perf_counter()
+        graph = ReferralGraph().load()
+        self.stdout.write(
+            f'Loaded {graph.node_count} profiles in {time.perf_counter() - started:.2f}s'
+        )
+
+        self.stdout.write('Comparing with Referral Relationships...')
+        started = time.perf_counter()
+        mismatched = graph.check_consistency()
+        self.stdout.write(f'Checked in {time.perf_counter() - started:.2f}s')
+
+        if not mismatched:
+            self.stdout.write(self.style.SUCCESS('Referral graph matches the closure table'))
+            return
+
+        self.stdout.write(
+            self.style.ERROR(f'{len(mismatched)} profiles have inconsistent upline rows')
+        )
+        for profile_id in mismatched[:options['show']]:
+            expected = graph.ancestors(profile_id)
+            self.stdout.write(f'- profile {profile_id}: expected uplines {expected}')
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from myapp.models import UserProfile
+from myapp.services.referral import invalidate_company_wallet, invalidate_referral_chains
 import dotenv 
 import os
 
@@ -41,5 +42,10 @@ class Command(BaseCommand):
         )
         root_user.referrer = root_user
         root_user.save()
+
+        # Ledger writes resolve the company wallet (or root) profile id again,
+        # and reward routing the ancestors of the recreated tree
+        invalidate_company_wallet()
+        invalidate_referral_chains()
         
         self.stdout.write(self.style.SUCCESS(f'Successfully created root user with wallet {root_wallet}'))
\ No newline at end of file
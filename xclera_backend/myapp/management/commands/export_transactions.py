@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+from myapp.models import Transaction
+from myapp.services.ledger import EXPORT_FORMATS, filter_transactions, stream_ledger
+
+
+class Command(BaseCommand):
+    help = (
+        'Stream the transaction ledger as CSV or NDJSON in id order. '
+        'Rows are fetched and written a chunk at a time, so memory stays flat for any ledger size.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format',
+            choices=list(EXPORT_FORMATS),
+            default='csv',
+            help='Output format',
+        )
+        parser.add_argument(
+            '--output',
+            help='File to write (defaults to stdout)',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=2000,
+            help='Rows fetched and written at a time',
+        )
+        parser.add_argument('--wallet-address', help='Only this user\'s transactions')
+        parser.add_argument('--transaction-type', choices=[t for t, _ in Transaction.TRANSACTION_TYPES])
+        parser.add_argument('--status', choices=[s for s, _ in Transaction.STATUS_CHOICES])
+        parser.add_argument('--level', type=int)
+        parser.add_argument('--from-date', help='YYYY-MM-DD')
+        parser.add_argument('--to-date', help='YYYY-MM-DD')
+
+    def handle(self, *args, **options):
+        queryset = Transaction.objects.all()
+        if options['wallet_address']:
+            queryset = queryset.filter(user__wallet_address=options['wallet_address'])
+        queryset = filter_transactions(queryset, options)
+
+        # Progress goes to stderr so the export itself can be piped from stdout
+        self.last_report = 0
+        if options['output']:
+            with open(options['output'], 'w', newline='') as handle:
+                self.export(queryset, options, handle.write)
+        else:
+            self.export(queryset, options, lambda text: self.stdout.write(text, ending=''))
+
+    def export(self, queryset, options, write):
+        for text in stream_ledger(
+            queryset, options['format'], options['chunk_size'], report=self.report
+        ):
+            write(text)
+        self.stderr.write(
+            self.style.SUCCESS(
+                f'Exported {self.exported} transactions in {self.elapsed:.2f}s '
+                f'({self.exported / self.elapsed if self.elapsed else 0:.0f} rows/sec)'
+            )
+        )
+
+    def report(self, exported, elapsed):
+        self.exported, self.elapsed = exported, elapsed
+        if elapsed - self.last_report >= 5:
+            self.last_report = elapsed
+            self.stderr.write(f'Exported {exported} transactions ({exported / elapsed:.0f} rows/sec)')
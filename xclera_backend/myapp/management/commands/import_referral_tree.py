@@ -0,0 +1,302 @@
+import csv
+import json
+import re
+import time
+from collections import Counter, defaultdict
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from myapp.models import UserProfile, DownlineLevelCount
+from myapp.services.referral import invalidate_referral_chains
+from myapp.services.referral_storage import get_referral_storage
+from myapp.services.referral_graph import ReferralGraph
+
+WALLET_PATTERN = re.compile(r'^0x[a-fA-F0-9]{40}$')
+PROFILE_FIELDS = ('username', 'country', 'phone_number', 'email')
+
+
+class Command(BaseCommand):
+    help = (
+        'Import (wallet, referrer_wallet) pairs from CSV or JSONL into the referral tree. '
+        'The file is streamed in --batch-size chunks; only rows whose referrer has not '
+        'been read yet are held in memory. Wallets that already exist are skipped, so an '
+        'interrupted import, or one stopped by an invalid row, can simply be re-run.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or JSONL file to import')
+        parser.add_argument(
+            '--format',
+            choices=['csv', 'jsonl'],
+            help='Input format (defaults to the file extension)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Rows read and profiles written per transaction',
+        )
+        parser.add_argument(
+            '--level',
+            type=int,
+            default=1,
+            help='current_level for rows that do not specify one',
+        )
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        input_format = options['format'] or (
+            'jsonl' if options['path'].endswith(('.jsonl', '.ndjson')) else 'csv'
+        )
+
+        self.stdout.write('Loading existing referral tree...')
+        self.graph = ReferralGraph().load()
+        # Rows whose referrer is neither in the database nor imported yet,
+        # keyed by that referrer's wallet
+        self.waiting = defaultdict(dict)
+        self.waiting_on = {}
+
+        self.stdout.write(f'Importing {options["path"]}...')
+        read = already_imported = imported = 0
+        started = time.perf_counter()
+        for chunk in self.read_chunks(options['path'], input_format, options['level']):
+            read += len(chunk)
+            existing = self.existing_wallets(set(chunk) | {row[0] for row in chunk.values()})
+            pending = {wallet: row for wallet, row in chunk.items() if wallet not in existing}
+            already_imported += len(chunk) - len(pending)
+            imported += self.import_pending(pending, existing)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'Read {read} rows, imported {imported} profiles '
+                f'({imported / elapsed:.0f} rows/sec)'
+            )
+
+        if imported:
+            invalidate_referral_chains()
+        if already_imported:
+            self.stdout.write(f'{already_imported} wallets were already imported')
+        skipped = len(self.waiting_on)
+        if skipped:
+            self.stdout.write(
+                self.style.WARNING(
+                    f'{skipped} rows were skipped because their referrer is unknown '
+                    'or part of a referral cycle'
+                )
+            )
+        self.stdout.write(self.style.SUCCESS(f'Successfully imported {imported} profiles'))
+
+    def read_chunks(self, path, input_format, default_level):
+        """
+        Stream the input file as {wallet: (referrer_wallet, level, profile
+        fields)} dicts of up to batch_size rows, validating every record
+        """
+        chunk = {}
+        with open(path, newline='') as handle:
+            if input_format == 'csv':
+                records = csv.DictReader(handle)
+            else:
+                records = (line for line in handle if line.strip())
+
+            for line_number, record in enumerate(records, start=1):
+                wallet, row = self.parse_record(line_number, record, default_level)
+                chunk[wallet] = row
+                if len(chunk) >= self.batch_size:
+                    yield chunk
+                    chunk = {}
+        if chunk:
+            yield chunk
+
+    def parse_record(self, line_number, record, default_level):
+        """Validate one CSV row or JSONL line, raising CommandError with its row number"""
+        if isinstance(record, str):
+            try:
+                record = json.loads(record)
+            except ValueError:
+                raise CommandError(f'Row {line_number}: invalid JSON')
+            if not isinstance(record, dict):
+                raise CommandError(f'Row {line_number}: expected a JSON object')
+
+        wallet = str(record.get('wallet_address') or record.get('wallet') or '').strip()
+        referrer = str(record.get('referrer_wallet') or '').strip()
+        if not WALLET_PATTERN.match(wallet) or not WALLET_PATTERN.match(referrer):
+            raise CommandError(f'Row {line_number}: invalid wallet address')
+        if wallet == referrer:
+            raise CommandError(f'Row {line_number}: wallet cannot refer itself')
+
+        level = record.get('current_level')
+        if level is None or level == '':
+            level = default_level
+        else:
+            try:
+                if isinstance(level, (bool, float)):
+                    raise ValueError(level)
+                level = int(level)
+            except (TypeError, ValueError):
+                raise CommandError(f'Row {line_number}: invalid current_level {level!r}')
+            if level < 0:
+                raise CommandError(f'Row {line_number}: invalid current_level {level!r}')
+
+        return wallet, (
+            referrer,
+            level,
+            tuple(record.get(field) or None for field in PROFILE_FIELDS),
+        )
+
+    def existing_wallets(self, wallets):
+        """Map the wallets that are already in the database to their profile ids"""
+        wallets = list(wallets)
+        existing = {}
+        for i in range(0, len(wallets), self.batch_size):
+            existing.update(
+                UserProfile.objects.filter(
+                    wallet_address__in=wallets[i:i + self.batch_size]
+                ).values_list('wallet_address', 'pk')
+            )
+        return existing
+
+    def import_pending(self, pending, existing):
+        """
+        Import the rows whose referrer exists, then the rows waiting on
+        those; park the others until their referrer is imported. Returns
+        the number of profiles imported.
+        """
+        for wallet in pending:
+            # A wallet listed again replaces its parked row
+            if wallet in self.waiting_on:
+                del self.waiting[self.waiting_on.pop(wallet)][wallet]
+
+        ordered = self.topological_order(pending, existing)
+        placed = set(ordered)
+        for wallet, row in pending.items():
+            if wallet not in placed:
+                self.waiting[row[0]][wallet] = row
+                self.waiting_on[wallet] = row[0]
+
+        imported = 0
+        while ordered:
+            for i in range(0, len(ordered), self.batch_size):
+                batch = ordered[i:i + self.batch_size]
+                with transaction.atomic():
+                    self.import_batch(batch, pending, existing)
+            imported += len(ordered)
+
+            # Their referrers now exist
+            pending = {}
+            for wallet in ordered:
+                pending.update(self.waiting.pop(wallet, {}))
+            for wallet in pending:
+                del self.waiting_on[wallet]
+            ordered = list(pending)
+        return imported
+
+    def topological_order(self, pending, existing):
+        """Order pending wallets so every referrer comes before its referrals"""
+        children = defaultdict(list)
+        ordered = []
+        for wallet, (referrer, _, _) in pending.items():
+            if referrer in existing:
+                ordered.append(wallet)
+            else:
+                children[referrer].append(wallet)
+
+        # Breadth first; wallets left in `children` are unreachable
+        position = 0
+        while position < len(ordered):
+            ordered.extend(children.pop(ordered[position], ()))
+            position += 1
+        return ordered
+
+    def import_batch(self, batch, pending, existing):
+        profiles = []
+        for wallet in batch:
+            referrer, level, fields = pending[wallet]
+            profiles.append(
+                UserProfile(
+                    wallet_address=wallet,
+                    # Referrers inside this batch get their id linked below
+                    referrer_id=existing.get(referrer),
+                    current_level=level,
+                    is_registered_on_chain=level >= 1,
+                    **dict(zip(PROFILE_FIELDS, fields)),
+                )
+            )
+        UserProfile.objects.bulk_create(profiles, batch_size=self.batch_size)
+
+        if not connection.features.can_return_rows_from_bulk_insert:
+            ids = dict(
+                UserProfile.objects.filter(wallet_address__in=batch).values_list(
+                    'wallet_address', 'pk'
+                )
+            )
+            for profile in profiles:
+                profile.pk = ids[profile.wallet_address]
+
+        unlinked = []
+        for profile in profiles:
+            existing[profile.wallet_address] = profile.pk
+            if profile.referrer_id is None:
+                profile.referrer_id = existing[pending[profile.wallet_address][0]]
+                unlinked.append(profile)
+        UserProfile.objects.bulk_update(unlinked, ['referrer'], batch_size=self.batch_size)
+
+        chains = []
+        direct = Counter()
+        team = Counter()
+        depth = {}
+        level_counts = Counter()
+        for profile in profiles:
+            self.graph.add(profile.pk, profile.referrer_id, profile.current_level)
+            registered = profile.current_level >= 1
+            if registered:
+                direct[profile.referrer_id] += 1
+
+            ancestors = self.graph.ancestors(profile.pk)
+            chains.append((profile.pk, ancestors))
+            for level, upline_id in enumerate(ancestors, start=1):
+                team[upline_id] += 1
+                level_counts[upline_id, level] += 1
+                if registered and level > depth.get(upline_id, 0):
+                    depth[upline_id] = level
+
+        get_referral_storage().bulk_link(chains, self.batch_size)
+        self.update_profile_counters(direct, team, depth)
+        self.update_level_counts(level_counts)
+
+    def update_profile_counters(self, direct, team, depth):
+        uplines = []
+        for upline_id in team:
+            upline = UserProfile(pk=upline_id)
+            upline.direct_referrals_count = F('direct_referrals_count') + direct[upline_id]
+            upline.team_size = F('team_size') + team[upline_id]
+            upline.max_referral_depth = Greatest(
+                F('max_referral_depth'), Value(depth.get(upline_id, 0))
+            )
+            uplines.append(upline)
+        UserProfile.objects.bulk_update(
+            uplines,
+            ['direct_referrals_count', 'team_size', 'max_referral_depth'],
+            batch_size=self.batch_size,
+        )
+
+    def update_level_counts(self, level_counts):
+        DownlineLevelCount.objects.bulk_create(
+            [
+                DownlineLevelCount(upline_id=upline_id, level=level)
+                for upline_id, level in level_counts
+            ],
+            batch_size=self.batch_size,
+            ignore_conflicts=True,
+        )
+        rows = DownlineLevelCount.objects.filter(
+            upline_id__in={upline_id for upline_id, _ in level_counts},
+            level__in={level for _, level in level_counts},
+        ).only('pk', 'upline', 'level')
+
+        changed = []
+        for row in rows.iterator():
+            increment = level_counts.get((row.upline_id, row.level))
+            if increment:
+                row.count = F('count') + increment
+                changed.append(row)
+        DownlineLevelCount.objects.bulk_update(changed, ['count'], batch_size=self.batch_size)
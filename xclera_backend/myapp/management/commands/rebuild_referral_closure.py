@@ -0,0 +1,201 @@
+import time
+from array import array
+from collections import Counter
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from myapp.models import UserProfile, ReferralRelationship, DownlineLevelCount
+from myapp.services.referral import invalidate_referral_chains
+from myapp.services.referral_storage import get_referral_storage
+from myapp.services.referral_graph import ReferralGraph, NO_NODE
+
+COUNTER_FIELDS = ('direct_referrals_count', 'max_referral_depth', 'team_size')
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the stored upline chains, referral counters and per-level rollup '
+        'from UserProfile.referrer pointers, and report or fix any drift'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help='Rewrite drifted rows instead of only reporting them',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Profiles checked (and fixed) per transaction',
+        )
+        parser.add_argument(
+            '--show',
+            type=int,
+            default=10,
+            help='Number of drifted profile ids to print per check',
+        )
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        self.show = options['show']
+        fix = options['fix']
+        self.storage = get_referral_storage()
+
+        self.stdout.write('Loading referral graph...')
+        started = time.perf_counter()
+        graph = ReferralGraph().load()
+        self.stdout.write(
+            f'Loaded {graph.node_count} profiles in {time.perf_counter() - started:.2f}s'
+        )
+
+        self.stdout.write(f'Checking {self.storage.name} upline storage...')
+        mismatched = graph.check_consistency()
+        self.report('upline chains', mismatched)
+        if fix and mismatched:
+            self.rebuild_closure(graph, mismatched)
+
+        self.stdout.write('Checking referral counters and level rollup...')
+        direct, depth = self.expected_counters(graph)
+        drifted, rollup_drifted = self.audit_profiles(graph, direct, depth, fix)
+        for field in COUNTER_FIELDS:
+            self.report(field, drifted[field])
+        self.report('level rollup', rollup_drifted)
+        if fix:
+            # Ancestors memoized while a chain was missing or stale
+            invalidate_referral_chains()
+
+        self.stdout.write(f'Finished in {time.perf_counter() - started:.2f}s')
+        total = len(mismatched) + len(rollup_drifted) + sum(map(len, drifted.values()))
+        if not total:
+            self.stdout.write(self.style.SUCCESS('No drift found'))
+        elif fix:
+            self.stdout.write(self.style.SUCCESS('Drifted rows were rebuilt'))
+        else:
+            self.stdout.write(self.style.WARNING('Run again with --fix to rebuild drifted rows'))
+
+    def report(self, name, profile_ids):
+        if not profile_ids:
+            self.stdout.write(f'- {name}: ok')
+            return
+        sample = ', '.join(str(pid) for pid in profile_ids[:self.show])
+        self.stdout.write(
+            self.style.ERROR(f'- {name}: {len(profile_ids)} profiles drifted (e.g. {sample})')
+        )
+
+    def expected_counters(self, graph):
+        """
+        Derive direct_referrals_count and max_referral_depth for every profile
+        in one bottom-up pass over the graph
+
+        Both only count registered (level >= 1) referrals, matching what
+        register_user and RegistrationView maintain.
+        """
+        size = len(graph.present)
+        direct = array('I', bytes(4 * size))
+        depth = array('I', bytes(4 * size))
+        for profile_id in reversed(graph.breadth_first_order()):
+            parent_id = graph.parent[profile_id]
+            if parent_id == NO_NODE:
+                continue
+            if graph.level[profile_id] >= 1:
+                direct[parent_id] += 1
+                reach = depth[profile_id] + 1
+            else:
+                reach = depth[profile_id] + 1 if depth[profile_id] else 0
+            if reach > depth[parent_id]:
+                depth[parent_id] = reach
+        return direct, depth
+
+    def rebuild_closure(self, graph, profile_ids):
+        for i in range(0, len(profile_ids), self.batch_size):
+            batch = profile_ids[i:i + self.batch_size]
+            chains = [(profile_id, graph.ancestors(profile_id)) for profile_id in batch]
+            with transaction.atomic():
+                self.storage.unlink(batch)
+                self.storage.bulk_link(
+                    [(profile_id, uplines) for profile_id, uplines in chains if uplines],
+                    self.batch_size,
+                )
+
+    def audit_profiles(self, graph, direct, depth, fix):
+        """Walk profiles in primary key batches comparing stored and expected values"""
+        drifted = {field: [] for field in COUNTER_FIELDS}
+        rollup_drifted = []
+        last_pk = 0
+        while True:
+            rows = list(
+                UserProfile.objects.filter(pk__gt=last_pk)
+                .order_by('pk')
+                .values_list('pk', *COUNTER_FIELDS)[:self.batch_size]
+            )
+            if not rows:
+                break
+            first_pk, last_pk = rows[0][0], rows[-1][0]
+
+            changed = []
+            for profile_id, *stored in rows:
+                expected = (direct[profile_id], depth[profile_id], graph.team_size(profile_id))
+                if tuple(stored) == expected:
+                    continue
+                for field, old, new in zip(COUNTER_FIELDS, stored, expected):
+                    if old != new:
+                        drifted[field].append(profile_id)
+                changed.append(UserProfile(pk=profile_id, **dict(zip(COUNTER_FIELDS, expected))))
+
+            with transaction.atomic():
+                uplines = self.audit_level_counts(graph, first_pk, last_pk, fix)
+                if fix and changed:
+                    UserProfile.objects.bulk_update(changed, COUNTER_FIELDS)
+            rollup_drifted.extend(uplines)
+
+        return drifted, rollup_drifted
+
+    def expected_level_counts(self, graph, first_pk, last_pk):
+        if self.storage.indexes_downlines:
+            # The closure table was already repaired above under --fix
+            return Counter(
+                {
+                    (upline_id, level): count
+                    for upline_id, level, count in ReferralRelationship.objects.filter(
+                        upline_id__gte=first_pk, upline_id__lte=last_pk
+                    )
+                    .values_list('upline_id', 'level')
+                    .annotate(count=Count('pk'))
+                    .order_by()
+                }
+            )
+        return Counter(
+            (upline_id, level)
+            for upline_id in range(first_pk, last_pk + 1)
+            for _, level in graph.descendants(upline_id)
+        )
+
+    def audit_level_counts(self, graph, first_pk, last_pk, fix):
+        """
+        Compare the DownlineLevelCount rows of a range of uplines with the
+        downlines found in the closure table, or in the graph when the
+        storage cannot list downlines
+        """
+        expected = self.expected_level_counts(graph, first_pk, last_pk)
+        stored = Counter(
+            {
+                (upline_id, level): count
+                for upline_id, level, count in DownlineLevelCount.objects.filter(
+                    upline_id__gte=first_pk, upline_id__lte=last_pk, count__gt=0
+                ).values_list('upline_id', 'level', 'count')
+            }
+        )
+        uplines = {upline_id for upline_id, _ in (expected - stored) + (stored - expected)}
+        if fix and uplines:
+            DownlineLevelCount.objects.filter(upline_id__in=uplines).delete()
+            DownlineLevelCount.objects.bulk_create(
+                [
+                    DownlineLevelCount(upline_id=upline_id, level=level, count=count)
+                    for (upline_id, level), count in expected.items()
+                    if upline_id in uplines
+                ],
+                batch_size=self.batch_size,
+            )
+        return sorted(uplines)
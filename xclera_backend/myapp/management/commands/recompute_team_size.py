@@ -0,0 +1,79 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from myapp.models import UserProfile, ReferralRelationship
+from myapp.services.referral_storage import get_referral_storage
+
+
+def expected_team_size():
+    """Number of closure rows pointing at the outer profile as their upline"""
+    return Coalesce(
+        Subquery(
+            ReferralRelationship.objects.filter(upline=OuterRef('pk'))
+            .order_by()
+            .values('upline')
+            .annotate(total=Count('pk'))
+            .values('total')
+        ),
+        0,
+    )
+
+
+class Command(BaseCommand):
+    help = 'Recompute the team_size counter of every user profile from the referral relationships'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Number of profiles recomputed per UPDATE',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            help='Only report profiles whose counter has drifted',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        if not get_referral_storage().indexes_downlines:
+            raise CommandError(
+                'Team sizes are counted from closure rows; use rebuild_referral_closure '
+                'with the current REFERRAL_STORAGE'
+            )
+        self.stdout.write('Recomputing team sizes...')
+
+        last_pk = 0
+        checked = drifted = 0
+        while True:
+            batch = list(
+                UserProfile.objects.filter(pk__gt=last_pk)
+                .order_by('pk')
+                .values_list('pk', flat=True)[:batch_size]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1]
+
+            with transaction.atomic():
+                in_batch = UserProfile.objects.filter(pk__gte=batch[0], pk__lte=last_pk)
+                batch_drifted = (
+                    in_batch.annotate(expected=expected_team_size())
+                    .exclude(team_size=F('expected'))
+                    .count()
+                )
+                if batch_drifted and not dry_run:
+                    in_batch.update(team_size=expected_team_size())
+
+            checked += len(batch)
+            drifted += batch_drifted
+
+        self.stdout.write(f'Checked {checked} profiles, {drifted} had a drifted team size')
+        if dry_run:
+            self.stdout.write(self.style.WARNING('Dry run: no counters were changed'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Team sizes are up to date'))
@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 from myapp.models import Level
+from myapp.services.level_catalog import bump_level_catalog_version
 
 class Command(BaseCommand):
     help = 'Set up initial data for the Xclera Matrix Marketing System'
@@ -47,4 +48,7 @@ class Command(BaseCommand):
                 min_referral_depth=i - 1
             )
         
+        # Workers reload their level catalog on their next lookup
+        bump_level_catalog_version()
+
         self.stdout.write(self.style.SUCCESS(f'Successfully created {Level.objects.count()} levels'))
\ No newline at end of file
@@ -0,0 +1,60 @@
+import time
+from django.core.management.base import BaseCommand
+from myapp.services.blockchain import get_blockchain_service
+from myapp.services.confirmations import settle_pending_payments
+
+
+class Command(BaseCommand):
+    help = (
+        'Poll receipts of PENDING registration and upgrade transactions and settle them '
+        'once they have CONFIRMATION_BLOCKS confirmations. Runs until stopped unless --once is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Check the pending transactions once and exit',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=5,
+            help='Seconds between checks',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Receipts read per JSON-RPC batch',
+        )
+        parser.add_argument(
+            '--timeout',
+            type=int,
+            help='Seconds a transaction may stay unmined before it is marked failed '
+                 '(defaults to PENDING_TRANSACTION_TIMEOUT)',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                counts = settle_pending_payments(
+                    get_blockchain_service(),
+                    batch_size=options['batch_size'],
+                    timeout=options['timeout'],
+                )
+            except Exception as e:
+                # Node or database hiccup; retry on the next round
+                if options['once']:
+                    raise
+                self.stderr.write(self.style.ERROR(f'Confirmation check failed: {e}'))
+            else:
+                if counts['confirmed'] or counts['failed'] or counts['error'] or options['once']:
+                    self.stdout.write(
+                        f"Confirmed {counts['confirmed']}, failed {counts['failed']}, "
+                        f"still pending {counts['pending']}, errors {counts['error']}"
+                    )
+
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:12
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_team_size(apps, schema_editor):
+    UserProfile = apps.get_model("myapp", "UserProfile")
+    ReferralRelationship = apps.get_model("myapp", "ReferralRelationship")
+
+    UserProfile.objects.update(
+        team_size=Coalesce(
+            Subquery(
+                ReferralRelationship.objects.filter(upline=OuterRef("pk"))
+                .order_by()
+                .values("upline")
+                .annotate(total=Count("pk"))
+                .values("total")
+            ),
+            0,
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("myapp", "0005_level_rank_fee"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userprofile",
+            name="team_size",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_team_size, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("myapp", "0006_userprofile_team_size"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="referralrelationship",
+            index=models.Index(
+                fields=["upline", "level"], name="referral_upline_level_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:32
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def backfill_downline_level_counts(apps, schema_editor):
+    ReferralRelationship = apps.get_model("myapp", "ReferralRelationship")
+    DownlineLevelCount = apps.get_model("myapp", "DownlineLevelCount")
+
+    rows = (
+        ReferralRelationship.objects.order_by()
+        .values("upline_id", "level")
+        .annotate(total=Count("id"))
+        .iterator(chunk_size=5000)
+    )
+    batch = []
+    for row in rows:
+        batch.append(
+            DownlineLevelCount(
+                upline_id=row["upline_id"], level=row["level"], count=row["total"]
+            )
+        )
+        if len(batch) >= 5000:
+            DownlineLevelCount.objects.bulk_create(batch)
+            batch = []
+    DownlineLevelCount.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("myapp", "0007_referral_upline_level_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DownlineLevelCount",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("level", models.PositiveSmallIntegerField()),
+                ("count", models.PositiveIntegerField(default=0)),
+                (
+                    "upline",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="downline_level_counts",
+                        to="myapp.userprofile",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Downline Level Count",
+                "verbose_name_plural": "Downline Level Counts",
+                "unique_together": {("upline", "level")},
+            },
+        ),
+        migrations.RunPython(backfill_downline_level_counts, migrations.RunPython.noop),
+    ]
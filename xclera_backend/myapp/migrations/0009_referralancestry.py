@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("myapp", "0008_downlinelevelcount"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReferralAncestry",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="ancestry",
+                        serialize=False,
+                        to="myapp.userprofile",
+                    ),
+                ),
+                ("ancestors", models.BinaryField(default=bytes)),
+            ],
+            options={
+                "verbose_name": "Referral Ancestry",
+                "verbose_name_plural": "Referral Ancestries",
+            },
+        ),
+    ]
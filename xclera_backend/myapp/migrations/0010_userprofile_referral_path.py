@@ -0,0 +1,40 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:11
+
+from django.db import migrations
+import myapp.models
+
+
+def create_ltree_extension(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS ltree")
+
+
+def create_path_index(apps, schema_editor):
+    # GiST serves the <@ / @> subtree and ancestor operators
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS userprofile_referral_path_gist "
+            "ON myapp_userprofile USING GIST (referral_path)"
+        )
+
+
+def drop_path_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute("DROP INDEX IF EXISTS userprofile_referral_path_gist")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("myapp", "0009_referralancestry"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_ltree_extension, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name="userprofile",
+            name="referral_path",
+            field=myapp.models.LtreeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(create_path_index, drop_path_index),
+    ]
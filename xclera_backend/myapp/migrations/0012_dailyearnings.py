@@ -0,0 +1,58 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("myapp", "0011_transaction_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailyEarnings",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                (
+                    "transaction_type",
+                    models.CharField(
+                        choices=[
+                            ("REGISTRATION", "Registration"),
+                            ("UPGRADE", "Level Upgrade"),
+                            ("REWARD", "Reward Payment"),
+                        ],
+                        max_length=15,
+                    ),
+                ),
+                (
+                    "total",
+                    models.DecimalField(decimal_places=6, default=0, max_digits=20),
+                ),
+                ("count", models.PositiveIntegerField(default=0)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="daily_earnings",
+                        to="myapp.userprofile",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Daily Earnings",
+                "verbose_name_plural": "Daily Earnings",
+                "unique_together": {("user", "transaction_type", "day")},
+            },
+        ),
+    ]
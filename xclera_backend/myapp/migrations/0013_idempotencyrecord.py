@@ -0,0 +1,53 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("myapp", "0012_dailyearnings"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IdempotencyRecord",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("transaction_hash", models.CharField(max_length=66)),
+                (
+                    "operation",
+                    models.CharField(
+                        choices=[
+                            ("REGISTRATION", "Registration"),
+                            ("UPGRADE", "Level Upgrade"),
+                        ],
+                        max_length=15,
+                    ),
+                ),
+                ("status_code", models.PositiveSmallIntegerField()),
+                ("response", models.JSONField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="idempotency_records",
+                        to="myapp.userprofile",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("transaction_hash", "operation")},
+            },
+        ),
+    ]
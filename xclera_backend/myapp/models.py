@@ -4,6 +4,18 @@ from django.utils import timezone
 from decimal import Decimal
 
 
+class LtreeField(models.TextField):
+    """
+    PostgreSQL ltree column (needs the ltree extension); a plain text
+    column on every other database, where it is left unused
+    """
+
+    def db_type(self, connection):
+        if connection.vendor == "postgresql":
+            return "ltree"
+        return super().db_type(connection)
+
+
 class UserProfile(models.Model):
     """User profile with blockchain and referral data"""
 
@@ -25,6 +37,9 @@ class UserProfile(models.Model):
     current_level = models.PositiveSmallIntegerField(default=0)  # Start at level 0
     direct_referrals_count = models.PositiveIntegerField(default=0)
     max_referral_depth = models.PositiveSmallIntegerField(default=0)
+    team_size = models.PositiveIntegerField(default=0)  # All downlines, any depth
+    # Root-to-user path of profile ids, only kept with the "ltree" storage
+    referral_path = LtreeField(null=True, blank=True, editable=False)
     is_registered_on_chain = models.BooleanField(default=False)
     date_registered = models.DateTimeField(auto_now_add=True)
 
@@ -78,6 +93,10 @@ class ReferralRelationship(models.Model):
 
     class Meta:
         unique_together = ("user", "upline")
+        indexes = [
+            # Downline listings seek on (level, id) within one upline
+            models.Index(fields=["upline", "level"], name="referral_upline_level_idx"),
+        ]
         verbose_name = "Referral Relationship"
         verbose_name_plural = "Referral Relationships"
 
@@ -85,6 +104,49 @@ class ReferralRelationship(models.Model):
         return f"{self.user} -> {self.upline} (Level {self.level})"
 
 
+class DownlineLevelCount(models.Model):
+    """Number of downlines each user has at every level of depth"""
+
+    upline = models.ForeignKey(
+        UserProfile, on_delete=models.CASCADE, related_name="downline_level_counts"
+    )
+    level = models.PositiveSmallIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("upline", "level")
+        verbose_name = "Downline Level Count"
+        verbose_name_plural = "Downline Level Counts"
+
+    def __str__(self):
+        return f"{self.upline} - Level {self.level}: {self.count}"
+
+
+class ReferralAncestry(models.Model):
+    """
+    A user's whole upline chain packed into one row
+
+    Used instead of ReferralRelationship rows when REFERRAL_STORAGE is
+    "packed". `ancestors` holds the upline ids as little-endian uint32
+    values, ordered from the direct referrer (level 1) upwards.
+    """
+
+    user = models.OneToOneField(
+        UserProfile,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="ancestry",
+    )
+    ancestors = models.BinaryField(default=bytes)
+
+    class Meta:
+        verbose_name = "Referral Ancestry"
+        verbose_name_plural = "Referral Ancestries"
+
+    def __str__(self):
+        return f"{self.user} ({len(self.ancestors) // 4} uplines)"
+
+
 class Transaction(models.Model):
     """Records all blockchain transactions"""
 
@@ -123,6 +185,83 @@ class Transaction(models.Model):
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            # dashboard_stats earnings sums, covering so amount needs no row lookup
+            models.Index(
+                fields=["user", "transaction_type", "created_at", "amount"],
+                name="tx_user_type_created_idx",
+            ),
+            # A user's own history, newest first
+            models.Index(fields=["user", "-created_at"], name="tx_user_created_idx"),
+            # TransactionViewSet listings, newest first, unfiltered or by one filter
+            models.Index(fields=["-created_at"], name="tx_created_idx"),
+            models.Index(
+                fields=["transaction_type", "-created_at"], name="tx_type_created_idx"
+            ),
+            models.Index(
+                fields=["status", "-created_at"], name="tx_status_created_idx"
+            ),
+            models.Index(fields=["level", "-created_at"], name="tx_level_created_idx"),
+            # Looking up the ledger rows of an on-chain transaction
+            models.Index(fields=["transaction_hash"], name="tx_hash_idx"),
+        ]
+
+
+class DailyEarnings(models.Model):
+    """
+    Per user, day and transaction type totals of the Transaction ledger
+
+    Kept in step with every ledger write so dashboards can sum a handful of
+    rows instead of a user's whole transaction history. Days are UTC dates
+    of Transaction.created_at.
+    """
+
+    user = models.ForeignKey(
+        UserProfile, on_delete=models.CASCADE, related_name="daily_earnings"
+    )
+    day = models.DateField()
+    transaction_type = models.CharField(
+        max_length=15, choices=Transaction.TRANSACTION_TYPES
+    )
+    total = models.DecimalField(max_digits=20, decimal_places=6, default=0)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("user", "transaction_type", "day")
+        verbose_name = "Daily Earnings"
+        verbose_name_plural = "Daily Earnings"
+
+    def __str__(self):
+        return f"{self.user} - {self.day} {self.transaction_type}: {self.total} USDT"
+
+
+class IdempotencyRecord(models.Model):
+    """
+    Result of an operation already processed for an on-chain transaction
+
+    A client retrying a submission with the same transaction hash gets the
+    stored response back instead of the operation running again.
+    """
+
+    OPERATIONS = [
+        ("REGISTRATION", "Registration"),
+        ("UPGRADE", "Level Upgrade"),
+    ]
+
+    transaction_hash = models.CharField(max_length=66)
+    operation = models.CharField(max_length=15, choices=OPERATIONS)
+    user = models.ForeignKey(
+        UserProfile, on_delete=models.CASCADE, related_name="idempotency_records"
+    )
+    status_code = models.PositiveSmallIntegerField()
+    response = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("transaction_hash", "operation")
+
+    def __str__(self):
+        return f"{self.operation} {self.transaction_hash}"
 
 
 class RefreshToken(models.Model):
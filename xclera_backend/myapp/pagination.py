@@ -0,0 +1,218 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination that seeks on a unique ordering key
+
+    Each page is fetched with a WHERE clause on the last key seen instead of
+    an OFFSET, and no COUNT query is run, so deep pages cost the same as the
+    first one. The opaque cursor also carries the filter parameters of the
+    first request so follow-up pages keep the same filters.
+    """
+
+    # Unique ordering key, "-" prefix for descending fields
+    ordering = ("id",)
+    # Type of each ordering field, int or datetime
+    ordering_types = (int,)
+    # Query parameters captured into the cursor
+    filter_params = ()
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 500
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def encode_cursor(self, position, filters):
+        payload = json.dumps({"p": position, "f": filters}, cls=DjangoJSONEncoder)
+        return base64.urlsafe_b64encode(payload.encode()).decode()
+
+    def decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+            position = self.parse_position(payload["p"])
+            filters = self.parse_filters(payload["f"])
+        except (binascii.Error, ValueError, KeyError, TypeError):
+            raise NotFound(self.invalid_cursor_message)
+        return position, filters
+
+    def parse_position(self, position):
+        """Validate a cursor's ordering key, raising ValueError on a bad one"""
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise ValueError("Malformed position")
+        key = []
+        for value, key_type in zip(position, self.ordering_types):
+            if key_type is datetime:
+                value = parse_datetime(value) if isinstance(value, str) else None
+                if value is None:
+                    raise ValueError("Malformed datetime")
+            elif (
+                not isinstance(value, int)
+                or isinstance(value, bool)
+                or abs(value) >= 2**63
+            ):
+                raise ValueError("Malformed integer")
+            key.append(value)
+        return key
+
+    def parse_filters(self, filters):
+        """Validate a cursor's filters, raising ValueError on bad ones"""
+        if not isinstance(filters, dict) or not all(
+            name in self.filter_params and isinstance(value, str)
+            for name, value in filters.items()
+        ):
+            raise ValueError("Malformed filters")
+        return filters
+
+    def get_filter_params(self, request):
+        """Filters to apply: those stored in the cursor, else the query string"""
+        cursor = self.decode_cursor(request)
+        if cursor:
+            return cursor[1]
+        return {
+            name: request.query_params[name]
+            for name in self.filter_params
+            if request.query_params.get(name)
+        }
+
+    def seek(self, position):
+        """Q object selecting the rows that come after the given key"""
+        condition = Q()
+        equal = Q()
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            condition |= equal & Q(**{f"{name}__{lookup}": value})
+            equal &= Q(**{name: value})
+        # A plain range on the leading field lets the database seek an index
+        # instead of evaluating the OR for every row
+        first = self.ordering[0]
+        lookup = "lte" if first.startswith("-") else "gte"
+        return Q(**{f"{first.lstrip('-')}__{lookup}": position[0]}) & condition
+
+    def get_position(self, obj):
+        position = [getattr(obj, field.lstrip("-")) for field in self.ordering]
+        # isoformat() keeps the microseconds DjangoJSONEncoder would truncate
+        return [
+            value.isoformat() if isinstance(value, datetime) else value
+            for value in position
+        ]
+
+    def iterate(self, queryset, position=None, chunk_size=1000):
+        """
+        Walk an entire queryset in key order, one bounded chunk at a time
+
+        Unlike QuerySet.iterator() this keeps memory flat on MySQL too, where
+        the driver buffers the whole result set client side.
+        """
+        queryset = queryset.order_by(*self.ordering)
+        while True:
+            page = queryset.filter(self.seek(position)) if position else queryset
+            rows = list(page[:chunk_size])
+            yield from rows
+            if len(rows) < chunk_size:
+                return
+            position = self.get_position(rows[-1])
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+        self.filters = cursor[1] if cursor else self.get_filter_params(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        if cursor:
+            queryset = queryset.filter(self.seek(cursor[0]))
+
+        rows = list(queryset[: self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        rows = rows[: self.page_size]
+        self.next_position = self.get_position(rows[-1]) if self.has_next else None
+        return rows
+
+    def paginate_keys(self, fetch_keys, request):
+        """
+        Paginate ordering key tuples listed by `fetch_keys(after, limit)`
+
+        For data that cannot be queried as a queryset, e.g. downlines listed
+        from the referral graph. `fetch_keys` returns, in ascending order, at
+        most `limit` keys following the `after` key (None on the first page).
+        Returns the keys of the requested page; ascending orderings only.
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+        self.filters = cursor[1] if cursor else self.get_filter_params(request)
+
+        after = tuple(cursor[0]) if cursor else None
+        page = list(fetch_keys(after, self.page_size + 1))
+        self.has_next = len(page) > self.page_size
+        page = page[: self.page_size]
+        self.next_position = list(page[-1]) if self.has_next else None
+        return page
+
+    def get_next_cursor(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self.next_position, self.filters)
+
+    def get_next_link(self):
+        cursor = self.get_next_cursor()
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        for name in self.filter_params:
+            url = remove_query_param(url, name)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                "next": self.get_next_link(),
+                "next_cursor": self.get_next_cursor(),
+                "results": data,
+            }
+        )
+
+
+class DownlinePagination(KeysetPagination):
+    ordering = ("level", "id")
+    ordering_types = (int, int)
+    filter_params = ("max_depth",)
+    page_size = 50
+    max_page_size = 1000
+
+
+class TransactionPagination(KeysetPagination):
+    ordering = ("-created_at", "-id")
+    ordering_types = (datetime, int)
+    filter_params = (
+        "wallet_address",
+        "transaction_type",
+        "status",
+        "transaction_hash",
+        "level",
+        "from_date",
+        "to_date",
+    )
@@ -22,6 +22,7 @@ class UserProfileSerializer(serializers.ModelSerializer):
             "current_level",
             "direct_referrals_count",
             "max_referral_depth",
+            "team_size",
             "is_registered_on_chain",
             "date_registered",
             "is_profile_complete",
@@ -30,6 +31,7 @@ class UserProfileSerializer(serializers.ModelSerializer):
             "id",
             "direct_referrals_count",
             "max_referral_depth",
+            "team_size",
             "is_registered_on_chain",
             "date_registered",
             "wallet_address",
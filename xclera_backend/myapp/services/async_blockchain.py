@@ -0,0 +1,167 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+import aiohttp
+from web3 import AsyncWeb3
+from web3.exceptions import TransactionNotFound
+from web3._utils.request import async_make_post_request
+from web3.providers.async_rpc import AsyncHTTPProvider
+from .blockchain import (
+    HEALTH_CHECK_INTERVAL,
+    RPC_TIMEOUT,
+    BlockchainService,
+    batch_requests,
+    batch_responses,
+    blockchain_settings,
+    unknown_transaction_result,
+    verification_result,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class TrackedAsyncHTTPProvider(AsyncHTTPProvider):
+    """AsyncHTTPProvider remembering when the node last answered"""
+
+    def __init__(self, endpoint_uri, timeout=RPC_TIMEOUT):
+        super().__init__(endpoint_uri, request_kwargs={'timeout': aiohttp.ClientTimeout(total=timeout)})
+        self.last_success = 0.0
+
+    async def make_request(self, method, params):
+        try:
+            response = await super().make_request(method, params)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.last_success = 0.0
+            raise
+        self.last_success = time.monotonic()
+        return response
+
+    async def make_batch_request(self, calls):
+        """
+        Send (method, params) calls as one JSON-RPC batch over the provider's
+        session, see PooledHTTPProvider.make_batch_request()
+        """
+        requests_data = batch_requests(calls, self.request_counter)
+        try:
+            raw_response = await async_make_post_request(
+                self.endpoint_uri, json.dumps(requests_data).encode(), **self.get_request_kwargs()
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.last_success = 0.0
+            raise
+        self.last_success = time.monotonic()
+
+        responses = json.loads(raw_response)
+        if not isinstance(responses, list):
+            return [await self.make_request(method, params) for method, params in calls]
+        return batch_responses(requests_data, responses)
+
+
+class AsyncBlockchainService:
+    """
+    Awaitable counterpart of BlockchainService for the async views
+
+    RPC calls go through AsyncWeb3, so a worker running an event loop keeps
+    serving other requests while the node answers. The contract encoding,
+    settings and gas price cache are those of a BlockchainService built
+    alongside it, which does no I/O of its own here; use the per-process
+    instance from get_async_blockchain_service().
+    """
+
+    def __init__(self):
+        self.service = BlockchainService()
+        self.provider = TrackedAsyncHTTPProvider(self.service.web3_provider_url)
+        self.w3 = AsyncWeb3(self.provider)
+
+    async def ensure_connected(self):
+        """Raise ConnectionError when the node is down, probing it as lazily as BlockchainService"""
+        if time.monotonic() - self.provider.last_success < HEALTH_CHECK_INTERVAL:
+            return
+        if not await self.w3.is_connected():
+            raise ConnectionError("Cannot connect to Ethereum node")
+
+    async def submit_transaction(self, signed_transaction):
+        """Send a signed transaction and return its hash without waiting for a receipt"""
+        tx_hash = await self.w3.eth.send_raw_transaction(signed_transaction)
+        return {
+            'status': 'pending',
+            'transaction_hash': AsyncWeb3.to_hex(tx_hash),
+        }
+
+    async def verify_transaction(self, transaction_hash):
+        """Verify transaction using the hash, see BlockchainService"""
+        required = self.service.confirmation_blocks
+        try:
+            receipt = await self.w3.eth.get_transaction_receipt(transaction_hash)
+            head = await self.w3.eth.block_number if required > 1 else None
+            return verification_result(transaction_hash, receipt, head, required)
+        except TransactionNotFound:
+            return await self.unmined_result(transaction_hash)
+        except Exception as e:
+            logger.exception("Error verifying transaction %s", transaction_hash)
+            return {
+                'status': 'failed',
+                'error': str(e)
+            }
+
+    async def unmined_result(self, transaction_hash):
+        """verify_transaction() result for a hash without a receipt, see BlockchainService"""
+        try:
+            await self.w3.eth.get_transaction(transaction_hash)
+        except TransactionNotFound:
+            return unknown_transaction_result(transaction_hash)
+        return verification_result(transaction_hash, None)
+
+    async def build_register_transaction(self, user_wallet, referrer_wallet):
+        """Build an unsigned registration transaction, see BlockchainService"""
+        return await self.build_transaction(
+            *self.service.register_call(user_wallet, referrer_wallet)
+        )
+
+    async def build_upgrade_transaction(self, user_wallet, new_level, upline_wallet):
+        """Build an unsigned level upgrade transaction, see BlockchainService"""
+        return await self.build_transaction(
+            *self.service.upgrade_call(user_wallet, new_level, upline_wallet)
+        )
+
+    async def build_transaction(self, user_wallet, value, data):
+        """
+        Build an unsigned contract call from user_wallet, reading the nonce
+        and gas fields in a single JSON-RPC batch like BlockchainService
+        """
+        transaction, calls, gas_price = self.service.transaction_reads(user_wallet, value, data)
+        responses = await self.provider.make_batch_request(calls)
+        return self.service.complete_transaction(transaction, gas_price, responses)
+
+
+_service = None
+_service_settings = None
+_service_lock = threading.Lock()
+
+
+async def get_async_blockchain_service():
+    """
+    Return the AsyncBlockchainService shared by every request of this
+    process, checked to reach the node (lazily, see ensure_connected)
+    """
+    global _service, _service_settings
+    current = blockchain_settings()
+    service = _service
+    if service is None or _service_settings != current:
+        with _service_lock:
+            if _service is None or _service_settings != current:
+                _service = AsyncBlockchainService()
+                _service_settings = current
+            service = _service
+    await service.ensure_connected()
+    return service
+
+
+def reset_async_blockchain_service():
+    """Drop the shared service; the next get_async_blockchain_service() rebuilds it"""
+    global _service, _service_settings
+    with _service_lock:
+        _service = None
+        _service_settings = None
@@ -1,11 +1,225 @@
 import json
+import logging
 import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
 from web3 import Web3
+from web3.exceptions import TransactionNotFound
+from web3.providers.rpc import HTTPProvider
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
+# Keep-alive connections one worker holds open to the RPC node
+RPC_POOL_SIZE = 10
+RPC_TIMEOUT = 10
+# Seconds a successful RPC call vouches for the node before the next probe
+HEALTH_CHECK_INTERVAL = 30
+# A cached gas price older than this many TTLs is refetched before use
+# instead of being served while the background refresh runs
+GAS_PRICE_MAX_AGE_TTLS = 4
+# Gas limit used when estimation is off or eth_estimateGas fails, and the
+# headroom added to estimates in case state moves before the user signs
+DEFAULT_GAS_LIMIT = 2000000
+GAS_ESTIMATE_MARGIN = 1.2
+
+logger = logging.getLogger(__name__)
+
+
+class PooledHTTPProvider(HTTPProvider):
+    """
+    HTTPProvider posting through one pooled requests session shared by all
+    threads (web3 keeps a session per thread otherwise), remembering when
+    the node last answered
+    """
+
+    def __init__(self, endpoint_uri, pool_size=RPC_POOL_SIZE, timeout=RPC_TIMEOUT):
+        super().__init__(endpoint_uri, request_kwargs={'timeout': timeout})
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.last_success = 0.0
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        try:
+            raw_response = self.session.post(
+                self.endpoint_uri, data=request_data, **self.get_request_kwargs()
+            )
+            raw_response.raise_for_status()
+        except requests.RequestException:
+            self.last_success = 0.0
+            raise
+        self.last_success = time.monotonic()
+        return self.decode_rpc_response(raw_response.content)
+
+    def make_batch_request(self, calls):
+        """
+        Send (method, params) calls as one JSON-RPC batch, one round trip
+
+        Returns the raw responses in call order, each with a 'result' or an
+        'error'. Nodes that reject batches get the calls one at a time.
+        """
+        requests_data = batch_requests(calls, self.request_counter)
+        try:
+            raw_response = self.session.post(
+                self.endpoint_uri, data=json.dumps(requests_data), **self.get_request_kwargs()
+            )
+            raw_response.raise_for_status()
+        except requests.RequestException:
+            self.last_success = 0.0
+            raise
+        self.last_success = time.monotonic()
+
+        responses = json.loads(raw_response.content)
+        if not isinstance(responses, list):
+            return [self.make_request(method, params) for method, params in calls]
+        return batch_responses(requests_data, responses)
+
+
+def batch_requests(calls, request_counter):
+    """JSON-RPC request objects for (method, params) calls"""
+    return [
+        {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': next(request_counter)}
+        for method, params in calls
+    ]
+
+
+def batch_responses(requests_data, responses):
+    """A batch's responses matched to its requests by id, in request order"""
+    by_id = {response.get('id'): response for response in responses}
+    return [
+        by_id.get(request['id'], {'error': {'message': 'Missing from batch response'}})
+        for request in requests_data
+    ]
+
+
+class GasPriceOracle:
+    """
+    Per-process gas price cache
+
+    A price younger than `ttl` seconds is served as is (a hit). An older one
+    is still served (a stale hit) while one background thread fetches the
+    next, so requests do not wait on the node; only the first call, or one
+    after the price went unrefreshed for GAS_PRICE_MAX_AGE_TTLS TTLs, fetches
+    inline (a miss).
+
+    With `smoothing_blocks`, the price is the pending base fee plus the mean
+    median tip of that many recent blocks (eth_feeHistory) rather than the
+    node's own eth_gasPrice guess.
+    """
+
+    def __init__(self, w3, ttl, smoothing_blocks=0):
+        self.w3 = w3
+        self.ttl = ttl
+        self.smoothing_blocks = smoothing_blocks
+        self.price = None
+        self.fetched_at = 0.0
+        self.refreshing = False
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0}
+
+    def get(self):
+        """Return the gas price in wei"""
+        price = self.cached()
+        return price if price is not None else self.refresh()
+
+    def cached(self):
+        """
+        Return the cached price, refreshing it in the background when stale,
+        or None on a miss; the caller then fetches it and calls store()
+        """
+        with self.lock:
+            age = time.monotonic() - self.fetched_at
+            if self.price is not None and age < self.ttl:
+                self.counts['hits'] += 1
+                return self.price
+            if self.price is None or age >= self.ttl * GAS_PRICE_MAX_AGE_TTLS:
+                self.counts['misses'] += 1
+                return None
+            self.counts['stale_hits'] += 1
+            price = self.price
+            start_refresh = not self.refreshing
+            self.refreshing = True
+
+        if start_refresh:
+            threading.Thread(target=self.refresh_in_background, daemon=True).start()
+        return price
+
+    def refresh(self):
+        """Fetch the gas price from the node and cache it"""
+        return self.store(self.fetch())
+
+    def store(self, price):
+        with self.lock:
+            self.price = price
+            self.fetched_at = time.monotonic()
+            self.counts['refreshes'] += 1
+        return price
+
+    def refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            # Keep serving the cached price; a later get() retries
+            with self.lock:
+                self.counts['errors'] += 1
+            logger.warning("Gas price refresh failed: %s", e)
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def fetch(self):
+        if not self.smoothing_blocks:
+            return self.w3.eth.gas_price
+        history = self.w3.eth.fee_history(self.smoothing_blocks, 'latest', [50])
+        return self.smoothed(history['baseFeePerGas'], history['reward'])
+
+    def smoothed(self, base_fees, rewards):
+        tips = [reward[0] for reward in rewards]
+        if not tips:
+            return self.w3.eth.gas_price
+        # baseFeePerGas ends with the base fee of the pending block
+        return base_fees[-1] + sum(tips) // len(tips)
+
+    def rpc_call(self):
+        """The (method, params) fetching the price, for batching with other reads"""
+        if not self.smoothing_blocks:
+            return 'eth_gasPrice', []
+        return 'eth_feeHistory', [hex(self.smoothing_blocks), 'latest', [50]]
+
+    def store_rpc_result(self, result):
+        """Cache the price from the raw result of rpc_call()"""
+        if not self.smoothing_blocks:
+            return self.store(int(result, 16))
+        return self.store(
+            self.smoothed(
+                [int(fee, 16) for fee in result['baseFeePerGas']],
+                [[int(tip, 16) for tip in reward] for reward in result.get('reward') or []],
+            )
+        )
+
+    def metrics(self):
+        """Hit/miss counters and the cached price, for logs and monitoring"""
+        with self.lock:
+            lookups = self.counts['hits'] + self.counts['stale_hits'] + self.counts['misses']
+            return {
+                **self.counts,
+                'hit_ratio': (lookups - self.counts['misses']) / lookups if lookups else 0.0,
+                'price': self.price,
+                'age': time.monotonic() - self.fetched_at if self.price is not None else None,
+            }
+
+
 class BlockchainService:
-    """Service for interacting with the blockchain contract"""
+    """
+    Service for interacting with the blockchain contract
+
+    Building one reads the ABI and opens a connection pool, so use the
+    per-process instance from get_blockchain_service() instead.
+    """
     
     def __init__(self):
         # Get contract address and ABI from settings
@@ -23,16 +237,36 @@ class BlockchainService:
         with open(self.contract_abi_path, 'r') as abi_file:
             self.contract_abi = json.load(abi_file)
         
-        # Initialize Web3 connection
-        self.w3 = Web3(Web3.HTTPProvider(self.web3_provider_url))
-        if not self.w3.is_connected():
-            raise ConnectionError("Cannot connect to Ethereum node")
+        # Initialize Web3 connection; the node is only probed when used
+        self.provider = PooledHTTPProvider(self.web3_provider_url)
+        self.w3 = Web3(self.provider)
         
         # Initialize contract
         self.contract = self.w3.eth.contract(
             address=self.contract_address,
             abi=self.contract_abi
         )
+
+        self.gas_price_oracle = GasPriceOracle(
+            self.w3,
+            ttl=getattr(settings, 'GAS_PRICE_TTL', 15),
+            smoothing_blocks=getattr(settings, 'GAS_PRICE_SMOOTHING_BLOCKS', 0),
+        )
+        self.estimate_gas = getattr(settings, 'ESTIMATE_GAS', False)
+        self.confirmation_blocks = getattr(settings, 'CONFIRMATION_BLOCKS', 1)
+
+    def ensure_connected(self):
+        """
+        Raise ConnectionError when the node is down
+
+        Free while RPC calls keep succeeding; the node is only probed when
+        nothing answered in the last HEALTH_CHECK_INTERVAL seconds or the
+        last call failed.
+        """
+        if time.monotonic() - self.provider.last_success < HEALTH_CHECK_INTERVAL:
+            return
+        if not self.w3.is_connected():
+            raise ConnectionError("Cannot connect to Ethereum node")
     
     def is_user_registered(self, wallet_address):
         """Check if user is registered on blockchain"""
@@ -53,6 +287,20 @@ class BlockchainService:
         
         Returns transaction data that needs to be signed by the user's wallet
         """
+        return self.build_transaction(*self.register_call(user_wallet, referrer_wallet))
+
+    def build_upgrade_transaction(self, user_wallet, new_level, upline_wallet):
+        """
+        Build an unsigned transaction for level upgrade with USDT
+        
+        Returns transaction data that needs to be signed by the user's wallet
+        """
+        return self.build_transaction(
+            *self.upgrade_call(user_wallet, new_level, upline_wallet)
+        )
+
+    def register_call(self, user_wallet, referrer_wallet):
+        """(sender, value in wei, calldata) of a registration"""
         # Get constants from contract (in USDT)
         level_1_price = 100  # 100 USDT
         service_fee = 15     # 15 USDT
@@ -62,28 +310,14 @@ class BlockchainService:
         user_wallet = self.w3.to_checksum_address(user_wallet)
         referrer_wallet = self.w3.to_checksum_address(referrer_wallet)
         
-        # Get the current nonce
-        nonce = self.w3.eth.get_transaction_count(user_wallet)
-        
-        # Build transaction with hex values
-        transaction = {
-            'from': user_wallet,
-            'to': self.contract_address,
-            'value': hex(self.w3.to_wei(total_amount, 'ether')),  # Convert to hex
-            'chainId': self.chain_id,
-            'gas': hex(2000000),  # Gas limit in hex
-            'gasPrice': hex(self.w3.eth.gas_price),  # Gas price in hex
-            'nonce': hex(nonce),  # Nonce in hex
-            'data': self.contract.encodeABI(fn_name='register', args=[referrer_wallet])
-        }
-        return transaction
+        return (
+            user_wallet,
+            self.w3.to_wei(total_amount, 'ether'),
+            self.contract.encodeABI(fn_name='register', args=[referrer_wallet])
+        )
 
-    def build_upgrade_transaction(self, user_wallet, new_level, upline_wallet):
-        """
-        Build an unsigned transaction for level upgrade with USDT
-        
-        Returns transaction data that needs to be signed by the user's wallet
-        """
+    def upgrade_call(self, user_wallet, new_level, upline_wallet):
+        """(sender, value in wei, calldata) of a level upgrade"""
         # Calculate upgrade fee in USDT (150 for level 2, 200 for level 3, etc.)
         upgrade_fee = (new_level * 50) + 50
 
@@ -91,25 +325,77 @@ class BlockchainService:
         user_wallet = self.w3.to_checksum_address(user_wallet)
         upline_wallet = self.w3.to_checksum_address(upline_wallet)
         
-        # Get the current nonce
-        nonce = self.w3.eth.get_transaction_count(user_wallet)
-        
-        # Build transaction with hex values
+        return (
+            user_wallet,
+            self.w3.to_wei(upgrade_fee, 'ether'),
+            self.contract.encodeABI(
+                fn_name='upgradeLevel',
+                args=[new_level, upline_wallet]
+            )
+        )
+
+    def build_transaction(self, user_wallet, value, data):
+        """
+        Build an unsigned contract call from user_wallet
+
+        The nonce, the gas price (unless the oracle has it cached) and, with
+        ESTIMATE_GAS, the gas limit are read in a single JSON-RPC batch.
+        """
+        transaction, calls, gas_price = self.transaction_reads(user_wallet, value, data)
+        responses = self.provider.make_batch_request(calls)
+        return self.complete_transaction(transaction, gas_price, responses)
+
+    def transaction_reads(self, user_wallet, value, data):
+        """
+        Return the transaction without its nonce and gas fields, the
+        (method, params) RPC calls reading them and the cached gas price
+        (None when it is one of the calls)
+        """
         transaction = {
             'from': user_wallet,
             'to': self.contract_address,
-            'value': hex(self.w3.to_wei(upgrade_fee, 'ether')),  # Convert to hex
+            'value': hex(value),  # Convert to hex
             'chainId': self.chain_id,
-            'gas': hex(2000000),  # Gas limit in hex
-            'gasPrice': hex(self.w3.eth.gas_price),  # Gas price in hex
-            'nonce': hex(nonce),  # Nonce in hex
-            'data': self.contract.encodeABI(
-                fn_name='upgradeLevel',
-                args=[new_level, upline_wallet]
-            )
+            'data': data,
         }
-        
+
+        calls = [('eth_getTransactionCount', [user_wallet, 'latest'])]
+        gas_price = self.gas_price_oracle.cached()
+        if gas_price is None:
+            calls.append(self.gas_price_oracle.rpc_call())
+        if self.estimate_gas:
+            calls.append((
+                'eth_estimateGas',
+                [{key: transaction[key] for key in ('from', 'to', 'value', 'data')}]
+            ))
+        return transaction, calls, gas_price
+
+    def complete_transaction(self, transaction, gas_price, responses):
+        """Fill in the nonce and gas fields from the raw responses of transaction_reads()"""
+        responses = iter(responses)
+        nonce = int(self.rpc_result(next(responses)), 16)
+        if gas_price is None:
+            gas_price = self.gas_price_oracle.store_rpc_result(self.rpc_result(next(responses)))
+        gas = DEFAULT_GAS_LIMIT
+        if self.estimate_gas:
+            estimate = next(responses)
+            if 'error' in estimate:
+                # Would revert as things stand; let the wallet show the reason
+                logger.info("Gas estimate failed, using %d: %s", gas, estimate['error'])
+            else:
+                gas = int(int(estimate['result'], 16) * GAS_ESTIMATE_MARGIN)
+
+        transaction.update({
+            'gas': hex(gas),  # Gas limit in hex
+            'gasPrice': hex(gas_price),  # Gas price in hex
+            'nonce': hex(nonce),  # Nonce in hex
+        })
         return transaction
+
+    def rpc_result(self, response):
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response['result']
     
     def submit_transaction(self, signed_transaction):
         """
@@ -119,42 +405,154 @@ class BlockchainService:
             signed_transaction: The signed transaction from the user's wallet
             
         Returns:
-            Dict with transaction hash, status, and block number
+            Dict with the transaction hash and a 'pending' status; the receipt
+            is picked up later by verify_transaction() or the confirmation
+            tracker instead of being waited for here
         """
         # Send the signed transaction
         tx_hash = self.w3.eth.send_raw_transaction(signed_transaction)
         
-        # Wait for transaction receipt
-        tx_receipt = self.w3.eth.wait_for_transaction_receipt(tx_hash)
-        
         return {
-            'tx_hash': tx_hash.hex(),
-            'status': 'success' if tx_receipt["status"] == 1 else 'failed',
-            'block_number': tx_receipt["blockNumber"]
+            'status': 'pending',
+            'transaction_hash': Web3.to_hex(tx_hash),
         }
 
     def verify_transaction(self, transaction_hash):
-        """Verify transaction using the hash"""
+        """
+        Verify transaction using the hash
+
+        The status is 'pending' while the transaction is not mined or has
+        fewer than CONFIRMATION_BLOCKS confirmations, and 'not_found' when
+        the node doesn't know the hash at all.
+        """
         try:
             # Get transaction receipt
             receipt = self.w3.eth.get_transaction_receipt(transaction_hash)
-            
-            # Check if transaction was successful
-            if receipt and receipt['status'] == 1:
-                return {
-                    'status': 'success',
-                    'transaction_hash': transaction_hash,
-                    'block_number': receipt['blockNumber']
-                }
-            else:
-                return {
-                    'status': 'failed',
-                    'transaction_hash': transaction_hash,
-                    'error': 'Transaction failed or not found'
-                }
+            head = self.w3.eth.block_number if self.confirmation_blocks > 1 else None
+            return verification_result(
+                transaction_hash, receipt, head, self.confirmation_blocks
+            )
+        except TransactionNotFound:
+            return self.unmined_result(transaction_hash)
         except Exception as e:
-            print(f"Error verifying transaction: {e}")
+            logger.exception("Error verifying transaction %s", transaction_hash)
             return {
                 'status': 'failed',
                 'error': str(e)
-            }
\ No newline at end of file
+            }
+
+    def unmined_result(self, transaction_hash):
+        """verify_transaction() result for a hash without a receipt"""
+        try:
+            # Only transactions the node has seen are worth waiting for
+            self.w3.eth.get_transaction(transaction_hash)
+        except TransactionNotFound:
+            return unknown_transaction_result(transaction_hash)
+        return verification_result(transaction_hash, None)
+
+    def transaction_receipts(self, transaction_hashes):
+        """
+        Return the head block number and {hash: raw receipt or None} of
+        several transactions, read in one JSON-RPC batch
+
+        A hash the node answers with an error maps to that error as a
+        ValueError instance, so one bad hash doesn't lose the whole batch.
+        """
+        responses = self.provider.make_batch_request(
+            [('eth_blockNumber', [])]
+            + [('eth_getTransactionReceipt', [tx_hash]) for tx_hash in transaction_hashes]
+        )
+        head = int(self.rpc_result(responses[0]), 16)
+        return head, {
+            tx_hash: ValueError(response['error']) if 'error' in response else response['result']
+            for tx_hash, response in zip(transaction_hashes, responses[1:])
+        }
+
+
+def confirmations(receipt_block, head):
+    """Blocks on top of and including the one a transaction was mined in"""
+    return head - receipt_block + 1
+
+
+def unknown_transaction_result(transaction_hash):
+    """verify_transaction() result for a hash the node has never seen"""
+    return {
+        'status': 'not_found',
+        'transaction_hash': transaction_hash,
+        'error': 'Transaction not found',
+    }
+
+
+def verification_result(transaction_hash, receipt, head=None, required=1):
+    """verify_transaction() result for a fetched receipt (None while not mined)"""
+    if receipt is None:
+        return {
+            'status': 'pending',
+            'transaction_hash': transaction_hash,
+        }
+    # Check if transaction was successful
+    if receipt['status'] == 1:
+        if head is not None and confirmations(receipt['blockNumber'], head) < required:
+            return {
+                'status': 'pending',
+                'transaction_hash': transaction_hash,
+                'block_number': receipt['blockNumber'],
+            }
+        return {
+            'status': 'success',
+            'transaction_hash': transaction_hash,
+            'block_number': receipt['blockNumber']
+        }
+    else:
+        return {
+            'status': 'failed',
+            'transaction_hash': transaction_hash,
+            'error': 'Transaction failed'
+        }
+
+
+def blockchain_settings():
+    return (
+        getattr(settings, 'WEB3_PROVIDER_URL', None),
+        getattr(settings, 'CONTRACT_ADDRESS', None),
+        getattr(settings, 'CONTRACT_ABI_PATH', None),
+        getattr(settings, 'CHAIN_ID', None),
+        getattr(settings, 'GAS_PRICE_TTL', None),
+        getattr(settings, 'GAS_PRICE_SMOOTHING_BLOCKS', None),
+        getattr(settings, 'ESTIMATE_GAS', None),
+        getattr(settings, 'CONFIRMATION_BLOCKS', None),
+    )
+
+
+_service = None
+_service_settings = None
+_service_lock = threading.Lock()
+
+
+def get_blockchain_service():
+    """
+    Return the BlockchainService shared by every request of this process,
+    checked to reach the node (lazily, see ensure_connected)
+
+    The ABI, contract object and RPC connection pool are built on first use
+    and kept until the blockchain settings change.
+    """
+    global _service, _service_settings
+    current = blockchain_settings()
+    service = _service
+    if service is None or _service_settings != current:
+        with _service_lock:
+            if _service is None or _service_settings != current:
+                _service = BlockchainService()
+                _service_settings = current
+            service = _service
+    service.ensure_connected()
+    return service
+
+
+def reset_blockchain_service():
+    """Drop the shared service; the next get_blockchain_service() rebuilds it"""
+    global _service, _service_settings
+    with _service_lock:
+        _service = None
+        _service_settings = None
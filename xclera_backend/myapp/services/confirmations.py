@@ -0,0 +1,119 @@
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from ..models import Transaction
+from .blockchain import confirmations
+from .ledger import fail_pending
+from .settlement import settle_registration, settle_upgrade
+
+logger = logging.getLogger(__name__)
+
+
+def pending_payments():
+    """PENDING registration/upgrade payment rows waiting for their receipt"""
+    return (
+        Transaction.objects.filter(
+            status="PENDING",
+            transaction_type__in=("REGISTRATION", "UPGRADE"),
+            recipient=None,
+        )
+        .exclude(transaction_hash=None)
+        .select_related("user__referrer")
+    )
+
+
+def settle_payment(row, receipt, head, required, expired_before):
+    """
+    Settle one PENDING payment row from its raw receipt (None while not
+    mined) and return "confirmed", "failed" or "pending"
+    """
+    if receipt is None:
+        if row.created_at < expired_before:
+            # Dropped from the mempool, or never broadcast
+            fail_pending(row)
+            return "failed"
+        return "pending"
+
+    if int(receipt["status"], 16) != 1:
+        fail_pending(row)
+        return "failed"
+    if confirmations(int(receipt["blockNumber"], 16), head) < required:
+        return "pending"
+
+    try:
+        if row.transaction_type == "REGISTRATION":
+            _, status_code = settle_registration(
+                row.user, row.transaction_hash, pending=row
+            )
+            if status_code >= 400:
+                fail_pending(row)
+                return "failed"
+        else:
+            settle_upgrade(row.user, row.level, row.transaction_hash, pending=row)
+    except ValueError as e:
+        # The user reached the level through another transaction
+        logger.warning("Could not settle %s: %s", row.transaction_hash, e)
+        fail_pending(row)
+        return "failed"
+    return "confirmed"
+
+
+def settle_or_skip(row, receipt, head, required, expired_before):
+    """
+    settle_payment(), logging any other error, including one the node
+    answered the receipt read with, and returning "error" so the round
+    moves on to the next row
+
+    The row stays PENDING and is retried next round, until it is older
+    than the pending timeout and marked FAILED.
+    """
+    try:
+        if isinstance(receipt, Exception):
+            raise receipt
+        return settle_payment(row, receipt, head, required, expired_before)
+    except Exception:
+        logger.exception("Could not settle %s", row.transaction_hash)
+    if row.created_at < expired_before:
+        fail_pending(row)
+        return "failed"
+    return "error"
+
+
+def settle_pending_payments(service, batch_size=100, timeout=None):
+    """
+    Check every PENDING payment against the node and settle the mined ones
+
+    Receipts are read `batch_size` rows at a time, each batch in a single
+    JSON-RPC request together with the head block number. A transaction
+    counts as confirmed once CONFIRMATION_BLOCKS blocks include or follow
+    it; one still unmined after `timeout` seconds (PENDING_TRANSACTION_TIMEOUT
+    by default) is marked FAILED. A row failing with an unexpected error is
+    logged and skipped. Returns counts per outcome.
+    """
+    if timeout is None:
+        timeout = getattr(settings, "PENDING_TRANSACTION_TIMEOUT", 3600)
+    expired_before = timezone.now() - timedelta(seconds=timeout)
+    counts = {"confirmed": 0, "failed": 0, "pending": 0, "error": 0}
+
+    last_pk = 0
+    while True:
+        rows = list(pending_payments().filter(pk__gt=last_pk).order_by("pk")[:batch_size])
+        if not rows:
+            break
+        head, receipts = service.transaction_receipts(
+            [row.transaction_hash for row in rows]
+        )
+        for row in rows:
+            outcome = settle_or_skip(
+                row,
+                receipts[row.transaction_hash],
+                head,
+                service.confirmation_blocks,
+                expired_before,
+            )
+            counts[outcome] += 1
+        if len(rows) < batch_size:
+            break
+        last_pk = rows[-1].pk
+    return counts
@@ -0,0 +1,91 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from django.db import connection
+from django.db.models import Q, Sum
+from django.utils import timezone
+from ..models import DailyEarnings, Transaction
+
+
+def rollup_day(created_at):
+    """Day of the DailyEarnings row a transaction is counted in"""
+    return timezone.localdate(created_at)
+
+
+def record_transactions(transactions):
+    """
+    Add freshly written Transaction rows to the DailyEarnings rollup
+
+    Must run inside the atomic block that wrote the rows. Costs one upsert
+    however many rows are passed: missing rollup rows are inserted and
+    existing ones incremented in the same statement.
+    """
+    increments = defaultdict(lambda: [Decimal(0), 0])
+    for tx in transactions:
+        key = (tx.user_id, tx.transaction_type, rollup_day(tx.created_at))
+        increments[key][0] += Decimal(str(tx.amount))
+        increments[key][1] += 1
+    if not increments:
+        return
+
+    fields = [
+        DailyEarnings._meta.get_field(name)
+        for name in ("user", "transaction_type", "day", "total", "count")
+    ]
+    quote = connection.ops.quote_name
+    table = quote(DailyEarnings._meta.db_table)
+    user_col, type_col, day_col, total_col, count_col = (
+        quote(field.column) for field in fields
+    )
+    if connection.vendor == "mysql":
+        upsert = (
+            f"ON DUPLICATE KEY UPDATE {total_col} = {total_col} + VALUES({total_col}), "
+            f"{count_col} = {count_col} + VALUES({count_col})"
+        )
+    else:
+        upsert = (
+            f"ON CONFLICT ({user_col}, {type_col}, {day_col}) DO UPDATE SET "
+            f"{total_col} = {table}.{total_col} + EXCLUDED.{total_col}, "
+            f"{count_col} = {table}.{count_col} + EXCLUDED.{count_col}"
+        )
+
+    params = []
+    for key, (total, count) in increments.items():
+        params.extend(
+            field.get_db_prep_save(value, connection)
+            for field, value in zip(fields, (*key, total, count))
+        )
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s)"] * len(increments))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} "
+            f"({user_col}, {type_col}, {day_col}, {total_col}, {count_col}) "
+            f"VALUES {placeholders} {upsert}",
+            params,
+        )
+
+
+def earnings_totals(profile, since, transaction_type="REWARD"):
+    """
+    Return the all-time total and the total since `since` of a user's
+    transactions of one type
+
+    Whole days are summed from DailyEarnings. The day `since` falls in is
+    only partly inside the period, so that part is summed from the
+    Transaction rows themselves and the period total stays exact.
+    """
+    first_full_day = rollup_day(since) + timedelta(days=1)
+    totals = DailyEarnings.objects.filter(
+        user=profile, transaction_type=transaction_type
+    ).aggregate(
+        all_time=Sum("total"),
+        period=Sum("total", filter=Q(day__gte=first_full_day)),
+    )
+    partial_day = Transaction.objects.filter(
+        user=profile,
+        transaction_type=transaction_type,
+        created_at__gte=since,
+        created_at__lt=timezone.make_aware(datetime.combine(first_full_day, time.min)),
+    ).aggregate(total=Sum("amount"))["total"]
+
+    return totals["all_time"] or 0, (totals["period"] or 0) + (partial_day or 0)
@@ -0,0 +1,35 @@
+from ..models import IdempotencyRecord
+
+
+def normalize_hash(transaction_hash):
+    """Transaction hashes are hex, so retries may differ only in case"""
+    return str(transaction_hash).strip().lower()
+
+
+def stored_result(transaction_hash, operation):
+    """
+    Return (user id, status code, response data) stored for a transaction
+    hash already processed by an operation, or None
+
+    A single read on the (transaction_hash, operation) unique index.
+    """
+    try:
+        return IdempotencyRecord.objects.values_list(
+            "user_id", "status_code", "response"
+        ).get(transaction_hash=normalize_hash(transaction_hash), operation=operation)
+    except IdempotencyRecord.DoesNotExist:
+        return None
+
+
+def store_result(transaction_hash, operation, user, status_code, data):
+    """
+    Remember the response of a processed operation; call inside the atomic
+    block that applied it so the record commits with the ledger rows
+    """
+    IdempotencyRecord.objects.create(
+        transaction_hash=normalize_hash(transaction_hash),
+        operation=operation,
+        user=user,
+        status_code=status_code,
+        response=data,
+    )
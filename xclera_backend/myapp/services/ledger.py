@@ -0,0 +1,221 @@
+import csv
+import json
+import logging
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from django.db import connection
+from django.utils import timezone as django_timezone
+from ..models import Transaction
+from .earnings import record_transactions
+
+logger = logging.getLogger(__name__)
+
+# (column name, Transaction lookup) of the ledger export
+EXPORT_COLUMNS = (
+    ("id", "id"),
+    ("wallet_address", "user__wallet_address"),
+    ("transaction_type", "transaction_type"),
+    ("amount", "amount"),
+    ("level", "level"),
+    ("recipient_wallet_address", "recipient__wallet_address"),
+    ("transaction_hash", "transaction_hash"),
+    ("status", "status"),
+    ("created_at", "created_at"),
+    ("updated_at", "updated_at"),
+)
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def filter_transactions(queryset, filters):
+    """
+    Apply the transaction_type, status, transaction_hash, level and
+    from_date/to_date (YYYY-MM-DD) filters shared by the transaction history
+    endpoints
+    """
+    if filters.get("transaction_type"):
+        queryset = queryset.filter(transaction_type=filters["transaction_type"])
+
+    if filters.get("status"):
+        queryset = queryset.filter(status=filters["status"])
+
+    if filters.get("transaction_hash"):
+        queryset = queryset.filter(transaction_hash=filters["transaction_hash"])
+
+    if filters.get("from_date"):
+        try:
+            from_datetime = datetime.strptime(filters["from_date"], "%Y-%m-%d").replace(
+                tzinfo=timezone.utc
+            )
+            queryset = queryset.filter(created_at__gte=from_datetime)
+        except ValueError:
+            pass  # Invalid date format, ignore filter
+
+    if filters.get("to_date"):
+        try:
+            # End of the given day
+            to_datetime = datetime.strptime(filters["to_date"], "%Y-%m-%d").replace(
+                hour=23, minute=59, second=59, tzinfo=timezone.utc
+            )
+            queryset = queryset.filter(created_at__lte=to_datetime)
+        except ValueError:
+            pass  # Invalid date format, ignore filter
+
+    if filters.get("level"):
+        try:
+            queryset = queryset.filter(level=int(filters["level"]))
+        except ValueError:
+            pass  # Invalid level, ignore filter
+
+    return queryset
+
+
+def write_ledger(transactions):
+    """
+    Persist unsaved Transaction rows with a single INSERT and add them to
+    the daily earnings rollup; call inside the atomic block of the write
+    """
+    Transaction.objects.bulk_create(transactions)
+    record_transactions(transactions)
+    return transactions
+
+
+def record_pending(user, transaction_type, level, amount, transaction_hash):
+    """
+    Return the payment row of a submitted, not yet confirmed transaction,
+    creating it as PENDING on first sight
+
+    It stays out of the daily earnings rollup until confirm_pending().
+    """
+    row, _ = Transaction.objects.get_or_create(
+        transaction_hash=transaction_hash,
+        transaction_type=transaction_type,
+        recipient=None,
+        defaults={
+            "user": user,
+            "level": level,
+            "amount": amount,
+            "status": "PENDING",
+        },
+    )
+    return row
+
+
+def find_pending(transaction_hash, transaction_type):
+    return Transaction.objects.filter(
+        transaction_hash=transaction_hash,
+        transaction_type=transaction_type,
+        status="PENDING",
+    ).first()
+
+
+def confirm_pending(row):
+    """
+    Flip a PENDING payment row to CONFIRMED and add it to the rollup; False
+    when another process settled it first
+    """
+    flipped = Transaction.objects.filter(pk=row.pk, status="PENDING").update(
+        status="CONFIRMED", updated_at=django_timezone.now()
+    )
+    if flipped:
+        row.status = "CONFIRMED"
+        record_transactions([row])
+    return bool(flipped)
+
+
+def fail_pending(row):
+    """Flip a PENDING payment row to FAILED, unless it was settled meanwhile"""
+    return bool(
+        Transaction.objects.filter(pk=row.pk, status="PENDING").update(
+            status="FAILED", updated_at=django_timezone.now()
+        )
+    )
+
+
+def iter_ledger_rows(queryset, chunk_size=2000):
+    """
+    Yield EXPORT_COLUMNS value tuples of a Transaction queryset in id
+    order, never holding more than `chunk_size` rows
+    """
+    queryset = queryset.order_by("pk").values_list(
+        *(lookup for _, lookup in EXPORT_COLUMNS)
+    )
+    if connection.vendor != "mysql":
+        # A server-side cursor on PostgreSQL, chunked fetches on SQLite
+        yield from queryset.iterator(chunk_size=chunk_size)
+        return
+
+    # mysqlclient buffers a whole result set client side, so walk id ranges
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        last_pk = rows[-1][0]
+
+
+def plain_values(row):
+    return [
+        (
+            value.isoformat()
+            if isinstance(value, datetime)
+            else str(value) if isinstance(value, Decimal) else value
+        )
+        for value in row
+    ]
+
+
+class Echo:
+    """File-like object handing each csv.writer line back instead of storing it"""
+
+    def write(self, value):
+        return value
+
+
+def stream_ledger(queryset, output_format="csv", chunk_size=2000, report=None):
+    """
+    Yield a Transaction queryset as CSV or NDJSON text, one chunk of rows
+    at a time, without going through the DRF serializers
+
+    `report(rows, seconds)` is called after every chunk; the final
+    throughput is also logged.
+    """
+    names = [name for name, _ in EXPORT_COLUMNS]
+    if output_format == "csv":
+        writer = csv.writer(Echo())
+        encode = writer.writerow
+        yield writer.writerow(names)
+    else:
+
+        def encode(values):
+            return json.dumps(dict(zip(names, values))) + "\n"
+
+    started = time.perf_counter()
+    exported = 0
+    lines = []
+    for row in iter_ledger_rows(queryset, chunk_size):
+        lines.append(encode(plain_values(row)))
+        if len(lines) < chunk_size:
+            continue
+        exported += len(lines)
+        yield "".join(lines)
+        lines = []
+        if report:
+            report(exported, time.perf_counter() - started)
+
+    if lines:
+        exported += len(lines)
+        yield "".join(lines)
+    elapsed = time.perf_counter() - started
+    if report:
+        report(exported, elapsed)
+    logger.info(
+        "Exported %d transactions in %.2fs (%.0f rows/sec)",
+        exported,
+        elapsed,
+        exported / elapsed if elapsed else 0,
+    )
@@ -0,0 +1,90 @@
+import hashlib
+import threading
+import uuid
+from django.core.cache import cache
+from django.db import transaction
+from ..models import Level
+
+# Moved to a new value whenever the Level rows change. Every worker compares
+# it with the version its catalog was loaded under and reloads on a change.
+# The bump reaches other processes (gunicorn workers, setup_initial_data)
+# through the shared cache configured by CACHE_LOCATION; see settings.
+LEVEL_CATALOG_VERSION_KEY = "levels:catalog_version"
+
+
+class LevelCatalog:
+    """
+    Snapshot of the Level table, ordered by level_number
+
+    The Level instances are shared by every request of the worker and must
+    not be modified.
+    """
+
+    def __init__(self, levels, version):
+        self.version = version
+        self.levels = tuple(levels)
+        self.by_number = {level.level_number: level for level in self.levels}
+        self.by_pk = {level.pk: level for level in self.levels}
+
+        digest = hashlib.sha1()
+        for level in self.levels:
+            digest.update(
+                repr(
+                    (
+                        level.pk,
+                        level.level_number,
+                        str(level.price),
+                        level.min_direct_referrals,
+                        level.min_referral_depth,
+                        str(level.rank_fee),
+                    )
+                ).encode()
+            )
+        # Derived from the rows only, so every worker serves the same ETag
+        self.etag = f'"{digest.hexdigest()}"'
+
+    def get(self, level_number):
+        """Return a Level by number, raising Level.DoesNotExist like the ORM"""
+        try:
+            return self.by_number[level_number]
+        except KeyError:
+            raise Level.DoesNotExist(f"Level {level_number} does not exist")
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_level_catalog():
+    """
+    Return the process-wide level catalog
+
+    Costs one cache read to check the version; the Level table itself is
+    only queried when the catalog is first used or the version moved.
+    """
+    global _catalog
+    version = cache.get(LEVEL_CATALOG_VERSION_KEY)
+    catalog = _catalog
+    if catalog is None or catalog.version != version:
+        with _catalog_lock:
+            if _catalog is None or _catalog.version != version:
+                _catalog = LevelCatalog(
+                    Level.objects.order_by("level_number"), version
+                )
+            catalog = _catalog
+    return catalog
+
+
+def bump_level_catalog_version():
+    cache.set(LEVEL_CATALOG_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def level_changed(**kwargs):
+    """
+    post_save/post_delete receiver for Level
+
+    Bumps the version right away so this process sees its own change, and
+    again on commit so no worker keeps rows it reloaded before the commit.
+    """
+    bump_level_catalog_version()
+    transaction.on_commit(bump_level_catalog_version)
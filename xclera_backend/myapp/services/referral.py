@@ -1,21 +1,124 @@
-from django.db import transaction
+import uuid
+from django.db import IntegrityError, transaction
 from django.db.models import F
-from ..models import UserProfile, ReferralRelationship, Level, Transaction
+from ..models import (
+    UserProfile,
+    Level,
+    Transaction,
+)
+from . import referral_graph
+from .referral_storage import get_referral_storage
+from .ledger import confirm_pending, write_ledger
+from .level_catalog import get_level_catalog
 from django.conf import settings
+from django.core.cache import cache
 
 
-def get_company_wallet_profile():
-    # Get company wallet profile
+# Cached in place of an upline id when the chain is shorter than the level
+NO_UPLINE = 0
+# Seconds a memoized ancestor id, or the absence of one, is kept. A missing
+# upline may only mean a chain not rebuilt yet, so it expires much sooner.
+ANCESTOR_CACHE_TIMEOUT = 24 * 60 * 60
+NO_UPLINE_CACHE_TIMEOUT = 5 * 60
+
+# Moved whenever stored upline chains are rewritten (rebuild, import, a new
+# root), dropping every memoized ancestor at once
+REFERRAL_CHAIN_VERSION_KEY = "referral:chain_version"
+
+
+def ancestor_cache_key(profile_id, level, version):
+    return (
+        f"referral:ancestor:{settings.REFERRAL_STORAGE}:{version}:{profile_id}:{level}"
+    )
+
+
+def invalidate_referral_chains():
+    """Forget the ancestor ids memoized by find_eligible_upline in every process"""
+    cache.set(REFERRAL_CHAIN_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+# Moved whenever the company wallet or root profile may have been recreated
+COMPANY_WALLET_VERSION_KEY = "referral:company_wallet_version"
+
+# (version, profile id, display name) of the profile receiving company fees
+_company_wallet = None
+
+
+def display_name(profile):
+    return profile.username or profile.wallet_address[:10] + "..."
+
+
+def resolve_company_wallet():
+    """
+    Return (profile id, display name) of the profile receiving company fees
+
+    That is the company wallet profile, or the root user if it doesn't
+    exist. A found company wallet profile is resolved with one query per
+    process and kept until create_root_user moves the version key, or a
+    ledger write finds it deleted (see write_company_ledger). The root
+    fallback is looked up on every call, so fees move to the company
+    wallet as soon as its profile is created.
+    """
+    global _company_wallet
+    version = cache.get(COMPANY_WALLET_VERSION_KEY)
+    company_wallet = _company_wallet
+    if company_wallet is None or company_wallet[0] != version:
+        profiles = {
+            profile.wallet_address: profile
+            for profile in UserProfile.objects.filter(
+                wallet_address__in={
+                    settings.COMPANY_WALLET_ADDRESS,
+                    settings.ROOT_USER_ADDRESS,
+                }
+            ).only("pk", "wallet_address", "username")
+        }
+        profile = profiles.get(settings.COMPANY_WALLET_ADDRESS)
+        if profile is None:
+            # Fallback to root user if company wallet profile doesn't exist
+            profile = profiles.get(settings.ROOT_USER_ADDRESS)
+            if profile is None:
+                raise UserProfile.DoesNotExist(
+                    "Neither the company wallet nor the root user exists"
+                )
+            return profile.pk, display_name(profile)
+        company_wallet = _company_wallet = (version, profile.pk, display_name(profile))
+    return company_wallet[1], company_wallet[2]
+
+
+def invalidate_company_wallet():
+    """Make every process resolve the company wallet profile again"""
+    cache.set(COMPANY_WALLET_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def forget_company_wallet():
+    """Make this process resolve the company wallet profile again"""
+    global _company_wallet
+    _company_wallet = None
+
+
+def write_company_ledger(ledger):
+    """
+    write_ledger() for rows crediting the company wallet profile
+
+    The profile kept by resolve_company_wallet() may have been deleted by
+    another process since. The insert then fails on its foreign key, so the
+    profile is resolved again and the write retried once with its new id.
+    """
+    company_wallet = _company_wallet
     try:
-        company_wallet_profile = UserProfile.objects.get(
-            wallet_address=settings.COMPANY_WALLET_ADDRESS
-        )
-    except UserProfile.DoesNotExist:
-        # Fallback to root user if company wallet profile doesn't exist
-        company_wallet_profile = UserProfile.objects.get(
-            wallet_address=settings.ROOT_USER_ADDRESS
-        )
-    return company_wallet_profile
+        with transaction.atomic():
+            return write_ledger(ledger)
+    except IntegrityError:
+        if company_wallet is None:
+            raise
+        forget_company_wallet()
+        company_wallet_id, _ = resolve_company_wallet()
+        if company_wallet_id == company_wallet[1]:
+            raise
+        for row in ledger:
+            if row.user_id == company_wallet[1]:
+                row.user_id = company_wallet_id
+        return write_ledger(ledger)
 
 
 class ReferralService:
@@ -50,30 +153,15 @@ class ReferralService:
             phone_number=profile_data.get("phone_number"),
             email=profile_data.get("email"),
         )
+        referral_graph.track_new_profile(profile)
 
         # Update referrer's direct referral count
         if referrer_profile:
             referrer_profile.direct_referrals_count = F("direct_referrals_count") + 1
             referrer_profile.save(update_fields=["direct_referrals_count"])
 
-            # Create direct referral relationship
-            ReferralRelationship.objects.create(
-                user=profile, upline=referrer_profile, level=1
-            )
-
             # Build referral tree by adding all uplines at their respective levels
-            current_upline = referrer_profile
-            level = 2
-
-            while current_upline and current_upline.referrer:
-                # Create relationship to this upline
-                ReferralRelationship.objects.create(
-                    user=profile, upline=current_upline.referrer, level=level
-                )
-
-                # Move up the tree
-                current_upline = current_upline.referrer
-                level += 1
+            ReferralService.create_referral_relationships(profile, referrer_profile)
 
             # Update max_referral_depth for each upline
             ReferralService.update_referral_depths(profile)
@@ -81,21 +169,23 @@ class ReferralService:
         return profile
 
     @staticmethod
-    def update_referral_depths(profile):
+    def create_referral_relationships(profile, referrer_profile):
         """
-        Update max_referral_depth for all uplines of a user
+        Link a new profile to all of its uplines in the configured storage
+        and count the new member in each upline's team size and level rollup
         """
-        # Get all uplines in reverse order (deepest first)
-        uplines = ReferralRelationship.objects.filter(user=profile).order_by("-level")
+        storage = get_referral_storage()
+        storage.link(profile, referrer_profile)
+        storage.update_team_sizes(profile)
+        storage.update_downline_level_counts(profile)
 
-        for relationship in uplines:
-            upline = relationship.upline
-            level = relationship.level
-
-            # Only update if this depth is greater than current max
-            if level > upline.max_referral_depth:
-                upline.max_referral_depth = level
-                upline.save(update_fields=["max_referral_depth"])
+    @staticmethod
+    def update_referral_depths(profile):
+        """
+        Raise max_referral_depth of every upline that is shallower than its
+        distance to this user
+        """
+        get_referral_storage().update_referral_depths(profile)
 
     @staticmethod
     def check_level_upgrade_eligibility(profile, target_level):
@@ -103,7 +193,7 @@ class ReferralService:
         Check if a user is eligible to upgrade to the target level
         """
         try:
-            level_requirements = Level.objects.get(level_number=target_level)
+            level_requirements = get_level_catalog().get(target_level)
         except Level.DoesNotExist:
             return False, "Level does not exist"
 
@@ -150,34 +240,64 @@ class ReferralService:
     def find_eligible_upline(profile, target_level):
         """
         Find the eligible upline for a level upgrade reward
+
+        The upline at depth target_level - 1 only changes when the stored
+        chains are rewritten, so its id is memoized per storage and chain
+        version (see invalidate_referral_chains), or read from the referral
+        graph, which is only synced for a profile it has not loaded yet. Its
+        current_level is read with the upline row on every call, so a level
+        change made by any process routes the reward at once. A cold lookup
+        is a single joined query.
         """
         # For level 1, this shouldn't be called
         if target_level == 1:
             return None
 
-        # Try to find eligible uplines at the appropriate level
-        relationships = ReferralRelationship.objects.filter(
-            user=profile,
-            level=target_level - 1,  # Level depth matches the target level
-        )
-        
-        # Check each potential upline for eligibility
-        for relationship in relationships:
-            upline = relationship.upline
-            if upline.current_level >= target_level:
-                return upline
+        if settings.REFERRAL_GRAPH_ENABLED:
+            graph = referral_graph.get_referral_graph()
+            graph.sync_missing(profile.pk)
+            upline_id = graph.ancestor_at(profile.pk, target_level - 1) or NO_UPLINE
+        else:
+            ancestor_key = ancestor_cache_key(
+                profile.pk, target_level - 1, cache.get(REFERRAL_CHAIN_VERSION_KEY)
+            )
+            upline_id = cache.get(ancestor_key)
+
+        if upline_id == NO_UPLINE:
+            return None
+
+        if upline_id is not None:
+            upline = UserProfile.objects.filter(pk=upline_id).first()
+        else:
+            upline = get_referral_storage().upline_at(profile, target_level - 1)
+            if upline is None:
+                cache.set(ancestor_key, NO_UPLINE, NO_UPLINE_CACHE_TIMEOUT)
+            else:
+                cache.set(ancestor_key, upline.pk, ANCESTOR_CACHE_TIMEOUT)
 
         # If no eligible upline found, return None (company wallet will be used)
-        return None
+        if upline is None:
+            return None
+        return upline if upline.current_level >= target_level else None
+
+    @staticmethod
+    def record_level_change(profile):
+        """
+        Propagate a committed current_level change to the in-process graph
+        """
+        referral_graph.track_level_change(profile)
 
     @staticmethod
     @transaction.atomic
-    def upgrade_user_level(profile, target_level, transaction_hash=None):
+    def upgrade_user_level(profile, target_level, transaction_hash=None, pending=None):
         """
         Upgrade a user to a new level and record the transaction
+
+        `pending` is the PENDING payment row recorded when the transaction
+        was submitted; it is confirmed instead of writing a new one.
         """
         # Get level info
-        level_info = Level.objects.get(level_number=target_level)
+        level_info = get_level_catalog().get(target_level)
 
         # Find eligible upline
         eligible_upline = ReferralService.find_eligible_upline(profile, target_level)
@@ -187,67 +307,65 @@ class ReferralService:
         company_fee = (level_info.price * company_fee_percentage) / 100
         upline_reward = level_info.price - company_fee
 
-        # Record upgrade transaction
-        upgrade_tx = Transaction.objects.create(
-            user=profile,
-            transaction_type="UPGRADE",
-            amount=level_info.price,
-            level=target_level,
-            # No recipient for upgrade transactions
-            transaction_hash=transaction_hash,
-            status="CONFIRMED" if transaction_hash else "PENDING",
-        )
-
-        company_wallet_profile = get_company_wallet_profile()
-        # Record company fee transaction (20%)
-        company_tx = Transaction.objects.create(
-            user=company_wallet_profile,  # User receiving the fee
-            transaction_type="REWARD",
-            amount=company_fee,
-            level=target_level,
-            recipient=profile,  # User who paid the fee
-            transaction_hash=transaction_hash,
-            status="CONFIRMED" if transaction_hash else "PENDING",
-        )
+        # Raise the level first; the condition stops a concurrent request
+        # from recording the same upgrade twice
+        upgraded = UserProfile.objects.filter(
+            pk=profile.pk, current_level__lt=target_level
+        ).update(current_level=target_level)
+        if not upgraded:
+            raise ValueError(f"User is already at level {target_level} or above")
+        profile.current_level = target_level
+        ReferralService.record_level_change(profile)
 
-        # Record reward transaction for the remaining 80%
+        company_wallet_id, company_wallet_name = resolve_company_wallet()
+        # If there's no eligible upline, company wallet gets the reward
         if eligible_upline:
-            # If there's an eligible upline, they get the reward
-            reward_tx = Transaction.objects.create(
-                user=eligible_upline,  # User receiving the reward
+            rewarded_user_id, rewarded_name = eligible_upline.pk, display_name(eligible_upline)
+        else:
+            rewarded_user_id, rewarded_name = company_wallet_id, company_wallet_name
+        status = "CONFIRMED" if transaction_hash else "PENDING"
+
+        ledger = [
+            # Company fee (20%), recipient is the user who paid the fee
+            Transaction(
+                user_id=company_wallet_id,
                 transaction_type="REWARD",
-                amount=upline_reward,
+                amount=company_fee,
                 level=target_level,
-                recipient=profile,  # User who triggered the reward
+                recipient=profile,
                 transaction_hash=transaction_hash,
-                status="CONFIRMED" if transaction_hash else "PENDING",
-            )
-            rewarded_user = eligible_upline
-        else:
-            # If no eligible upline, company wallet gets the reward
-            reward_tx = Transaction.objects.create(
-                user=company_wallet_profile,
+                status=status,
+            ),
+            # Reward for the remaining 80%
+            Transaction(
+                user_id=rewarded_user_id,
                 transaction_type="REWARD",
                 amount=upline_reward,
                 level=target_level,
                 recipient=profile,
                 transaction_hash=transaction_hash,
-                status="CONFIRMED" if transaction_hash else "PENDING",
+                status=status,
+            ),
+        ]
+        if pending is None or not confirm_pending(pending):
+            # Upgrade payment, no recipient for upgrade transactions
+            ledger.insert(
+                0,
+                Transaction(
+                    user=profile,
+                    transaction_type="UPGRADE",
+                    amount=level_info.price,
+                    level=target_level,
+                    transaction_hash=transaction_hash,
+                    status=status,
+                ),
             )
-            rewarded_user = company_wallet_profile
-
-        # Update user level
-        profile.current_level = target_level
-        profile.save(update_fields=["current_level"])
+        write_company_ledger(ledger)
 
         return {
             "success": True,
             "new_level": target_level,
-            "upline_rewarded": (
-                rewarded_user.username
-                if rewarded_user and rewarded_user.username
-                else rewarded_user.wallet_address[:10] + "..." if rewarded_user else None
-            ),
+            "upline_rewarded": rewarded_name,
             "upline_reward": upline_reward,
             "company_fee": company_fee,
         }
@@ -0,0 +1,317 @@
+import threading
+from array import array
+
+from django.db import transaction
+
+from ..models import UserProfile
+from .referral_storage import get_referral_storage
+
+# Profile ids start at 1, so 0 marks "no parent" / "no child"
+NO_NODE = 0
+
+
+class ReferralGraph:
+    """
+    Process-local copy of the referral tree kept in flat typed arrays
+
+    Every buffer is indexed directly by UserProfile.id. Parent pointers,
+    depth, current_level and subtree sizes live in compact `array` buffers
+    and children are threaded through first_child/next_sibling links, so
+    ancestor walks and subtree counts never touch the database.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self.parent = array("I")
+        self.depth = array("I")
+        self.level = array("B")
+        self.subtree_size = array("I")
+        self.first_child = array("I")
+        self.next_sibling = array("I")
+        self.present = bytearray()
+        self.max_id = 0
+        self.node_count = 0
+
+    def __contains__(self, profile_id):
+        return 0 < profile_id < len(self.present) and bool(self.present[profile_id])
+
+    def _ensure_capacity(self, profile_id):
+        size = len(self.present)
+        if profile_id < size:
+            return
+        grow = max(profile_id + 1, size * 2) - size
+        for buffer in (
+            self.parent,
+            self.depth,
+            self.subtree_size,
+            self.first_child,
+            self.next_sibling,
+        ):
+            buffer.frombytes(bytes(grow * buffer.itemsize))
+        self.level.frombytes(bytes(grow))
+        self.present.extend(bytes(grow))
+
+    def _set_node(self, profile_id, parent_id, level):
+        # The root user points at itself; treat that like a missing referrer
+        if parent_id is None or parent_id == profile_id:
+            parent_id = NO_NODE
+
+        self._ensure_capacity(profile_id)
+        self.parent[profile_id] = parent_id
+        self.level[profile_id] = level
+        self.present[profile_id] = 1
+        self.max_id = max(self.max_id, profile_id)
+        self.node_count += 1
+
+    def _link_child(self, profile_id):
+        parent_id = self.parent[profile_id]
+        if parent_id == NO_NODE:
+            return
+        self.next_sibling[profile_id] = self.first_child[parent_id]
+        self.first_child[parent_id] = profile_id
+
+    def load(self, chunk_size=10000):
+        """
+        Build the graph from UserProfile.referrer pointers in one streaming pass
+        """
+        with self._lock:
+            self._reset()
+
+            rows = (
+                UserProfile.objects.order_by("pk")
+                .values_list("pk", "referrer_id", "current_level")
+                .iterator(chunk_size=chunk_size)
+            )
+            for profile_id, referrer_id, current_level in rows:
+                self._set_node(profile_id, referrer_id, current_level)
+
+            for profile_id in self.node_ids():
+                if self.parent[profile_id] not in self:
+                    self.parent[profile_id] = NO_NODE
+                self._link_child(profile_id)
+
+            order = self.breadth_first_order()
+            for profile_id in order:
+                parent_id = self.parent[profile_id]
+                if parent_id != NO_NODE:
+                    self.depth[profile_id] = self.depth[parent_id] + 1
+
+            for profile_id in reversed(order):
+                parent_id = self.parent[profile_id]
+                if parent_id != NO_NODE:
+                    self.subtree_size[parent_id] += self.subtree_size[profile_id] + 1
+
+        return self
+
+    def breadth_first_order(self):
+        """
+        All node ids breadth-first from the roots, so every parent comes
+        before its children; iterate it reversed for bottom-up passes
+        """
+        order = array(
+            "I", (pid for pid in self.node_ids() if self.parent[pid] == NO_NODE)
+        )
+        position = 0
+        while position < len(order):
+            child_id = self.first_child[order[position]]
+            while child_id != NO_NODE:
+                order.append(child_id)
+                child_id = self.next_sibling[child_id]
+            position += 1
+        return order
+
+    def add(self, profile_id, parent_id, level):
+        """Insert a newly created profile and bump the subtree size of its uplines"""
+        with self._lock:
+            if parent_id not in (None, profile_id) and parent_id not in self:
+                # The referrer was created by another process since we loaded
+                self.sync()
+            self._insert(profile_id, parent_id, level)
+
+    def _insert(self, profile_id, parent_id, level):
+        if profile_id in self:
+            return
+        self._set_node(profile_id, parent_id, level)
+        parent_id = self.parent[profile_id]
+        if parent_id not in self:
+            self.parent[profile_id] = NO_NODE
+            return
+
+        self._link_child(profile_id)
+        self.depth[profile_id] = self.depth[parent_id] + 1
+        while parent_id != NO_NODE:
+            self.subtree_size[parent_id] += 1
+            parent_id = self.parent[parent_id]
+
+    def set_level(self, profile_id, level):
+        if profile_id in self:
+            self.level[profile_id] = level
+
+    def sync(self):
+        """
+        Pick up profiles created since the last load, e.g. by other workers
+
+        Only ids above the high-water mark are fetched; a full load() is still
+        needed to repair anything committed out of id order.
+        """
+        with self._lock:
+            rows = (
+                UserProfile.objects.filter(pk__gt=self.max_id)
+                .order_by("pk")
+                .values_list("pk", "referrer_id", "current_level")
+            )
+            for profile_id, referrer_id, current_level in rows:
+                self._insert(profile_id, referrer_id, current_level)
+
+    def sync_missing(self, profile_id):
+        """
+        sync() only when the profile is not in the graph yet
+
+        A loaded profile's referrer, and so its whole upline chain, never
+        changes, so lookups for it need no trip to the database.
+        """
+        if profile_id not in self:
+            self.sync()
+
+    def node_ids(self):
+        return (pid for pid in range(1, len(self.present)) if self.present[pid])
+
+    def ancestors(self, profile_id):
+        """Upline ids ordered from the direct referrer (level 1) upwards"""
+        result = []
+        if profile_id not in self:
+            return result
+        parent_id = self.parent[profile_id]
+        while parent_id != NO_NODE:
+            result.append(parent_id)
+            parent_id = self.parent[parent_id]
+        return result
+
+    def ancestor_at(self, profile_id, level):
+        """Upline id at the given referral level, or None if the chain is shorter"""
+        if profile_id not in self or level < 1:
+            return None
+        for _ in range(level):
+            profile_id = self.parent[profile_id]
+            if profile_id == NO_NODE:
+                return None
+        return profile_id
+
+    def is_ancestor(self, upline_id, profile_id):
+        if upline_id not in self or profile_id not in self:
+            return False
+        if self.depth[upline_id] >= self.depth[profile_id]:
+            return False
+        return self.ancestor_at(
+            profile_id, self.depth[profile_id] - self.depth[upline_id]
+        ) == upline_id
+
+    def children(self, profile_id):
+        if profile_id not in self:
+            return
+        child_id = self.first_child[profile_id]
+        while child_id != NO_NODE:
+            yield child_id
+            child_id = self.next_sibling[child_id]
+
+    def descendants(self, profile_id, max_depth=None):
+        """Yield (descendant id, relative level) pairs, depth first"""
+        if profile_id not in self:
+            return
+        stack = [(child_id, 1) for child_id in self.children(profile_id)]
+        while stack:
+            child_id, level = stack.pop()
+            yield child_id, level
+            if max_depth is None or level < max_depth:
+                stack.extend(
+                    (grandchild_id, level + 1)
+                    for grandchild_id in self.children(child_id)
+                )
+
+    def descendant_levels(self, profile_id, max_depth=None):
+        """Yield (relative level, descendant ids) per level, breadth first"""
+        if profile_id not in self:
+            return
+        frontier = list(self.children(profile_id))
+        level = 1
+        while frontier and (max_depth is None or level <= max_depth):
+            yield level, frontier
+            frontier = [
+                grandchild_id
+                for child_id in frontier
+                for grandchild_id in self.children(child_id)
+            ]
+            level += 1
+
+    def team_size(self, profile_id):
+        return self.subtree_size[profile_id] if profile_id in self else 0
+
+    def check_consistency(self, chunk_size=10000):
+        """
+        Compare the graph against the stored upline chains (closure rows or
+        packed ancestry, whichever REFERRAL_STORAGE selects)
+
+        Returns the ids of profiles whose stored uplines do not match the
+        chain derived from referrer pointers.
+        """
+        storage = get_referral_storage()
+        if not storage.stores_chains:
+            # Chains are read straight from referrer pointers, nothing to drift
+            return []
+
+        mismatched = []
+        seen = bytearray(len(self.present))
+
+        for user_id, uplines in storage.iter_chains(chunk_size):
+            if user_id in self:
+                seen[user_id] = 1
+            if uplines != self.ancestors(user_id):
+                mismatched.append(user_id)
+
+        # Profiles with a referrer chain but no stored uplines at all
+        for profile_id in self.node_ids():
+            if not seen[profile_id] and self.parent[profile_id] != NO_NODE:
+                mismatched.append(profile_id)
+
+        return sorted(mismatched)
+
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+def get_referral_graph():
+    """Return the process-wide graph, loading it on first use"""
+    global _graph
+    if _graph is None:
+        with _graph_lock:
+            if _graph is None:
+                _graph = ReferralGraph().load()
+    return _graph
+
+
+def reset_referral_graph():
+    global _graph
+    with _graph_lock:
+        _graph = None
+
+
+def track_new_profile(profile):
+    """Add a profile to the loaded graph once the surrounding transaction commits"""
+    graph = _graph
+    if graph is not None:
+        transaction.on_commit(
+            lambda: graph.add(profile.pk, profile.referrer_id, profile.current_level)
+        )
+
+
+def track_level_change(profile):
+    """Mirror a current_level change into the loaded graph after commit"""
+    graph = _graph
+    if graph is not None:
+        transaction.on_commit(
+            lambda: graph.set_level(profile.pk, profile.current_level)
+        )
@@ -0,0 +1,799 @@
+import heapq
+import sys
+from array import array
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models import F, OuterRef, Q, Subquery
+from django.db.models.constants import OnConflict
+from django.utils import timezone
+
+from ..models import (
+    UserProfile,
+    ReferralRelationship,
+    ReferralAncestry,
+    DownlineLevelCount,
+)
+
+# Uplines updated per statement when a chain is expanded into CASE expressions
+CASE_CHUNK_SIZE = 1000
+# Deepest referral chain the recursive CTE storage will walk
+MAX_TREE_DEPTH = 100000
+
+
+def quoted_columns(model, *field_names):
+    """Quoted table name followed by the quoted columns of the given fields"""
+    quote = connection.ops.quote_name
+    return [quote(model._meta.db_table)] + [
+        quote(model._meta.get_field(name).column) for name in field_names
+    ]
+
+
+def is_root(profile):
+    """Roots refer to themselves (or nobody) and have no upline chain"""
+    return profile.referrer_id in (None, profile.pk)
+
+
+class MissingChainError(ImproperlyConfigured):
+    """
+    A non-root referrer has no chain in the selected storage, typically
+    because REFERRAL_STORAGE was switched on an existing database
+    """
+
+    def __init__(self, storage, referrer_profile):
+        super().__init__(
+            f"Referrer {referrer_profile.pk} has no upline chain in the "
+            f"{storage.name!r} referral storage. After switching REFERRAL_STORAGE, "
+            f"run 'python manage.py rebuild_referral_closure --fix' before accepting signups."
+        )
+
+
+def pack_ids(ids):
+    """Pack profile ids into little-endian uint32 bytes"""
+    packed = array("I", ids)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_ids(data):
+    ids = array("I")
+    ids.frombytes(bytes(data))
+    if sys.byteorder == "big":
+        ids.byteswap()
+    return ids
+
+
+class ClosureStorage:
+    """
+    One ReferralRelationship row per (user, upline) pair
+
+    Every upline and downline question is a single indexed lookup, at the
+    cost of a table that grows with users x depth.
+    """
+
+    name = "closure"
+    # Downline listings can be paginated straight from the table
+    indexes_downlines = True
+    stores_chains = True
+    requires_vendor = None
+
+    def link(self, profile, referrer_profile):
+        """
+        Create the closure rows linking a new profile to all of its uplines
+
+        The referrer's own upline rows are copied one level deeper and the
+        direct (level 1) row is added in a single INSERT ... SELECT, so the
+        cost of a signup does not grow with the depth of the tree. Raises
+        MissingChainError, rolling the signup back, when a non-root
+        referrer has no rows to copy.
+        """
+        table, user_col, upline_col, level_col, created_col = quoted_columns(
+            ReferralRelationship, "user", "upline", "level", "date_created"
+        )
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} ({user_col}, {upline_col}, {level_col}, {created_col}) "
+                f"SELECT %s, %s, 1, %s "
+                f"UNION ALL "
+                f"SELECT %s, {upline_col}, {level_col} + 1, %s FROM {table} "
+                f"WHERE {user_col} = %s AND {upline_col} <> %s",
+                [
+                    profile.pk,
+                    referrer_profile.pk,
+                    now,
+                    profile.pk,
+                    now,
+                    referrer_profile.pk,
+                    profile.pk,
+                ],
+            )
+            if cursor.rowcount == 1 and not is_root(referrer_profile):
+                raise MissingChainError(self, referrer_profile)
+
+    def bulk_link(self, chains, batch_size=5000):
+        """
+        Store (user_id, upline ids from level 1 upwards) pairs in bulk
+
+        Used by the import and rebuild commands, where deep trees produce far
+        more closure rows than profiles: plain tuples go straight to the
+        driver instead of being built into model instances first.
+        """
+        table, *columns = quoted_columns(
+            ReferralRelationship, "user", "upline", "level", "date_created"
+        )
+        sql = "INSERT INTO {} ({}) VALUES ({})".format(
+            table, ", ".join(columns), ", ".join(["%s"] * len(columns))
+        )
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        rows = [
+            (user_id, upline_id, level, now)
+            for user_id, upline_ids in chains
+            for level, upline_id in enumerate(upline_ids, start=1)
+        ]
+        with connection.cursor() as cursor:
+            for i in range(0, len(rows), batch_size):
+                cursor.executemany(sql, rows[i : i + batch_size])
+
+    def unlink(self, user_ids):
+        ReferralRelationship.objects.filter(user_id__in=user_ids).delete()
+
+    def iter_chains(self, chunk_size=10000):
+        """Yield (user_id, upline ids from level 1 upwards) for every linked user"""
+        rows = (
+            ReferralRelationship.objects.order_by("user_id", "level")
+            .values_list("user_id", "upline_id")
+            .iterator(chunk_size=chunk_size)
+        )
+        current_user, uplines = None, []
+        for user_id, upline_id in rows:
+            if user_id != current_user:
+                if current_user is not None:
+                    yield current_user, uplines
+                current_user, uplines = user_id, []
+            uplines.append(upline_id)
+        if current_user is not None:
+            yield current_user, uplines
+
+    def ancestor_ids(self, profile_id):
+        """Upline ids ordered from the direct referrer (level 1) upwards"""
+        return list(
+            ReferralRelationship.objects.filter(user_id=profile_id)
+            .order_by("level")
+            .values_list("upline_id", flat=True)
+        )
+
+    def ancestor_at(self, profile_id, level):
+        """Upline id at the given level, or None if the chain is shorter"""
+        return (
+            ReferralRelationship.objects.filter(user_id=profile_id, level=level)
+            .values_list("upline_id", flat=True)
+            .first()
+        )
+
+    def is_ancestor(self, upline_id, profile_id):
+        return ReferralRelationship.objects.filter(
+            user_id=profile_id, upline_id=upline_id
+        ).exists()
+
+    def upline_at(self, profile, level):
+        """Upline profile at the given level, fetched in one joined query"""
+        relationship = (
+            ReferralRelationship.objects.filter(user=profile, level=level)
+            .select_related("upline")
+            .first()
+        )
+        return relationship.upline if relationship else None
+
+    def uplines(self, profile):
+        return (
+            ReferralRelationship.objects.filter(user=profile)
+            .select_related("user", "upline")
+            .order_by("level")
+        )
+
+    def downline_keys(self, profile, max_depth=None, after=None, limit=None):
+        """
+        Sorted (level, user_id) keys of the downlines following the `after`
+        key, at most `limit` of them
+        """
+        relationships = ReferralRelationship.objects.filter(upline=profile)
+        if max_depth is not None:
+            relationships = relationships.filter(level__lte=max_depth)
+        if after is not None:
+            level, user_id = after
+            relationships = relationships.filter(
+                Q(level__gt=level) | Q(level=level, user_id__gt=user_id),
+                level__gte=level,
+            )
+        keys = relationships.order_by("level", "user_id").values_list("level", "user_id")
+        return list(keys if limit is None else keys[:limit])
+
+    def update_team_sizes(self, profile):
+        """Count a new profile in the team size of every upline"""
+        UserProfile.objects.filter(
+            pk__in=ReferralRelationship.objects.filter(user=profile).values("upline_id")
+        ).update(team_size=F("team_size") + 1)
+
+    def update_downline_level_counts(self, profile):
+        """
+        Count a new profile in the per-level downline rollup of every upline
+        """
+        relationships = ReferralRelationship.objects.filter(user=profile)
+
+        # Uplines reaching a level for the first time get a zero row to
+        # increment; existing rows are left alone by the conflict clause
+        table, upline_col, level_col, count_col = quoted_columns(
+            DownlineLevelCount, "upline", "level", "count"
+        )
+        rr_table, rr_user_col, rr_upline_col, rr_level_col = quoted_columns(
+            ReferralRelationship, "user", "upline", "level"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"{connection.ops.insert_statement(on_conflict=OnConflict.IGNORE)} "
+                f"{table} ({upline_col}, {level_col}, {count_col}) "
+                f"SELECT {rr_upline_col}, {rr_level_col}, 0 FROM {rr_table} "
+                f"WHERE {rr_user_col} = %s "
+                + connection.ops.on_conflict_suffix_sql(
+                    [], OnConflict.IGNORE, None, None
+                ),
+                [profile.pk],
+            )
+
+        DownlineLevelCount.objects.filter(
+            upline_id__in=relationships.values("upline_id"),
+            level=Subquery(
+                relationships.filter(upline=OuterRef("upline_id")).values("level")[:1]
+            ),
+        ).update(count=F("count") + 1)
+
+    def update_referral_depths(self, profile):
+        """
+        Update max_referral_depth for all uplines of a user
+
+        Runs as a single UPDATE: every upline whose stored depth is below the
+        level of its relationship to this user is raised to that level.
+        """
+        relationship_level = Subquery(
+            ReferralRelationship.objects.filter(
+                user=profile, upline=OuterRef("pk")
+            ).values("level")[:1]
+        )
+
+        UserProfile.objects.filter(
+            pk__in=ReferralRelationship.objects.filter(user=profile).values(
+                "upline_id"
+            ),
+            max_referral_depth__lt=relationship_level,
+        ).update(max_referral_depth=relationship_level)
+
+
+class UplineListStorage:
+    """
+    Shared logic for storages that answer upline questions with a Python
+    list of upline ids (level 1 first) instead of per-pair rows
+
+    Subclasses provide ancestor_ids() and downline_keys(); counters and the
+    serialized relationship rows are derived from those.
+    """
+
+    indexes_downlines = False
+    stores_chains = True
+    requires_vendor = None
+
+    def ancestor_at(self, profile_id, level):
+        ancestors = self.ancestor_ids(profile_id)
+        return ancestors[level - 1] if 0 < level <= len(ancestors) else None
+
+    def is_ancestor(self, upline_id, profile_id):
+        return upline_id in self.ancestor_ids(profile_id)
+
+    def upline_at(self, profile, level):
+        upline_id = self.ancestor_at(profile.pk, level)
+        if upline_id is None:
+            return None
+        return UserProfile.objects.filter(pk=upline_id).first()
+
+    def uplines(self, profile):
+        """Unsaved ReferralRelationship rows built from the upline list"""
+        ancestors = self.ancestor_ids(profile.pk)
+        profiles = UserProfile.objects.in_bulk(ancestors)
+        return [
+            ReferralRelationship(
+                user=profile,
+                upline=profiles[upline_id],
+                level=level,
+                date_created=profile.date_registered,
+            )
+            for level, upline_id in enumerate(ancestors, start=1)
+            if upline_id in profiles
+        ]
+
+    def downline_rows(self, profile, keys):
+        """Unsaved ReferralRelationship rows for a page of downline keys"""
+        profiles = UserProfile.objects.in_bulk([user_id for _, user_id in keys])
+        return [
+            ReferralRelationship(
+                user=profiles[user_id],
+                upline=profile,
+                level=level,
+                date_created=profiles[user_id].date_registered,
+            )
+            for level, user_id in keys
+            if user_id in profiles
+        ]
+
+    def _level_chunks(self, profile):
+        """
+        Split the profile's chain into (level -> upline id pairs, SQL CASE
+        mapping each upline to its level) chunks for one statement each
+
+        Ids and levels are integers we produced, so they are inlined instead
+        of being bound; that keeps deep chains clear of bound-parameter limits
+        and avoids building thousands of ORM expressions per signup.
+        """
+        ancestors = self.ancestor_ids(profile.pk)
+        for start in range(0, len(ancestors), CASE_CHUNK_SIZE):
+            pairs = list(
+                enumerate(ancestors[start : start + CASE_CHUNK_SIZE], start=start + 1)
+            )
+            whens = " ".join(
+                "WHEN %d THEN %d" % (upline_id, level) for level, upline_id in pairs
+            )
+            yield pairs, f"CASE {{}} {whens} END"
+
+    def update_team_sizes(self, profile):
+        UserProfile.objects.filter(pk__in=self.ancestor_ids(profile.pk)).update(
+            team_size=F("team_size") + 1
+        )
+
+    def update_downline_level_counts(self, profile):
+        table, upline_col, level_col, count_col = quoted_columns(
+            DownlineLevelCount, "upline", "level", "count"
+        )
+        with connection.cursor() as cursor:
+            for pairs, case in self._level_chunks(profile):
+                ids = ", ".join("%d" % upline_id for _, upline_id in pairs)
+                # Zero rows for uplines reaching a level for the first time
+                cursor.execute(
+                    f"{connection.ops.insert_statement(on_conflict=OnConflict.IGNORE)} "
+                    f"{table} ({upline_col}, {level_col}, {count_col}) VALUES "
+                    + ", ".join(
+                        "(%d, %d, 0)" % (upline_id, level) for level, upline_id in pairs
+                    )
+                    + " "
+                    + connection.ops.on_conflict_suffix_sql(
+                        [], OnConflict.IGNORE, None, None
+                    )
+                )
+                cursor.execute(
+                    f"UPDATE {table} SET {count_col} = {count_col} + 1 "
+                    f"WHERE {upline_col} IN ({ids}) "
+                    f"AND {level_col} = {case.format(upline_col)}"
+                )
+
+    def update_referral_depths(self, profile):
+        table, pk_col, depth_col = quoted_columns(
+            UserProfile, "id", "max_referral_depth"
+        )
+        with connection.cursor() as cursor:
+            for pairs, case in self._level_chunks(profile):
+                ids = ", ".join("%d" % upline_id for _, upline_id in pairs)
+                level = case.format(pk_col)
+                cursor.execute(
+                    f"UPDATE {table} SET {depth_col} = {level} "
+                    f"WHERE {pk_col} IN ({ids}) AND {depth_col} < {level}"
+                )
+
+
+class PackedAncestryStorage(UplineListStorage):
+    """
+    One ReferralAncestry row per user holding its packed upline chain
+
+    Storage grows with users x depth x 4 bytes and there is one primary
+    key index, instead of two foreign keys, a level, a timestamp and a
+    unique index per pair. Upline questions read a single row; downline
+    listings cannot be indexed and are served from the in-memory
+    ReferralGraph instead.
+    """
+
+    name = "packed"
+
+    def link(self, profile, referrer_profile):
+        referrer_chain = self.ancestor_ids(referrer_profile.pk)
+        if not referrer_chain and not is_root(referrer_profile):
+            raise MissingChainError(self, referrer_profile)
+        chain = [referrer_profile.pk] + [
+            upline_id for upline_id in referrer_chain if upline_id != profile.pk
+        ]
+        ReferralAncestry.objects.create(user=profile, ancestors=pack_ids(chain))
+
+    def bulk_link(self, chains, batch_size=5000):
+        ReferralAncestry.objects.bulk_create(
+            (
+                ReferralAncestry(user_id=user_id, ancestors=pack_ids(upline_ids))
+                for user_id, upline_ids in chains
+            ),
+            batch_size=batch_size,
+        )
+
+    def unlink(self, user_ids):
+        ReferralAncestry.objects.filter(user_id__in=user_ids).delete()
+
+    def iter_chains(self, chunk_size=10000):
+        rows = (
+            ReferralAncestry.objects.order_by("user_id")
+            .values_list("user_id", "ancestors")
+            .iterator(chunk_size=chunk_size)
+        )
+        for user_id, ancestors in rows:
+            if ancestors:
+                yield user_id, list(unpack_ids(ancestors))
+
+    def ancestor_ids(self, profile_id):
+        ancestors = (
+            ReferralAncestry.objects.filter(user_id=profile_id)
+            .values_list("ancestors", flat=True)
+            .first()
+        )
+        return list(unpack_ids(ancestors)) if ancestors else []
+
+    def downline_keys(self, profile, max_depth=None, after=None, limit=None):
+        """
+        Sorted (level, user_id) keys of the downlines following the `after`
+        key, at most `limit` of them, from the graph
+
+        The graph is walked one level at a time and the walk stops at the
+        level that fills the page, so only that level's ids are ordered.
+        """
+        from .referral_graph import get_referral_graph
+
+        graph = get_referral_graph()
+        graph.sync()
+        after_level, after_id = after or (0, 0)
+        keys = []
+        for level, user_ids in graph.descendant_levels(profile.pk, max_depth):
+            if level < after_level:
+                continue
+            if level == after_level:
+                user_ids = [user_id for user_id in user_ids if user_id > after_id]
+            if limit is None:
+                user_ids = sorted(user_ids)
+            else:
+                user_ids = heapq.nsmallest(limit - len(keys), user_ids)
+            keys.extend((level, user_id) for user_id in user_ids)
+            if limit is not None and len(keys) >= limit:
+                break
+        return keys
+
+
+class RecursiveCteStorage(UplineListStorage):
+    """
+    No stored chains at all: uplines and downlines are walked with
+    WITH RECURSIVE over UserProfile.referrer on every read
+
+    Signups only write the profile row and the counters, trading read
+    latency that grows with depth (or subtree size) for the lowest write
+    cost. Needs MySQL 8+, PostgreSQL or SQLite 3.8.3+.
+    """
+
+    name = "cte"
+    stores_chains = False
+
+    def link(self, profile, referrer_profile):
+        pass
+
+    def bulk_link(self, chains, batch_size=5000):
+        pass
+
+    def unlink(self, user_ids):
+        pass
+
+    def iter_chains(self, chunk_size=10000):
+        return iter(())
+
+    def _execute(self, cursor, sql, params):
+        if connection.vendor == "mysql":
+            # MySQL stops recursive CTEs at 1000 levels by default
+            cursor.execute(
+                "SET SESSION cte_max_recursion_depth = %s", [MAX_TREE_DEPTH + 1]
+            )
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def _ancestors_sql(self, select):
+        table, pk_col, referrer_col = quoted_columns(UserProfile, "id", "referrer")
+        # The root refers to itself, which ends the walk; MAX_TREE_DEPTH
+        # guards against any other referrer cycle
+        return (
+            f"WITH RECURSIVE chain (id, referrer_id, level) AS ("
+            f"SELECT {pk_col}, {referrer_col}, 0 FROM {table} WHERE {pk_col} = %s "
+            f"UNION ALL "
+            f"SELECT p.{pk_col}, p.{referrer_col}, chain.level + 1 "
+            f"FROM {table} p JOIN chain ON p.{pk_col} = chain.referrer_id "
+            f"WHERE chain.referrer_id <> chain.id AND chain.level < %s"
+            f") {select}"
+        )
+
+    def ancestor_ids(self, profile_id):
+        with connection.cursor() as cursor:
+            rows = self._execute(
+                cursor,
+                self._ancestors_sql(
+                    "SELECT id FROM chain WHERE level > 0 ORDER BY level"
+                ),
+                [profile_id, MAX_TREE_DEPTH],
+            )
+        return [upline_id for upline_id, in rows]
+
+    def ancestor_at(self, profile_id, level):
+        if level < 1:
+            return None
+        with connection.cursor() as cursor:
+            rows = self._execute(
+                cursor,
+                self._ancestors_sql("SELECT id FROM chain WHERE level = %s"),
+                [profile_id, min(level, MAX_TREE_DEPTH), level],
+            )
+        return rows[0][0] if rows else None
+
+    def is_ancestor(self, upline_id, profile_id):
+        with connection.cursor() as cursor:
+            rows = self._execute(
+                cursor,
+                self._ancestors_sql("SELECT 1 FROM chain WHERE level > 0 AND id = %s"),
+                [profile_id, MAX_TREE_DEPTH, upline_id],
+            )
+        return bool(rows)
+
+    def downline_keys(self, profile, max_depth=None, after=None, limit=None):
+        """
+        Sorted (level, user_id) keys of the downlines following the `after`
+        key, at most `limit` of them, walked in SQL
+        """
+        table, pk_col, referrer_col = quoted_columns(UserProfile, "id", "referrer")
+        max_depth = min(max_depth or MAX_TREE_DEPTH, MAX_TREE_DEPTH)
+        select = "SELECT level, id FROM down"
+        params = [profile.pk, profile.pk, max_depth]
+        if after is not None:
+            select += " WHERE level > %s OR (level = %s AND id > %s)"
+            params += [after[0], after[0], after[1]]
+        select += " ORDER BY level, id"
+        if limit is not None:
+            select += " LIMIT %s"
+            params.append(limit)
+        with connection.cursor() as cursor:
+            rows = self._execute(
+                cursor,
+                f"WITH RECURSIVE down (id, level) AS ("
+                f"SELECT {pk_col}, 1 FROM {table} "
+                f"WHERE {referrer_col} = %s AND {pk_col} <> %s "
+                f"UNION ALL "
+                f"SELECT p.{pk_col}, down.level + 1 "
+                f"FROM {table} p JOIN down ON p.{referrer_col} = down.id "
+                f"WHERE p.{pk_col} <> p.{referrer_col} AND down.level < %s"
+                f") {select}",
+                params,
+            )
+        return [tuple(row) for row in rows]
+
+
+class LtreePathStorage(UplineListStorage):
+    """
+    PostgreSQL only: every profile carries its root-to-user path of ids in
+    the ltree column UserProfile.referral_path
+
+    Subtree counts, depth-limited downline listings and ancestor lookups are
+    answered with the GiST-indexed <@ / @> operators, and a signup writes one
+    path plus a constant number of counter statements whatever its depth.
+    Other databases fall back to the closure storage.
+    """
+
+    name = "ltree"
+    requires_vendor = "postgresql"
+
+    def _columns(self):
+        return quoted_columns(UserProfile, "id", "referral_path")
+
+    def link(self, profile, referrer_profile):
+        table, pk_col, path_col = self._columns()
+        with connection.cursor() as cursor:
+            if is_root(referrer_profile):
+                # Roots are not linked themselves; give them a one-label path
+                cursor.execute(
+                    f"UPDATE {table} SET {path_col} = text2ltree(%s) "
+                    f"WHERE {pk_col} = %s AND {path_col} IS NULL",
+                    [str(referrer_profile.pk), referrer_profile.pk],
+                )
+            referrer_path = f"(SELECT r.{path_col} FROM {table} r WHERE r.{pk_col} = %s)"
+            cursor.execute(
+                f"UPDATE {table} SET {path_col} = {referrer_path} || text2ltree(%s) "
+                f"WHERE {pk_col} = %s AND {referrer_path} IS NOT NULL",
+                [referrer_profile.pk, str(profile.pk), profile.pk, referrer_profile.pk],
+            )
+            if cursor.rowcount == 0:
+                raise MissingChainError(self, referrer_profile)
+
+    def bulk_link(self, chains, batch_size=5000):
+        table, pk_col, path_col = self._columns()
+        paths = []
+        roots = set()
+        for user_id, upline_ids in chains:
+            paths.append(
+                (".".join(map(str, reversed(upline_ids))) + f".{user_id}", user_id)
+            )
+            roots.add(upline_ids[-1])
+        paths.extend((str(root_id), root_id) for root_id in roots)
+
+        with connection.cursor() as cursor:
+            for i in range(0, len(paths), batch_size):
+                cursor.executemany(
+                    f"UPDATE {table} SET {path_col} = text2ltree(%s) WHERE {pk_col} = %s",
+                    paths[i : i + batch_size],
+                )
+
+    def unlink(self, user_ids):
+        UserProfile.objects.filter(pk__in=user_ids).update(referral_path=None)
+
+    def iter_chains(self, chunk_size=10000):
+        rows = (
+            UserProfile.objects.filter(referral_path__isnull=False)
+            .order_by("pk")
+            .values_list("pk", "referral_path")
+            .iterator(chunk_size=chunk_size)
+        )
+        for user_id, path in rows:
+            upline_ids = [int(label) for label in reversed(path.split(".")[:-1])]
+            if upline_ids:
+                yield user_id, upline_ids
+
+    def ancestor_ids(self, profile_id):
+        path = (
+            UserProfile.objects.filter(pk=profile_id)
+            .values_list("referral_path", flat=True)
+            .first()
+        )
+        if not path:
+            return []
+        return [int(label) for label in reversed(path.split(".")[:-1])]
+
+    def _ancestor_sql(self, select):
+        """Join an upline `a` to the user `d` it is an ancestor of"""
+        table, pk_col, path_col = self._columns()
+        return (
+            f"SELECT {select} FROM {table} a JOIN {table} d "
+            f"ON a.{path_col} @> d.{path_col} AND a.{pk_col} <> d.{pk_col} "
+            f"WHERE d.{pk_col} = %s"
+        )
+
+    def _level(self):
+        _, _, path_col = self._columns()
+        return f"nlevel(d.{path_col}) - nlevel(a.{path_col})"
+
+    def ancestor_at(self, profile_id, level):
+        _, pk_col, _ = self._columns()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self._ancestor_sql(f"a.{pk_col}") + f" AND {self._level()} = %s",
+                [profile_id, level],
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def is_ancestor(self, upline_id, profile_id):
+        _, pk_col, _ = self._columns()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self._ancestor_sql("1") + f" AND a.{pk_col} = %s",
+                [profile_id, upline_id],
+            )
+            return cursor.fetchone() is not None
+
+    def upline_at(self, profile, level):
+        uplines = UserProfile.objects.raw(
+            self._ancestor_sql("a.*") + f" AND {self._level()} = %s",
+            [profile.pk, level],
+        )
+        return next(iter(uplines), None)
+
+    def downline_keys(self, profile, max_depth=None, after=None, limit=None):
+        """
+        Sorted (level, user_id) keys of the downlines following the `after`
+        key, at most `limit` of them, from a <@ scan
+        """
+        table, pk_col, path_col = self._columns()
+        level = f"nlevel(d.{path_col}) - nlevel(u.{path_col})"
+        sql = (
+            f"SELECT {level}, d.{pk_col} FROM {table} u JOIN {table} d "
+            f"ON d.{path_col} <@ u.{path_col} AND d.{pk_col} <> u.{pk_col} "
+            f"WHERE u.{pk_col} = %s"
+        )
+        params = [profile.pk]
+        if max_depth is not None:
+            sql += f" AND {level} <= %s"
+            params.append(max_depth)
+        if after is not None:
+            sql += f" AND ({level}, d.{pk_col}) > (%s, %s)"
+            params += list(after)
+        sql += " ORDER BY 1, 2"
+        if limit is not None:
+            sql += " LIMIT %s"
+            params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [tuple(row) for row in cursor.fetchall()]
+
+    def update_team_sizes(self, profile):
+        table, pk_col, path_col = self._columns()
+        _, team_col = quoted_columns(UserProfile, "team_size")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} a SET {team_col} = a.{team_col} + 1 FROM {table} d "
+                f"WHERE d.{pk_col} = %s AND a.{path_col} @> d.{path_col} "
+                f"AND a.{pk_col} <> d.{pk_col}",
+                [profile.pk],
+            )
+
+    def update_downline_level_counts(self, profile):
+        table, pk_col, path_col = self._columns()
+        counts, upline_col, level_col, count_col = quoted_columns(
+            DownlineLevelCount, "upline", "level", "count"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {counts} ({upline_col}, {level_col}, {count_col}) "
+                + self._ancestor_sql(f"a.{pk_col}, {self._level()}, 0")
+                + " ON CONFLICT DO NOTHING",
+                [profile.pk],
+            )
+            cursor.execute(
+                f"UPDATE {counts} c SET {count_col} = c.{count_col} + 1 "
+                f"FROM {table} a, {table} d "
+                f"WHERE d.{pk_col} = %s AND a.{path_col} @> d.{path_col} "
+                f"AND a.{pk_col} <> d.{pk_col} "
+                f"AND c.{upline_col} = a.{pk_col} AND c.{level_col} = {self._level()}",
+                [profile.pk],
+            )
+
+    def update_referral_depths(self, profile):
+        table, pk_col, path_col = self._columns()
+        _, depth_col = quoted_columns(UserProfile, "max_referral_depth")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} a SET {depth_col} = {self._level()} FROM {table} d "
+                f"WHERE d.{pk_col} = %s AND a.{path_col} @> d.{path_col} "
+                f"AND a.{pk_col} <> d.{pk_col} AND a.{depth_col} < {self._level()}",
+                [profile.pk],
+            )
+
+
+STORAGES = {
+    storage.name: storage
+    for storage in (
+        ClosureStorage(),
+        PackedAncestryStorage(),
+        RecursiveCteStorage(),
+        LtreePathStorage(),
+    )
+}
+
+
+def get_referral_storage():
+    """
+    Return the upline storage selected by settings.REFERRAL_STORAGE, or the
+    closure storage if the selected one needs another database vendor
+    """
+    try:
+        storage = STORAGES[settings.REFERRAL_STORAGE]
+    except KeyError:
+        raise ImproperlyConfigured(
+            f"Unknown REFERRAL_STORAGE {settings.REFERRAL_STORAGE!r}, "
+            f"expected one of {', '.join(STORAGES)}"
+        )
+    if storage.requires_vendor not in (None, connection.vendor):
+        return STORAGES[ClosureStorage.name]
+    return storage
@@ -0,0 +1,140 @@
+from django.db import transaction
+from django.db.models import F
+from rest_framework import status
+from ..models import Transaction, UserProfile
+from .idempotency import store_result
+from .ledger import confirm_pending, find_pending
+from .referral import (
+    ReferralService,
+    resolve_company_wallet,
+    write_company_ledger,
+)
+
+# Registration fees in USDT
+REGISTRATION_LEVEL_FEE = 100  # to the referrer
+REGISTRATION_SERVICE_FEE = 15  # to the company wallet
+REGISTRATION_TOTAL_FEE = REGISTRATION_LEVEL_FEE + REGISTRATION_SERVICE_FEE
+
+
+@transaction.atomic
+def settle_registration(profile, transaction_hash, pending=None):
+    """
+    Apply a confirmed registration transaction and return (response data,
+    status code)
+
+    The payment row recorded as PENDING when the transaction was submitted,
+    if any, is flipped to CONFIRMED instead of writing a new one. Needs
+    profile.referrer loaded.
+    """
+    referrer_profile = profile.referrer
+    if pending is None:
+        pending = find_pending(transaction_hash, "REGISTRATION")
+
+    # Update the user's status; the condition stops a
+    # concurrent request from registering the user twice
+    registered = UserProfile.objects.filter(
+        pk=profile.pk, current_level=0, is_registered_on_chain=False
+    ).update(is_registered_on_chain=True, current_level=1)
+    if not registered:
+        return {"error": "User is already registered"}, status.HTTP_400_BAD_REQUEST
+    profile.is_registered_on_chain = True
+    profile.current_level = 1
+    ReferralService.record_level_change(profile)
+
+    company_wallet_id, _ = resolve_company_wallet()
+    ledger = [
+        # Reward for the referrer (100 USDT), the new user is its source
+        Transaction(
+            user=referrer_profile,
+            transaction_type="REWARD",
+            amount=REGISTRATION_LEVEL_FEE,
+            level=1,
+            recipient=profile,
+            transaction_hash=transaction_hash,
+            status="CONFIRMED",
+        ),
+        # Service fee (15 USDT) for the company wallet
+        Transaction(
+            user_id=company_wallet_id,
+            transaction_type="REWARD",
+            amount=REGISTRATION_SERVICE_FEE,
+            level=1,
+            recipient=profile,
+            transaction_hash=transaction_hash,
+            status="CONFIRMED",
+        ),
+    ]
+    if pending is None or not confirm_pending(pending):
+        # Main registration transaction record, no recipient
+        ledger.insert(
+            0,
+            Transaction(
+                user=profile,
+                transaction_type="REGISTRATION",
+                amount=REGISTRATION_TOTAL_FEE,  # 115 USDT total
+                level=1,
+                transaction_hash=transaction_hash,
+                status="CONFIRMED",
+            ),
+        )
+    write_company_ledger(ledger)
+
+    # Update referrer's direct referral count
+    UserProfile.objects.filter(pk=referrer_profile.pk).update(
+        direct_referrals_count=F("direct_referrals_count") + 1
+    )
+
+    # Update max_referral_depth for each upline
+    ReferralService.update_referral_depths(profile)
+
+    data = {
+        "message": "Registration successful",
+        "profile_id": profile.pk,
+        "transaction_hash": transaction_hash,
+        "current_level": profile.current_level,
+    }
+    store_result(
+        transaction_hash,
+        "REGISTRATION",
+        profile,
+        status.HTTP_201_CREATED,
+        data,
+    )
+    return data, status.HTTP_201_CREATED
+
+
+@transaction.atomic
+def settle_upgrade(profile, target_level, transaction_hash, pending=None):
+    """
+    Apply a confirmed upgrade transaction and return (response data, status
+    code), flipping its PENDING payment row like settle_registration()
+
+    Raises ValueError when the user already reached the level.
+    """
+    if pending is None:
+        pending = find_pending(transaction_hash, "UPGRADE")
+
+    # ReferralService.upgrade_user_level will handle updating the
+    # user's level and creating reward transactions
+    upgrade_result = ReferralService.upgrade_user_level(
+        profile=profile,
+        target_level=target_level,
+        transaction_hash=transaction_hash,
+        pending=pending,
+    )
+
+    data = {
+        "message": "Level upgrade successful",
+        "new_level": target_level,
+        "transaction_hash": transaction_hash,
+        "upline_rewarded": upgrade_result["upline_rewarded"],
+        "upline_reward": float(upgrade_result["upline_reward"]),
+    }
+    store_result(
+        transaction_hash,
+        "UPGRADE",
+        profile,
+        status.HTTP_200_OK,
+        data,
+    )
+    return data, status.HTTP_200_OK
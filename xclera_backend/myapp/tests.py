@@ -1,11 +1,74 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.db import IntegrityError, connection
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.cache import cache
+from django.conf import settings
+from io import StringIO
+import base64
+import csv
+import os
+import tempfile
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import timedelta
+from decimal import Decimal
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from asgiref.sync import sync_to_async
 from rest_framework.test import APIClient
 from rest_framework import status
-from unittest.mock import patch, MagicMock
-from .models import UserProfile, Level, ReferralRelationship, Transaction
-from .services.referral import ReferralService
+from unittest import skipUnless
+from unittest.mock import patch, AsyncMock, MagicMock
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from .models import (
+    UserProfile,
+    Level,
+    ReferralRelationship,
+    Transaction,
+    DownlineLevelCount,
+    ReferralAncestry,
+    DailyEarnings,
+    IdempotencyRecord,
+)
+from .services.referral import (
+    ReferralService,
+    invalidate_company_wallet,
+    resolve_company_wallet,
+)
+from .services.blockchain import (
+    BlockchainService,
+    GasPriceOracle,
+    get_blockchain_service,
+    reset_blockchain_service,
+)
+from .services.async_blockchain import (
+    get_async_blockchain_service,
+    reset_async_blockchain_service,
+)
+from .authentication import Web3AuthBackend
+from .services.earnings import record_transactions
+from .services.ledger import record_pending
+from .services.settlement import settle_upgrade
+from .services.level_catalog import get_level_catalog
+from .services.referral_storage import MissingChainError, get_referral_storage, unpack_ids
+from .services.referral_graph import (
+    ReferralGraph,
+    get_referral_graph,
+    reset_referral_graph,
+)
+
+
+def encode_cursor(payload):
+    """A pagination cursor carrying an arbitrary, possibly malformed, payload"""
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
 
 class ReferralServiceTests(TestCase):
     def setUp(self):
@@ -252,4 +315,2284 @@ class APITests(TestCase):
         self.assertEqual(Transaction.objects.count(), 1)
         transaction = Transaction.objects.first()
         self.assertEqual(transaction.transaction_type, 'UPGRADE')
-        self.assertEqual(transaction.level, 2)
\ No newline at end of file
+        self.assertEqual(transaction.level, 2)
+
+class ReferralClosureTests(TestCase):
+    def build_chain(self, depth):
+        """Create a referral chain and return its deepest profile"""
+        profile = UserProfile.objects.create(
+            wallet_address=f'0x{depth:04x}{0:036x}',
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        chain = [profile]
+        for i in range(1, depth):
+            profile = UserProfile.objects.create(
+                wallet_address=f'0x{depth:04x}{i:036x}',
+                referrer=profile,
+                current_level=1,
+                is_registered_on_chain=True
+            )
+            chain.append(profile)
+
+        # Only the tail needs its closure rows for the new signup to copy
+        ReferralRelationship.objects.bulk_create([
+            ReferralRelationship(user=profile, upline=upline, level=len(chain) - i - 1)
+            for i, upline in enumerate(chain[:-1])
+        ])
+        return profile
+
+    def test_register_user_builds_full_upline_chain(self):
+        referrer = self.build_chain(5)
+
+        profile = ReferralService.register_user(
+            wallet_address='0x' + 'f' * 40,
+            referrer_profile=referrer
+        )
+
+        relationships = list(
+            ReferralRelationship.objects.filter(user=profile).order_by('level')
+        )
+        self.assertEqual(len(relationships), 5)
+        self.assertEqual(relationships[0].upline, referrer)
+        self.assertEqual(
+            [r.level for r in relationships], [1, 2, 3, 4, 5]
+        )
+        self.assertEqual(
+            relationships[-1].upline, UserProfile.objects.get(referrer__isnull=True)
+        )
+
+    def test_update_referral_depths_only_raises_shallower_uplines(self):
+        referrer = self.build_chain(4)
+        top = UserProfile.objects.get(referrer__isnull=True)
+        UserProfile.objects.filter(pk=top.pk).update(max_referral_depth=10)
+
+        profile = UserProfile.objects.create(
+            wallet_address='0x' + 'e' * 40, referrer=referrer
+        )
+        ReferralService.create_referral_relationships(profile, referrer)
+
+        with self.assertNumQueries(1):
+            ReferralService.update_referral_depths(profile)
+
+        depths = dict(
+            ReferralRelationship.objects.filter(user=profile).values_list(
+                'upline_id', 'upline__max_referral_depth'
+            )
+        )
+        levels = dict(
+            ReferralRelationship.objects.filter(user=profile).values_list(
+                'upline_id', 'level'
+            )
+        )
+        for upline_id, level in levels.items():
+            expected = 10 if upline_id == top.pk else level
+            self.assertEqual(depths[upline_id], expected)
+
+    def test_register_user_query_count_is_independent_of_depth(self):
+        query_counts = {}
+        for depth in (10, 100, 1000):
+            referrer = self.build_chain(depth)
+            with CaptureQueriesContext(connection) as queries:
+                profile = ReferralService.register_user(
+                    wallet_address=f'0x{depth:04x}{"e" * 36}',
+                    referrer_profile=referrer
+                )
+            query_counts[depth] = len(queries)
+            # One closure row per upline, however deep the chain
+            self.assertEqual(profile.uplines.count(), depth)
+            referrer.refresh_from_db()
+            self.assertEqual(referrer.max_referral_depth, 1)
+
+        self.assertEqual(len(set(query_counts.values())), 1, query_counts)
+
+    def test_closure_insert_query_count_is_independent_of_depth(self):
+        query_counts = {}
+        for depth in (10, 100, 1000):
+            referrer = self.build_chain(depth)
+            profile = UserProfile.objects.create(
+                wallet_address=f'0x{depth:04x}{"f" * 36}',
+                referrer=referrer
+            )
+            with CaptureQueriesContext(connection) as queries:
+                ReferralService.create_referral_relationships(profile, referrer)
+            query_counts[depth] = len(queries)
+            self.assertEqual(
+                ReferralRelationship.objects.filter(user=profile).count(), depth
+            )
+
+        self.assertEqual(len(set(query_counts.values())), 1, query_counts)
+
+
+class ReferralGraphTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.root_profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000001',
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        # The root user refers to itself, as create_root_user sets it up
+        self.root_profile.referrer = self.root_profile
+        self.root_profile.save()
+
+        self.user1_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            referrer_profile=self.root_profile
+        )
+        self.user2_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000003',
+            referrer_profile=self.user1_profile
+        )
+        self.user3_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000004',
+            referrer_profile=self.user1_profile
+        )
+
+    def tearDown(self):
+        reset_referral_graph()
+
+    def test_load_matches_closure_table(self):
+        graph = ReferralGraph().load()
+
+        self.assertEqual(
+            graph.ancestors(self.user2_profile.pk),
+            [self.user1_profile.pk, self.root_profile.pk]
+        )
+        self.assertEqual(graph.ancestor_at(self.user3_profile.pk, 2), self.root_profile.pk)
+        self.assertIsNone(graph.ancestor_at(self.user3_profile.pk, 3))
+        self.assertTrue(graph.is_ancestor(self.root_profile.pk, self.user2_profile.pk))
+        self.assertFalse(graph.is_ancestor(self.user2_profile.pk, self.user3_profile.pk))
+        self.assertEqual(graph.team_size(self.root_profile.pk), 3)
+        self.assertEqual(graph.team_size(self.user1_profile.pk), 2)
+        self.assertEqual(
+            sorted(graph.descendants(self.root_profile.pk, max_depth=1)),
+            [(self.user1_profile.pk, 1)]
+        )
+        self.assertEqual(graph.check_consistency(), [])
+
+    def test_incremental_updates_without_queries(self):
+        graph = ReferralGraph().load()
+
+        with self.assertNumQueries(0):
+            graph.add(1000, self.user3_profile.pk, 1)
+            graph.set_level(self.user1_profile.pk, 2)
+            self.assertEqual(graph.team_size(self.root_profile.pk), 4)
+            self.assertEqual(graph.ancestor_at(1000, 3), self.root_profile.pk)
+            self.assertEqual(graph.depth[1000], 3)
+            self.assertEqual(graph.level[self.user1_profile.pk], 2)
+
+    def test_register_user_updates_loaded_graph_on_commit(self):
+        graph = get_referral_graph()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            profile = ReferralService.register_user(
+                wallet_address='0x0000000000000000000000000000000000000005',
+                referrer_profile=self.user3_profile
+            )
+
+        self.assertEqual(graph.ancestor_at(profile.pk, 1), self.user3_profile.pk)
+        self.assertEqual(graph.team_size(self.root_profile.pk), 4)
+
+    @override_settings(REFERRAL_GRAPH_ENABLED=True)
+    def test_find_eligible_upline_uses_graph(self):
+        get_referral_graph()
+
+        with self.assertNumQueries(1):
+            upline = ReferralService.find_eligible_upline(self.user2_profile, 3)
+
+        self.assertEqual(upline, self.root_profile)
+        self.assertIsNone(ReferralService.find_eligible_upline(self.user2_profile, 2))
+
+    @override_settings(REFERRAL_GRAPH_ENABLED=True)
+    def test_find_eligible_upline_syncs_profiles_missing_from_graph(self):
+        graph = get_referral_graph()
+        # Created without running the on-commit hook, like a signup served
+        # by another process
+        profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000005',
+            referrer_profile=self.user2_profile
+        )
+
+        with self.assertNumQueries(2):
+            upline = ReferralService.find_eligible_upline(profile, 4)
+
+        self.assertEqual(upline, self.root_profile)
+        self.assertIn(profile.pk, graph)
+
+    def test_check_consistency_reports_missing_rows(self):
+        ReferralRelationship.objects.filter(
+            user=self.user2_profile, level=2
+        ).delete()
+
+        graph = ReferralGraph().load()
+
+        self.assertEqual(graph.check_consistency(), [self.user2_profile.pk])
+
+
+class TeamSizeTests(TestCase):
+    def setUp(self):
+        self.root_profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000001',
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        self.user1_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            referrer_profile=self.root_profile
+        )
+        self.user2_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000003',
+            referrer_profile=self.user1_profile
+        )
+
+    def test_register_user_increments_every_upline(self):
+        self.root_profile.refresh_from_db()
+        self.user1_profile.refresh_from_db()
+        self.user2_profile.refresh_from_db()
+
+        self.assertEqual(self.root_profile.team_size, 2)
+        self.assertEqual(self.user1_profile.team_size, 1)
+        self.assertEqual(self.user2_profile.team_size, 0)
+
+    def test_dashboard_stats_reads_counter(self):
+        client = APIClient()
+        client.force_authenticate(user=self.root_profile)
+
+        response = client.get(
+            reverse('userprofile-dashboard-stats', args=[self.root_profile.pk])
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['team_size'], 2)
+
+    def test_recompute_team_size_repairs_drift(self):
+        UserProfile.objects.update(team_size=7)
+
+        call_command('recompute_team_size', batch_size=2, stdout=StringIO())
+
+        self.assertEqual(
+            dict(UserProfile.objects.values_list('pk', 'team_size')),
+            {
+                self.root_profile.pk: 2,
+                self.user1_profile.pk: 1,
+                self.user2_profile.pk: 0,
+            }
+        )
+
+
+class DownlinesTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.root_profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000001',
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        self.client.force_authenticate(user=self.root_profile)
+
+        referrer = self.root_profile
+        for i in range(2, 8):
+            referrer = ReferralService.register_user(
+                wallet_address=f'0x{i:040x}',
+                referrer_profile=referrer if i % 2 == 0 else self.root_profile
+            )
+
+        self.url = reverse('userprofile-downlines', args=[self.root_profile.pk])
+
+    def expected_order(self, max_depth=None):
+        relationships = ReferralRelationship.objects.filter(upline=self.root_profile)
+        if max_depth:
+            relationships = relationships.filter(level__lte=max_depth)
+        return list(relationships.order_by('level', 'id').values_list('id', flat=True))
+
+    def test_pages_follow_level_and_id_order(self):
+        seen = []
+        response = self.client.get(self.url, {'page_size': 2})
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(row['id'] for row in response.data['results'])
+            if not response.data['next_cursor']:
+                break
+            response = self.client.get(
+                self.url, {'page_size': 2, 'cursor': response.data['next_cursor']}
+            )
+
+        self.assertEqual(seen, self.expected_order())
+
+    def test_cursor_keeps_max_depth_filter(self):
+        response = self.client.get(self.url, {'page_size': 1, 'max_depth': 1})
+        response = self.client.get(
+            self.url, {'page_size': 10, 'cursor': response.data['next_cursor']}
+        )
+
+        self.assertTrue(all(row['level'] == 1 for row in response.data['results']))
+        self.assertEqual(
+            [row['id'] for row in response.data['results']],
+            self.expected_order(max_depth=1)[1:]
+        )
+
+    def test_page_query_count_does_not_depend_on_page_size(self):
+        with self.assertNumQueries(2):
+            self.client.get(self.url, {'page_size': 1})
+        with self.assertNumQueries(2):
+            self.client.get(self.url, {'page_size': 100})
+
+    def test_invalid_cursor(self):
+        for cursor in [
+            'not-a-cursor',
+            encode_cursor({'p': 5, 'f': {}}),
+            encode_cursor({'p': [1, 'x'], 'f': {}}),
+            encode_cursor({'p': [1, True], 'f': {}}),
+            encode_cursor({'p': [1, 2 ** 70], 'f': {}}),
+            encode_cursor({'p': [1, 2], 'f': []}),
+            encode_cursor({'p': [1, 2], 'f': {'max_depth': 2}}),
+            encode_cursor({'p': [1, 2], 'f': {'unknown': 'x'}}),
+        ]:
+            with self.subTest(cursor=cursor):
+                response = self.client.get(self.url, {'cursor': cursor})
+
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_ndjson_stream(self):
+        response = self.client.get(self.url, {'stream': 'ndjson', 'max_depth': 2})
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [
+            json.loads(line)
+            for line in b''.join(response.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual([row['id'] for row in rows], self.expected_order(max_depth=2))
+
+
+class DownlineHistogramTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.root_profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000001',
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        self.client.force_authenticate(user=self.root_profile)
+
+        self.user1_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            referrer_profile=self.root_profile
+        )
+        for i in range(3, 6):
+            ReferralService.register_user(
+                wallet_address=f'0x{i:040x}',
+                referrer_profile=self.user1_profile
+            )
+
+    def test_rollup_matches_closure_table(self):
+        expected = {
+            (row['upline'], row['level']): row['total']
+            for row in ReferralRelationship.objects.values('upline', 'level')
+            .annotate(total=Count('id'))
+        }
+        stored = {
+            (row.upline_id, row.level): row.count
+            for row in DownlineLevelCount.objects.all()
+        }
+
+        self.assertEqual(stored, expected)
+
+    def test_histogram_endpoint(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                reverse('userprofile-downline-histogram', args=[self.root_profile.pk])
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data['levels'],
+            [{'level': 1, 'count': 1}, {'level': 2, 'count': 3}]
+        )
+        self.assertEqual(response.data['team_size'], 4)
+
+    def test_histogram_max_depth(self):
+        response = self.client.get(
+            reverse('userprofile-downline-histogram', args=[self.root_profile.pk]),
+            {'max_depth': 1}
+        )
+
+        self.assertEqual(response.data['levels'], [{'level': 1, 'count': 1}])
+
+
+class EligibleUplineCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.root_profile = UserProfile.objects.create(
+            wallet_address=settings.ROOT_USER_ADDRESS,
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        invalidate_company_wallet()
+        self.user1_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            referrer_profile=self.root_profile
+        )
+        self.user2_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000003',
+            referrer_profile=self.user1_profile
+        )
+        Level.objects.create(level_number=2, price=150, min_direct_referrals=0, min_referral_depth=0)
+
+    def test_cold_lookup_is_one_joined_query(self):
+        with self.assertNumQueries(1):
+            upline = ReferralService.find_eligible_upline(self.user2_profile, 3)
+
+        self.assertEqual(upline, self.root_profile)
+
+    def break_chain(self):
+        ReferralRelationship.objects.filter(user=self.user2_profile).delete()
+        self.assertIsNone(ReferralService.find_eligible_upline(self.user2_profile, 3))
+
+    def test_missing_upline_is_forgotten_after_rebuild(self):
+        self.break_chain()
+
+        call_command('rebuild_referral_closure', fix=True, stdout=StringIO())
+
+        self.assertEqual(
+            ReferralService.find_eligible_upline(self.user2_profile, 3), self.root_profile
+        )
+
+    def test_memo_is_kept_per_storage(self):
+        self.break_chain()
+
+        with override_settings(REFERRAL_STORAGE='cte'):
+            self.assertEqual(
+                ReferralService.find_eligible_upline(self.user2_profile, 3), self.root_profile
+            )
+
+    def test_warm_lookup_reads_only_the_upline_row(self):
+        self.assertIsNone(ReferralService.find_eligible_upline(self.user2_profile, 2))
+
+        with self.assertNumQueries(1):
+            self.assertIsNone(ReferralService.find_eligible_upline(self.user2_profile, 2))
+
+    def test_level_change_from_another_process_is_seen(self):
+        self.assertIsNone(ReferralService.find_eligible_upline(self.user2_profile, 2))
+
+        # e.g. the confirmation tracker, which shares no cache with this worker
+        UserProfile.objects.filter(pk=self.user1_profile.pk).update(current_level=2)
+
+        self.assertEqual(
+            ReferralService.find_eligible_upline(self.user2_profile, 2),
+            self.user1_profile
+        )
+
+
+class ImportReferralTreeTests(TestCase):
+    def setUp(self):
+        self.root_profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000001',
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        self.existing_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            referrer_profile=self.root_profile
+        )
+
+    def write_rows(self, rows):
+        handle = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+        self.addCleanup(os.remove, handle.name)
+        writer = csv.writer(handle)
+        writer.writerow(['wallet_address', 'referrer_wallet', 'username', 'current_level'])
+        writer.writerows(rows)
+        handle.close()
+        return handle.name
+
+    def test_import_matches_register_user(self):
+        # Children are listed before their referrers on purpose
+        path = self.write_rows([
+            [f'0x{12:040x}', f'0x{11:040x}', 'grandchild', ''],
+            [f'0x{11:040x}', f'0x{2:040x}', 'child', ''],
+            [f'0x{13:040x}', f'0x{11:040x}', '', '0'],
+            [f'0x{14:040x}', f'0x{99:040x}', 'orphan', ''],
+        ])
+
+        call_command('import_referral_tree', path, batch_size=2, stdout=StringIO())
+
+        self.assertEqual(UserProfile.objects.count(), 5)
+        self.assertEqual(ReferralGraph().load().check_consistency(), [])
+        grandchild = UserProfile.objects.get(wallet_address=f'0x{12:040x}')
+        self.assertEqual(grandchild.username, 'grandchild')
+        self.assertEqual(
+            list(grandchild.uplines.order_by('level').values_list('upline__username', flat=True)),
+            ['child', None, None]
+        )
+
+        self.root_profile.refresh_from_db()
+        self.existing_profile.refresh_from_db()
+        child = UserProfile.objects.get(wallet_address=f'0x{11:040x}')
+        self.assertEqual(self.root_profile.team_size, 4)
+        self.assertEqual(self.root_profile.max_referral_depth, 3)
+        self.assertEqual(self.existing_profile.direct_referrals_count, 1)
+        # The level 0 referral counts towards the team but not the depth
+        self.assertEqual(child.team_size, 2)
+        self.assertEqual(child.direct_referrals_count, 1)
+        self.assertEqual(child.max_referral_depth, 1)
+        self.assertEqual(
+            dict(
+                DownlineLevelCount.objects.filter(upline=self.root_profile)
+                .values_list('level', 'count')
+            ),
+            {1: 1, 2: 1, 3: 2}
+        )
+
+    def test_rerun_skips_imported_wallets(self):
+        path = self.write_rows([
+            [f'0x{11:040x}', f'0x{2:040x}', 'child', ''],
+            [f'0x{12:040x}', f'0x{11:040x}', 'grandchild', ''],
+        ])
+
+        call_command('import_referral_tree', path, stdout=StringIO())
+        call_command('import_referral_tree', path, stdout=StringIO())
+
+        self.assertEqual(UserProfile.objects.count(), 4)
+        self.assertEqual(ReferralRelationship.objects.count(), 1 + 2 + 3)
+        self.root_profile.refresh_from_db()
+        self.assertEqual(self.root_profile.team_size, 3)
+
+    def test_streams_rows_referred_before_their_referrer_is_read(self):
+        path = self.write_rows([
+            [f'0x{13:040x}', f'0x{12:040x}', 'great-grandchild', ''],
+            [f'0x{12:040x}', f'0x{11:040x}', 'grandchild', ''],
+            [f'0x{15:040x}', f'0x{16:040x}', 'cycle', ''],
+            [f'0x{16:040x}', f'0x{15:040x}', 'cycle', ''],
+            [f'0x{11:040x}', f'0x{2:040x}', 'child', ''],
+        ])
+        out = StringIO()
+
+        call_command('import_referral_tree', path, batch_size=1, stdout=out)
+
+        self.assertEqual(UserProfile.objects.count(), 5)
+        self.assertEqual(ReferralGraph().load().check_consistency(), [])
+        self.assertIn('2 rows were skipped', out.getvalue())
+
+    def test_invalid_rows_are_reported_by_number(self):
+        for level in ['abc', '-1', '1.5']:
+            with self.subTest(level=level):
+                path = self.write_rows([
+                    [f'0x{11:040x}', f'0x{2:040x}', 'child', ''],
+                    [f'0x{12:040x}', f'0x{11:040x}', 'grandchild', level],
+                ])
+
+                with self.assertRaisesMessage(CommandError, 'Row 2: invalid current_level'):
+                    call_command('import_referral_tree', path, stdout=StringIO())
+
+    def test_invalid_jsonl_line_is_reported_by_number(self):
+        handle = tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False)
+        self.addCleanup(os.remove, handle.name)
+        handle.write(json.dumps({
+            'wallet_address': f'0x{11:040x}', 'referrer_wallet': f'0x{2:040x}', 'current_level': 0,
+        }) + '\n')
+        handle.write('{"wallet_address": \n')
+        handle.close()
+
+        with self.assertRaisesMessage(CommandError, 'Row 2: invalid JSON'):
+            call_command('import_referral_tree', handle.name, batch_size=1, stdout=StringIO())
+        # The chunk read before the bad line is imported; JSON 0 is a level
+        # of its own, not a missing value
+        self.assertEqual(UserProfile.objects.get(wallet_address=f'0x{11:040x}').current_level, 0)
+
+
+class RebuildReferralClosureTests(TestCase):
+    def setUp(self):
+        self.root_profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000001',
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        self.child = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            referrer_profile=self.root_profile
+        )
+        self.grandchild = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000003',
+            referrer_profile=self.child
+        )
+        self.great_grandchild = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000004',
+            referrer_profile=self.grandchild
+        )
+
+    def snapshot(self):
+        return (
+            sorted(ReferralRelationship.objects.values_list('user_id', 'upline_id', 'level')),
+            sorted(UserProfile.objects.values_list(
+                'pk', 'direct_referrals_count', 'max_referral_depth', 'team_size'
+            )),
+            sorted(DownlineLevelCount.objects.filter(count__gt=0).values_list(
+                'upline_id', 'level', 'count'
+            )),
+        )
+
+    def test_consistent_tree_reports_no_drift(self):
+        out = StringIO()
+        call_command('rebuild_referral_closure', stdout=out)
+        self.assertIn('No drift found', out.getvalue())
+
+    def test_report_leaves_drift_in_place(self):
+        UserProfile.objects.filter(pk=self.child.pk).update(direct_referrals_count=7)
+        out = StringIO()
+
+        call_command('rebuild_referral_closure', stdout=out)
+
+        self.assertIn('direct_referrals_count: 1 profiles drifted', out.getvalue())
+        self.child.refresh_from_db()
+        self.assertEqual(self.child.direct_referrals_count, 7)
+
+    def test_fix_restores_register_user_state(self):
+        expected = self.snapshot()
+        ReferralRelationship.objects.filter(user=self.great_grandchild, level=3).delete()
+        ReferralRelationship.objects.create(user=self.grandchild, upline=self.grandchild, level=5)
+        UserProfile.objects.update(direct_referrals_count=0, max_referral_depth=9, team_size=0)
+        DownlineLevelCount.objects.filter(upline=self.root_profile, level=2).update(count=4)
+
+        call_command('rebuild_referral_closure', fix=True, batch_size=2, stdout=StringIO())
+
+        self.assertEqual(self.snapshot(), expected)
+        out = StringIO()
+        call_command('rebuild_referral_closure', stdout=out)
+        self.assertIn('No drift found', out.getvalue())
+
+
+class UplineListStorageTestsMixin:
+    def setUp(self):
+        cache.clear()
+        reset_referral_graph()
+        self.client = APIClient()
+        self.root_profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000001',
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        self.client.force_authenticate(user=self.root_profile)
+
+        self.profiles = [self.root_profile]
+        for i in range(2, 8):
+            self.profiles.append(ReferralService.register_user(
+                wallet_address=f'0x{i:040x}',
+                referrer_profile=self.profiles[-1] if i <= 5 else self.root_profile
+            ))
+        # root <- 2 <- 3 <- 4 <- 5, with 6 and 7 referred by the root directly
+        self.leaf = self.profiles[4]
+
+    def tearDown(self):
+        reset_referral_graph()
+
+    def test_ancestor_helpers(self):
+        storage = get_referral_storage()
+
+        self.assertEqual(
+            storage.ancestor_ids(self.leaf.pk),
+            [profile.pk for profile in reversed(self.profiles[:4])]
+        )
+        self.assertEqual(storage.ancestor_ids(self.root_profile.pk), [])
+        self.assertEqual(storage.ancestor_at(self.leaf.pk, 2), self.profiles[2].pk)
+        self.assertIsNone(storage.ancestor_at(self.leaf.pk, 5))
+        self.assertTrue(storage.is_ancestor(self.root_profile.pk, self.leaf.pk))
+        self.assertFalse(storage.is_ancestor(self.profiles[5].pk, self.leaf.pk))
+
+    def test_counters_match_referrer_pointers(self):
+        out = StringIO()
+        call_command('rebuild_referral_closure', stdout=out)
+
+        self.assertIn('No drift found', out.getvalue())
+        self.root_profile.refresh_from_db()
+        self.assertEqual(self.root_profile.team_size, 6)
+        self.assertEqual(self.root_profile.max_referral_depth, 4)
+
+    def test_uplines_and_eligible_upline(self):
+        response = self.client.get(reverse('userprofile-uplines', args=[self.leaf.pk]))
+
+        self.assertEqual(
+            [(row['upline'], row['level']) for row in response.data],
+            [(self.profiles[level].pk, 4 - level) for level in (3, 2, 1, 0)]
+        )
+        self.assertEqual(ReferralService.find_eligible_upline(self.leaf, 5), self.root_profile)
+        self.assertIsNone(ReferralService.find_eligible_upline(self.leaf, 4))
+
+    def test_downlines_are_paginated_from_the_graph(self):
+        url = reverse('userprofile-downlines', args=[self.root_profile.pk])
+        seen = []
+        response = self.client.get(url, {'page_size': 2})
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend((row['level'], row['user']) for row in response.data['results'])
+            if not response.data['next_cursor']:
+                break
+            response = self.client.get(
+                url, {'page_size': 2, 'cursor': response.data['next_cursor']}
+            )
+
+        depths = {2: 1, 3: 2, 4: 3, 5: 4, 6: 1, 7: 1}
+        self.assertEqual(
+            seen,
+            sorted((depths[int(p.wallet_address, 16)], p.pk) for p in self.profiles[1:])
+        )
+
+    def test_downline_keys_follow_the_cursor(self):
+        storage = get_referral_storage()
+        keys = storage.downline_keys(self.root_profile)
+
+        self.assertEqual(len(keys), 6)
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(storage.downline_keys(self.root_profile, limit=2), keys[:2])
+        self.assertEqual(
+            storage.downline_keys(self.root_profile, after=keys[1], limit=3), keys[2:5]
+        )
+        self.assertEqual(storage.downline_keys(self.root_profile, after=keys[2]), keys[3:])
+        self.assertEqual(
+            storage.downline_keys(self.root_profile, max_depth=2, after=keys[1]),
+            [key for key in keys[2:] if key[0] <= 2]
+        )
+        self.assertEqual(storage.downline_keys(self.root_profile, after=keys[-1]), [])
+
+
+@override_settings(REFERRAL_STORAGE='packed')
+class PackedAncestryStorageTests(UplineListStorageTestsMixin, TestCase):
+    def test_signup_stores_one_packed_row(self):
+        self.assertEqual(ReferralRelationship.objects.count(), 0)
+        self.assertEqual(ReferralAncestry.objects.count(), 6)
+        self.assertEqual(
+            list(unpack_ids(ReferralAncestry.objects.get(user=self.leaf).ancestors)),
+            [profile.pk for profile in reversed(self.profiles[:4])]
+        )
+
+
+@override_settings(REFERRAL_STORAGE='cte')
+class RecursiveCteStorageTests(UplineListStorageTestsMixin, TestCase):
+    def test_signup_stores_no_chain_rows(self):
+        self.assertEqual(ReferralRelationship.objects.count(), 0)
+        self.assertEqual(ReferralAncestry.objects.count(), 0)
+
+    def test_lookups_are_single_queries(self):
+        storage = get_referral_storage()
+
+        with self.assertNumQueries(1):
+            storage.ancestor_ids(self.leaf.pk)
+        with self.assertNumQueries(1):
+            storage.downline_keys(self.root_profile, max_depth=2)
+        with self.assertNumQueries(2):
+            ReferralService.find_eligible_upline(self.leaf, 5)
+
+    def test_downline_page_is_cut_in_sql(self):
+        keys = get_referral_storage().downline_keys(self.root_profile)
+
+        with CaptureQueriesContext(connection) as queries:
+            page = get_referral_storage().downline_keys(
+                self.root_profile, after=keys[0], limit=2
+            )
+
+        self.assertEqual(page, keys[1:3])
+        self.assertEqual(len(queries), 1)
+        self.assertIn('LIMIT 2', queries[0]['sql'])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'ltree storage needs PostgreSQL')
+@override_settings(REFERRAL_STORAGE='ltree')
+class LtreePathStorageTests(UplineListStorageTestsMixin, TestCase):
+    def test_signup_stores_root_to_user_path(self):
+        path = UserProfile.objects.get(pk=self.leaf.pk).referral_path
+
+        self.assertEqual(path, '.'.join(str(profile.pk) for profile in self.profiles[:5]))
+        self.assertEqual(ReferralRelationship.objects.count(), 0)
+
+    def test_downline_page_is_cut_in_sql(self):
+        keys = get_referral_storage().downline_keys(self.root_profile)
+
+        with CaptureQueriesContext(connection) as queries:
+            page = get_referral_storage().downline_keys(
+                self.root_profile, after=keys[0], limit=2
+            )
+
+        self.assertEqual(page, keys[1:3])
+        self.assertEqual(len(queries), 1)
+        self.assertIn('LIMIT 2', queries[0]['sql'])
+
+
+
+@override_settings(REFERRAL_STORAGE='ltree')
+class LtreePathStorageFallbackTests(TestCase):
+    def test_falls_back_to_closure_rows_off_postgresql(self):
+        if connection.vendor == 'postgresql':
+            self.skipTest('ltree storage is used on PostgreSQL')
+        root_profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000001',
+            current_level=19,
+            is_registered_on_chain=True
+        )
+
+        profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            referrer_profile=root_profile
+        )
+
+        self.assertEqual(get_referral_storage().name, 'closure')
+        self.assertTrue(
+            ReferralRelationship.objects.filter(user=profile, upline=root_profile).exists()
+        )
+        self.assertIsNone(UserProfile.objects.get(pk=profile.pk).referral_path)
+
+
+class SwitchedReferralStorageTests(TestCase):
+    def setUp(self):
+        self.root_profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000001',
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        # Linked while the closure storage was selected
+        self.user1_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            referrer_profile=self.root_profile
+        )
+
+    def tearDown(self):
+        reset_referral_graph()
+
+    def register(self):
+        return ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000003',
+            referrer_profile=self.user1_profile
+        )
+
+    def test_signup_under_unlinked_referrer_is_refused(self):
+        for name in ['packed', 'closure']:
+            with self.subTest(storage=name), override_settings(REFERRAL_STORAGE=name):
+                if name == 'closure':
+                    ReferralRelationship.objects.all().delete()
+
+                with self.assertRaisesMessage(MissingChainError, 'rebuild_referral_closure --fix'):
+                    self.register()
+
+                self.assertFalse(
+                    UserProfile.objects.filter(wallet_address__endswith='3').exists()
+                )
+
+    @override_settings(REFERRAL_STORAGE='packed')
+    def test_rebuild_links_existing_profiles(self):
+        call_command('rebuild_referral_closure', fix=True, stdout=StringIO())
+
+        profile = self.register()
+
+        self.assertEqual(
+            get_referral_storage().ancestor_ids(profile.pk),
+            [self.user1_profile.pk, self.root_profile.pk]
+        )
+
+
+class LedgerWriteTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.root_profile = UserProfile.objects.create(
+            wallet_address=settings.ROOT_USER_ADDRESS,
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        invalidate_company_wallet()
+        self.user1_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            referrer_profile=self.root_profile
+        )
+        Level.objects.create(level_number=2, price=150, min_direct_referrals=0, min_referral_depth=0)
+
+    def statements(self, queries):
+        return [
+            query['sql'] for query in queries.captured_queries
+            if 'SAVEPOINT' not in query['sql']
+        ]
+
+    def test_upgrade_writes_ledger_in_three_statements(self):
+        # Warm the per-process lookups and the eligible upline lookup the
+        # view runs before upgrading
+        get_level_catalog()
+        resolve_company_wallet()
+        ReferralService.find_eligible_upline(self.user1_profile, 2)
+
+        with CaptureQueriesContext(connection) as queries:
+            result = ReferralService.upgrade_user_level(
+                self.user1_profile, 2, transaction_hash='0x' + 'a' * 64
+            )
+
+        statements = self.statements(queries)
+        writes = [sql for sql in statements if not sql.startswith('SELECT')]
+        self.assertEqual(len(writes), 3, writes)
+        self.assertEqual(len(statements), 4, statements)
+        self.assertEqual(result['upline_reward'], 120)
+        self.assertEqual(
+            sorted(Transaction.objects.values_list('user_id', 'transaction_type', 'amount')),
+            sorted([
+                (self.user1_profile.pk, 'UPGRADE', Decimal(150)),
+                (self.root_profile.pk, 'REWARD', Decimal(30)),
+                (self.root_profile.pk, 'REWARD', Decimal(120)),
+            ])
+        )
+
+    def test_upgrade_is_recorded_once(self):
+        ReferralService.upgrade_user_level(self.user1_profile, 2, transaction_hash='0x' + 'a' * 64)
+
+        with self.assertRaises(ValueError):
+            ReferralService.upgrade_user_level(
+                UserProfile.objects.get(pk=self.user1_profile.pk), 2,
+                transaction_hash='0x' + 'b' * 64
+            )
+        self.assertEqual(Transaction.objects.filter(transaction_type='UPGRADE').count(), 1)
+
+    @patch('myapp.views.get_blockchain_service')
+    def test_registration_writes_ledger_in_one_insert(self, blockchain_service):
+        tx_hash = '0x' + 'c' * 64
+        blockchain_service.return_value.verify_transaction.return_value = {
+            'status': 'success',
+            'transaction_hash': tx_hash,
+        }
+        profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000003',
+            referrer=self.user1_profile,
+            username='newuser',
+            phone_number='123456789',
+            country='NP',
+        )
+        ReferralService.create_referral_relationships(profile, self.user1_profile)
+        client = APIClient()
+        client.force_authenticate(user=profile)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = client.post(
+                reverse('register-list'),
+                {'wallet_address': profile.wallet_address, 'transaction_hash': tx_hash},
+                format='json',
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+        inserts = [sql for sql in self.statements(queries) if sql.startswith('INSERT')]
+        # Ledger rows, the rollup upsert and the idempotency record
+        self.assertEqual(len(inserts), 3, inserts)
+        self.assertEqual(
+            Transaction.objects.filter(transaction_hash=tx_hash).count(), 3
+        )
+        self.user1_profile.refresh_from_db()
+        self.assertEqual(self.user1_profile.direct_referrals_count, 1)
+        profile.refresh_from_db()
+        self.assertEqual(profile.current_level, 1)
+
+        # A second registration under a new hash is refused
+        response = client.post(
+            reverse('register-list'),
+            {'wallet_address': profile.wallet_address, 'transaction_hash': '0x' + 'f' * 64},
+            format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(COMPANY_WALLET_ADDRESS='0x00000000000000000000000000000000000000cc')
+class CompanyWalletTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.root_profile = UserProfile.objects.create(
+            wallet_address=settings.ROOT_USER_ADDRESS,
+            username='Root User',
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        invalidate_company_wallet()
+
+    def test_resolved_once_per_process(self):
+        company = UserProfile.objects.create(
+            wallet_address=settings.COMPANY_WALLET_ADDRESS, current_level=19
+        )
+        self.assertEqual(resolve_company_wallet(), (company.pk, '0x00000000...'))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_company_wallet()[0], company.pk)
+
+    def test_root_fallback_is_not_kept(self):
+        self.assertEqual(resolve_company_wallet(), (self.root_profile.pk, 'Root User'))
+
+        # Created by another process, which cannot reach this one's cache
+        company = UserProfile.objects.create(
+            wallet_address=settings.COMPANY_WALLET_ADDRESS, current_level=19
+        )
+
+        self.assertEqual(resolve_company_wallet()[0], company.pk)
+
+    def test_deleted_company_wallet_is_resolved_again_on_write(self):
+        stale = UserProfile.objects.create(
+            wallet_address=settings.COMPANY_WALLET_ADDRESS, current_level=19
+        )
+        resolve_company_wallet()
+        stale_id = stale.pk
+        stale.delete()
+        company = UserProfile.objects.create(
+            wallet_address=settings.COMPANY_WALLET_ADDRESS, current_level=19
+        )
+        profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            referrer_profile=self.root_profile
+        )
+        Level.objects.create(level_number=2, price=150, min_direct_referrals=0, min_referral_depth=0)
+        create = Transaction.objects.bulk_create
+
+        # SQLite only checks foreign keys at commit, MySQL on the insert
+        def insert(rows):
+            if any(row.user_id == stale_id for row in rows):
+                raise IntegrityError('FOREIGN KEY constraint failed')
+            return create(rows)
+
+        with patch.object(Transaction.objects, 'bulk_create', side_effect=insert):
+            ReferralService.upgrade_user_level(profile, 2, transaction_hash='0x' + 'a' * 64)
+
+        self.assertEqual(
+            Transaction.objects.get(transaction_type='REWARD', amount=30).user_id, company.pk
+        )
+
+    @patch('builtins.input', return_value='y')
+    def test_create_root_user_invalidates(self, _):
+        resolve_company_wallet()
+
+        with patch.dict(os.environ, {'ROOT_USER_ADDRESS': settings.ROOT_USER_ADDRESS}):
+            call_command('create_root_user', stdout=StringIO())
+
+        root_profile = UserProfile.objects.get(wallet_address=settings.ROOT_USER_ADDRESS)
+        self.assertNotEqual(root_profile.pk, self.root_profile.pk)
+        self.assertEqual(resolve_company_wallet()[0], root_profile.pk)
+
+
+class LevelCatalogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000001',
+            current_level=1,
+            direct_referrals_count=3,
+        )
+        call_command('setup_initial_data', stdout=StringIO())
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.profile)
+
+    def test_service_lookups_need_no_queries(self):
+        get_level_catalog()
+
+        with self.assertNumQueries(0):
+            eligible, _ = ReferralService.check_level_upgrade_eligibility(self.profile, 2)
+            missing, message = ReferralService.check_level_upgrade_eligibility(self.profile, 42)
+
+        self.assertTrue(eligible)
+        self.assertFalse(missing)
+        self.assertEqual(message, 'Level does not exist')
+
+    def test_level_changes_reload_the_catalog(self):
+        self.assertEqual(get_level_catalog().get(19).price, 1000)
+
+        Level.objects.filter(level_number=19).get().delete()
+        Level.objects.create(level_number=19, price=2000)
+
+        self.assertEqual(get_level_catalog().get(19).price, 2000)
+
+    def test_setup_initial_data_bumps_the_version(self):
+        catalog = get_level_catalog()
+
+        call_command('setup_initial_data', stdout=StringIO())
+
+        # The levels were recreated under new ids
+        self.assertIsNot(get_level_catalog(), catalog)
+        self.assertNotEqual(get_level_catalog().etag, catalog.etag)
+
+    def test_level_endpoints_use_etag_without_queries(self):
+        get_level_catalog()
+        url = reverse('level-list')
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [level['level_number'] for level in response.data['results']], list(range(20))
+        )
+
+        with self.assertNumQueries(0):
+            cached = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        level = get_level_catalog().get(5)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('level-detail', args=[level.pk]))
+        self.assertEqual(response.data['level_number'], 5)
+        self.assertEqual(
+            self.client.get(reverse('level-detail', args=[0])).status_code,
+            status.HTTP_404_NOT_FOUND
+        )
+
+
+class TransactionPaginationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000001',
+            current_level=1,
+        )
+        other = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            current_level=1,
+        )
+        self.client.force_authenticate(user=self.profile)
+
+        now = timezone.now()
+        for i in range(9):
+            tx = Transaction.objects.create(
+                user=other if i % 3 == 0 else self.profile,
+                transaction_type='REWARD' if i % 2 else 'UPGRADE',
+                amount=i + 1,
+                level=1,
+                status='CONFIRMED',
+            )
+            # Pairs of rows share a timestamp so the id tie-break matters, and
+            # all of them fall within one millisecond
+            Transaction.objects.filter(pk=tx.pk).update(
+                created_at=now.replace(microsecond=500) - timedelta(microseconds=i // 2)
+            )
+
+    def walk(self, url, params):
+        seen = []
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(row['id'] for row in response.data['results'])
+            if not response.data['next_cursor']:
+                return seen
+            response = self.client.get(
+                url, {'cursor': response.data['next_cursor'], 'page_size': params['page_size']}
+            )
+
+    def test_pages_follow_created_at_and_id_order(self):
+        self.assertEqual(
+            self.walk(reverse('transaction-list'), {'page_size': 2}),
+            list(Transaction.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        )
+
+    def test_cursor_keeps_filters(self):
+        url = reverse('userprofile-transactions', args=[self.profile.pk])
+
+        self.assertEqual(
+            self.walk(url, {'page_size': 1, 'transaction_type': 'REWARD'}),
+            list(
+                Transaction.objects.filter(user=self.profile, transaction_type='REWARD')
+                .order_by('-created_at', '-id')
+                .values_list('id', flat=True)
+            )
+        )
+
+    def test_deep_pages_cost_the_same_without_counting(self):
+        url = reverse('transaction-list')
+        first = self.client.get(url, {'page_size': 1})
+        later = first
+        for _ in range(6):
+            later = self.client.get(url, {'page_size': 1, 'cursor': later.data['next_cursor']})
+
+        with CaptureQueriesContext(connection) as first_page:
+            self.client.get(url, {'page_size': 1})
+        with CaptureQueriesContext(connection) as later_page:
+            self.client.get(url, {'page_size': 1, 'cursor': later.data['next_cursor']})
+
+        self.assertEqual(len(first_page), len(later_page))
+        for query in first_page.captured_queries + later_page.captured_queries:
+            self.assertNotIn('COUNT(', query['sql'])
+
+    def test_invalid_cursor(self):
+        created_at = timezone.now().isoformat()
+        for cursor in [
+            'not-a-cursor',
+            encode_cursor({'p': 5, 'f': {}}),
+            encode_cursor({'p': [created_at], 'f': {}}),
+            encode_cursor({'p': ['notadate', 1], 'f': {}}),
+            encode_cursor({'p': [None, 1], 'f': {}}),
+            encode_cursor({'p': [created_at, 'x'], 'f': {}}),
+            encode_cursor({'p': [created_at, 1], 'f': {'level': ['2']}}),
+        ]:
+            with self.subTest(cursor=cursor):
+                response = self.client.get(reverse('transaction-list'), {'cursor': cursor})
+
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_invalid_level_filter_is_ignored(self):
+        created_at = timezone.now().isoformat()
+        cursor = encode_cursor({'p': [created_at, 10 ** 6], 'f': {'level': 'abc'}})
+
+        for params in [{'level': 'abc'}, {'cursor': cursor}]:
+            with self.subTest(params=params):
+                response = self.client.get(reverse('transaction-list'), params)
+
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class TransactionExportTests(TestCase):
+    def setUp(self):
+        self.profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000001',
+            current_level=1,
+        )
+        for i in range(5):
+            Transaction.objects.create(
+                user=self.profile,
+                transaction_type='REWARD' if i % 2 else 'UPGRADE',
+                amount=Decimal('10.5') * (i + 1),
+                level=i + 1,
+                recipient=self.profile if i % 2 else None,
+                transaction_hash=f'0x{i:064x}',
+                status='CONFIRMED',
+            )
+
+    def test_command_writes_csv_in_id_order(self):
+        out = StringIO()
+        call_command('export_transactions', chunk_size=2, stdout=out, stderr=StringIO())
+
+        rows = list(csv.DictReader(StringIO(out.getvalue())))
+        self.assertEqual(
+            [int(row['id']) for row in rows],
+            list(Transaction.objects.order_by('pk').values_list('pk', flat=True))
+        )
+        self.assertEqual(rows[1]['amount'], '21.000000')
+        self.assertEqual(rows[1]['recipient_wallet_address'], self.profile.wallet_address)
+        self.assertEqual(rows[0]['recipient_wallet_address'], '')
+
+    def test_command_applies_filters_and_reports_throughput(self):
+        out = StringIO()
+        err = StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ledger.ndjson')
+            call_command(
+                'export_transactions', format='ndjson', output=path,
+                transaction_type='REWARD', stdout=out, stderr=err,
+            )
+            with open(path) as handle:
+                rows = [json.loads(line) for line in handle]
+
+        self.assertEqual([row['transaction_type'] for row in rows], ['REWARD', 'REWARD'])
+        self.assertIn('Exported 2 transactions', err.getvalue())
+        self.assertIn('rows/sec', err.getvalue())
+
+    def test_endpoint_streams_ndjson(self):
+        client = APIClient()
+        client.force_authenticate(user=self.profile)
+
+        response = client.get(
+            reverse('transaction-export'), {'stream': 'ndjson', 'status': 'CONFIRMED'}
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['wallet_address'], self.profile.wallet_address)
+
+    def test_endpoint_rejects_unknown_format(self):
+        client = APIClient()
+        client.force_authenticate(user=self.profile)
+
+        response = client.get(reverse('transaction-export'), {'stream': 'xml'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@skipUnless(
+    os.getenv('TRANSACTION_PLAN_ROWS'),
+    'set TRANSACTION_PLAN_ROWS (e.g. 1000000) to seed and EXPLAIN a large ledger',
+)
+class TransactionIndexPlanTests(TestCase):
+    """
+    Run the ledger endpoints against a large Transaction table and EXPLAIN
+    every statement they send to it, failing on any full table scan
+
+    Seeding takes a while, so it only runs when TRANSACTION_PLAN_ROWS sets
+    the table size.
+    """
+
+    TOTAL_ROWS = int(os.getenv('TRANSACTION_PLAN_ROWS') or 1000000)
+    ROWS_PER_PROFILE = 1000
+
+    @classmethod
+    def setUpTestData(cls):
+        profile_count = max(cls.TOTAL_ROWS // cls.ROWS_PER_PROFILE, 2)
+        UserProfile.objects.bulk_create(
+            [
+                UserProfile(wallet_address=f'0x{i:040x}', current_level=1)
+                for i in range(1, profile_count + 1)
+            ],
+            batch_size=1000,
+        )
+        cls.profile = UserProfile.objects.order_by('pk').first()
+
+        now = timezone.now()
+        rows = Transaction.objects.bulk_create(
+            [
+                Transaction(
+                    user=cls.profile,
+                    transaction_type=(
+                        'REGISTRATION' if i % 10 == 0 else 'UPGRADE' if i % 5 == 0 else 'REWARD'
+                    ),
+                    amount=Decimal(i % 500 + 1),
+                    level=i % 19 + 1,
+                    transaction_hash=f'0x{i:064x}',
+                    status='PENDING' if i % 50 == 0 else 'FAILED' if i % 101 == 0 else 'CONFIRMED',
+                )
+                for i in range(cls.ROWS_PER_PROFILE)
+            ],
+            batch_size=1000,
+        )
+        # created_at is auto_now_add, so spread it over the past year afterwards
+        for i, row in enumerate(rows):
+            row.created_at = now - timedelta(hours=9 * i)
+        Transaction.objects.bulk_update(rows, ['created_at'], batch_size=1000)
+
+        # Copy the first profile's history to every other profile in one statement
+        table = connection.ops.quote_name(Transaction._meta.db_table)
+        profiles = connection.ops.quote_name(UserProfile._meta.db_table)
+        columns = ', '.join(
+            connection.ops.quote_name(column)
+            for column in (
+                'transaction_type', 'amount', 'level', 'transaction_hash',
+                'status', 'created_at', 'updated_at',
+            )
+        )
+        copied = ', '.join(f'a.{column}' for column in columns.split(', '))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (user_id, {columns}) '
+                f'SELECT p.id, {copied} FROM {table} a CROSS JOIN {profiles} p '
+                'WHERE a.user_id = %s AND p.id <> %s',
+                [cls.profile.pk, cls.profile.pk],
+            )
+            # Fresh statistics so the planner sees the real row counts; InnoDB
+            # recalculates its own after a bulk insert
+            if connection.vendor == 'sqlite':
+                cursor.execute('ANALYZE')
+            elif connection.vendor == 'postgresql':
+                cursor.execute(f'ANALYZE {table}')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.profile)
+
+    def full_scans(self, sql):
+        """Return the plan lines of a statement that read the whole table"""
+        table = Transaction._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f'{connection.ops.explain_query_prefix()} {sql}')
+            columns = [column[0] for column in cursor.description]
+            plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+        if connection.vendor == 'sqlite':
+            details = [row['detail'] for row in plan]
+            return [
+                detail for detail in details
+                if detail.split(' AS ')[0] in (f'SCAN {table}', f'SCAN TABLE {table}')
+            ]
+        if connection.vendor == 'mysql':
+            return [row for row in plan if row['table'] == table and row['type'] == 'ALL']
+        lines = [str(next(iter(row.values()))) for row in plan]
+        return [line for line in lines if f'Seq Scan on {table}' in line]
+
+    def assertNoFullScans(self, queries):
+        table = Transaction._meta.db_table
+        checked = 0
+        for query in queries:
+            sql = query['sql']
+            if table not in sql:
+                continue
+            checked += 1
+            self.assertEqual(self.full_scans(sql), [], sql)
+        self.assertGreater(checked, 0)
+
+    def get(self, url, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNoFullScans(queries.captured_queries)
+        return response
+
+    def test_dashboard_stats(self):
+        for period in ('24h', '7d', '10d'):
+            self.get(
+                reverse('userprofile-dashboard-stats', args=[self.profile.pk]),
+                {'period': period},
+            )
+
+    def test_user_transactions(self):
+        url = reverse('userprofile-transactions', args=[self.profile.pk])
+        from_date = (timezone.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+
+        self.get(url)
+        self.get(url, {'transaction_type': 'REWARD', 'from_date': from_date})
+        self.get(url, {'status': 'PENDING'})
+
+    def test_transaction_list_filters(self):
+        url = reverse('transaction-list')
+        today = timezone.now().strftime('%Y-%m-%d')
+        last_week = (timezone.now() - timedelta(days=7)).strftime('%Y-%m-%d')
+
+        for params in (
+            {},
+            {'status': 'FAILED'},
+            {'transaction_type': 'REGISTRATION'},
+            {'level': 19},
+            {'from_date': last_week, 'to_date': today},
+            {'wallet_address': self.profile.wallet_address},
+            {'wallet_address': self.profile.wallet_address, 'transaction_type': 'UPGRADE'},
+        ):
+            with self.subTest(**params):
+                self.get(url, params)
+
+    def test_transaction_hash_lookup(self):
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(Transaction.objects.filter(transaction_hash=f'0x{7:064x}'))
+
+        self.assertEqual(len(rows), self.TOTAL_ROWS // self.ROWS_PER_PROFILE)
+        self.assertNoFullScans(queries.captured_queries)
+
+
+class DailyEarningsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.root_profile = UserProfile.objects.create(
+            wallet_address=settings.ROOT_USER_ADDRESS,
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        invalidate_company_wallet()
+        self.user1_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            referrer_profile=self.root_profile
+        )
+        Level.objects.create(level_number=2, price=150, min_direct_referrals=0, min_referral_depth=0)
+        ReferralService.upgrade_user_level(
+            self.user1_profile, 2, transaction_hash='0x' + 'a' * 64
+        )
+
+    def expected_rollup(self):
+        return {
+            (user_id, transaction_type, day): (total, count)
+            for user_id, transaction_type, day, total, count in Transaction.objects.annotate(
+                day=TruncDate('created_at')
+            )
+            .order_by()
+            .values_list('user_id', 'transaction_type', 'day')
+            .annotate(total=Sum('amount'), count=Count('pk'))
+        }
+
+    def stored_rollup(self):
+        return {
+            (user_id, transaction_type, day): (total, count)
+            for user_id, transaction_type, day, total, count in DailyEarnings.objects.values_list(
+                'user_id', 'transaction_type', 'day', 'total', 'count'
+            )
+        }
+
+    def add_reward(self, amount, age):
+        tx = Transaction.objects.create(
+            user=self.root_profile,
+            transaction_type='REWARD',
+            amount=amount,
+            level=2,
+            status='CONFIRMED',
+        )
+        Transaction.objects.filter(pk=tx.pk).update(created_at=timezone.now() - age)
+
+    def test_upgrade_updates_rollup(self):
+        # Company fee and upline reward both go to the root on the same day
+        self.assertEqual(
+            self.stored_rollup(),
+            {
+                (self.user1_profile.pk, 'UPGRADE', timezone.localdate()): (Decimal(150), 1),
+                (self.root_profile.pk, 'REWARD', timezone.localdate()): (Decimal(150), 2),
+            }
+        )
+        self.assertEqual(self.stored_rollup(), self.expected_rollup())
+
+    def test_rollup_write_is_one_upsert(self):
+        rows = list(Transaction.objects.all())
+        # A day without a rollup row yet next to rows that already have one
+        earlier = Transaction(
+            user=self.root_profile,
+            transaction_type='REWARD',
+            amount=Decimal('2.5'),
+            created_at=timezone.now() - timedelta(days=2),
+        )
+
+        with self.assertNumQueries(1):
+            record_transactions(rows * 5 + [earlier])
+
+        rewards = dict(
+            DailyEarnings.objects.filter(user=self.root_profile).values_list('day', 'count')
+        )
+        self.assertEqual(
+            rewards,
+            {timezone.localdate(): 2 * 6, timezone.localdate(earlier.created_at): 1}
+        )
+        self.assertEqual(
+            DailyEarnings.objects.get(user=self.root_profile, day=earlier.created_at.date()).total,
+            Decimal('2.5')
+        )
+
+    def test_dashboard_stats_sums_rollup(self):
+        self.add_reward(10, timedelta(hours=23))
+        self.add_reward(20, timedelta(hours=25))
+        self.add_reward(40, timedelta(days=8))
+        call_command('backfill_daily_earnings', stdout=StringIO())
+        client = APIClient()
+        client.force_authenticate(user=self.root_profile)
+        url = reverse('userprofile-dashboard-stats', args=[self.root_profile.pk])
+
+        for period, expected in (('24h', 160), ('7d', 180), ('10d', 220)):
+            with self.subTest(period=period):
+                response = client.get(url, {'period': period})
+
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.data['total_earnings'], 220)
+                self.assertEqual(response.data['period_earnings'], expected)
+
+    def test_backfill_rebuilds_drifted_rollup(self):
+        self.add_reward(10, timedelta(days=3))
+        DailyEarnings.objects.filter(transaction_type='UPGRADE').delete()
+        DailyEarnings.objects.update(total=0, count=0)
+
+        call_command('backfill_daily_earnings', batch_size=1, stdout=StringIO())
+
+        self.assertEqual(self.stored_rollup(), self.expected_rollup())
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.root_profile = UserProfile.objects.create(
+            wallet_address=settings.ROOT_USER_ADDRESS,
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        invalidate_company_wallet()
+        self.user1_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            referrer_profile=self.root_profile
+        )
+        Level.objects.create(level_number=2, price=150, min_direct_referrals=0, min_referral_depth=0)
+        self.tx_hash = '0x' + 'd' * 64
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user1_profile)
+
+    def statements(self, queries):
+        return [
+            query['sql'] for query in queries.captured_queries
+            if 'SAVEPOINT' not in query['sql']
+        ]
+
+    def upgrade(self, tx_hash=None):
+        return self.client.post(
+            reverse('upgrade-list'),
+            {
+                'wallet_address': self.user1_profile.wallet_address,
+                'target_level': 2,
+                'transaction_hash': tx_hash or self.tx_hash,
+            },
+            format='json',
+        )
+
+    @patch('myapp.views.get_blockchain_service')
+    def test_replayed_upgrade_returns_stored_result(self, blockchain_service):
+        blockchain_service.return_value.verify_transaction.return_value = {
+            'status': 'success',
+            'transaction_hash': self.tx_hash,
+        }
+        first = self.upgrade()
+        self.assertEqual(first.status_code, status.HTTP_200_OK, first.data)
+        blockchain_service.reset_mock()
+
+        # Retried with a differently cased hash: one indexed read, no RPC;
+        # the view's atomic block only shows up as a savepoint inside the test
+        with CaptureQueriesContext(connection) as queries:
+            replay = self.upgrade(self.tx_hash.upper().replace('0X', '0x'))
+
+        self.assertEqual(len(self.statements(queries)), 1, self.statements(queries))
+        self.assertEqual(replay.status_code, status.HTTP_200_OK)
+        self.assertEqual(replay.data, first.data)
+        blockchain_service.assert_not_called()
+        self.assertEqual(Transaction.objects.filter(transaction_type='UPGRADE').count(), 1)
+        self.assertEqual(IdempotencyRecord.objects.get().operation, 'UPGRADE')
+
+    def test_hash_of_another_wallet_is_rejected(self):
+        IdempotencyRecord.objects.create(
+            transaction_hash=self.tx_hash,
+            operation='UPGRADE',
+            user=self.root_profile,
+            status_code=200,
+            response={'message': 'Level upgrade successful'},
+        )
+
+        response = self.upgrade()
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertFalse(Transaction.objects.filter(transaction_type='UPGRADE').exists())
+
+    @patch('myapp.views.get_blockchain_service')
+    def test_replayed_registration_returns_stored_result(self, blockchain_service):
+        tx_hash = '0x' + 'e' * 64
+        blockchain_service.return_value.verify_transaction.return_value = {
+            'status': 'success',
+            'transaction_hash': tx_hash,
+        }
+        profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000003',
+            referrer=self.user1_profile,
+            username='newuser',
+            phone_number='123456789',
+            country='NP',
+        )
+        ReferralService.create_referral_relationships(profile, self.user1_profile)
+        self.client.force_authenticate(user=profile)
+        payload = {'wallet_address': profile.wallet_address, 'transaction_hash': tx_hash}
+
+        first = self.client.post(reverse('register-list'), payload, format='json')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED, first.data)
+        blockchain_service.reset_mock()
+        with CaptureQueriesContext(connection) as queries:
+            replay = self.client.post(reverse('register-list'), payload, format='json')
+
+        self.assertEqual(len(self.statements(queries)), 1, self.statements(queries))
+        self.assertEqual(replay.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(replay.data, first.data)
+        blockchain_service.assert_not_called()
+
+
+class StubNodeHandler(BaseHTTPRequestHandler):
+    """Minimal keep-alive JSON-RPC node counting connections, posts and calls"""
+
+    protocol_version = 'HTTP/1.1'
+    results = {
+        'web3_clientVersion': 'stub/v1',
+        'eth_chainId': '0x7a69',
+        'eth_blockNumber': '0x10',
+        'eth_getTransactionReceipt': {'status': '0x1', 'blockNumber': '0x10'},
+        'eth_getTransactionByHash': {'hash': '0x' + 'ab' * 32, 'blockNumber': None},
+        'eth_getTransactionCount': '0x5',
+        'eth_gasPrice': '0x3b9aca00',
+        'eth_estimateGas': '0x186a0',
+        'eth_sendRawTransaction': '0x' + 'ab' * 32,
+    }
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def answer(self, request):
+        self.server.calls.append(request['method'])
+        response = {'jsonrpc': '2.0', 'id': request['id']}
+        # node.errors fails calls by method, or by their first (hash) parameter
+        params = request.get('params') or [None]
+        key = params[0] if isinstance(params[0], str) and params[0] in self.server.errors else request['method']
+        if key in self.server.errors:
+            response['error'] = {'code': -32000, 'message': self.server.errors[key]}
+        elif request['method'] == 'eth_getTransactionReceipt' and self.server.receipts is not None:
+            response['result'] = self.server.receipts.get(request['params'][0])
+        else:
+            response['result'] = self.server.results[request['method']]
+        return response
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.posts += 1
+        time.sleep(self.server.delay)
+        if isinstance(request, list):
+            body = json.dumps([self.answer(item) for item in reversed(request)]).encode()
+        else:
+            body = json.dumps(self.answer(request)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubNodeMixin:
+    """Run a StubNodeHandler node and point the blockchain settings at it"""
+
+    def setUp(self):
+        self.node = ThreadingHTTPServer(('127.0.0.1', 0), StubNodeHandler)
+        self.node.connections, self.node.posts, self.node.calls, self.node.errors = 0, 0, [], {}
+        self.node.delay = 0
+        # Per-test overrides: node.results answers by method, node.receipts
+        # (when set) by transaction hash, with None for unmined ones
+        self.node.results, self.node.receipts = dict(StubNodeHandler.results), None
+        threading.Thread(target=self.node.serve_forever, daemon=True).start()
+        self.addCleanup(self.node.server_close)
+        self.addCleanup(self.node.shutdown)
+
+        abi_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        json.dump([
+            {
+                'type': 'function', 'name': 'register', 'stateMutability': 'payable',
+                'inputs': [{'name': 'referrer', 'type': 'address'}], 'outputs': [],
+            },
+            {
+                'type': 'function', 'name': 'upgradeLevel', 'stateMutability': 'payable',
+                'inputs': [
+                    {'name': 'newLevel', 'type': 'uint256'},
+                    {'name': 'upline', 'type': 'address'},
+                ],
+                'outputs': [],
+            },
+        ], abi_file)
+        abi_file.close()
+        self.addCleanup(os.unlink, abi_file.name)
+
+        overrides = override_settings(
+            WEB3_PROVIDER_URL=f'http://127.0.0.1:{self.node.server_port}',
+            CONTRACT_ABI_PATH=abi_file.name,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        reset_blockchain_service()
+        self.addCleanup(reset_blockchain_service)
+        reset_async_blockchain_service()
+        self.addCleanup(reset_async_blockchain_service)
+
+
+class SharedBlockchainServiceTests(StubNodeMixin, TestCase):
+    def test_service_is_built_once_per_process(self):
+        with patch(
+            'myapp.services.blockchain.BlockchainService', wraps=BlockchainService
+        ) as build:
+            first = get_blockchain_service()
+            second = get_blockchain_service()
+
+        self.assertIs(first, second)
+        self.assertEqual(build.call_count, 1)
+
+    def test_health_check_is_skipped_while_calls_succeed(self):
+        service = get_blockchain_service()
+        self.assertEqual(self.node.calls, ['web3_clientVersion'])
+
+        for _ in range(3):
+            get_blockchain_service().verify_transaction('0x' + 'a' * 64)
+
+        # No probe after the first, and one keep-alive connection for all calls
+        self.assertEqual(self.node.calls, ['web3_clientVersion'] + ['eth_getTransactionReceipt'] * 3)
+        self.assertEqual(self.node.connections, 1)
+        self.assertIs(get_blockchain_service(), service)
+
+    def test_unreachable_node_raises_connection_error(self):
+        with override_settings(WEB3_PROVIDER_URL='http://127.0.0.1:1'):
+            with self.assertRaisesMessage(ConnectionError, 'Cannot connect to Ethereum node'):
+                get_blockchain_service()
+
+        # Switching the settings back rebuilds a service for the live node
+        self.assertEqual(get_blockchain_service().web3_provider_url, settings.WEB3_PROVIDER_URL)
+
+    def prepare_register(self):
+        service = get_blockchain_service()
+        self.node.posts, self.node.calls = 0, []
+        return service.build_register_transaction(
+            '0x0000000000000000000000000000000000000002',
+            settings.ROOT_USER_ADDRESS,
+        )
+
+    def test_prepare_reads_nonce_and_gas_price_in_one_batch(self):
+        transaction = self.prepare_register()
+
+        self.assertEqual(self.node.posts, 1)
+        self.assertEqual(sorted(self.node.calls), ['eth_gasPrice', 'eth_getTransactionCount'])
+        self.assertEqual(transaction['nonce'], '0x5')
+        self.assertEqual(transaction['gasPrice'], '0x3b9aca00')
+        self.assertEqual(transaction['gas'], hex(2000000))
+
+        # With the gas price cached only the nonce is read
+        self.node.posts, self.node.calls = 0, []
+        get_blockchain_service().build_upgrade_transaction(
+            '0x0000000000000000000000000000000000000002', 2, settings.ROOT_USER_ADDRESS
+        )
+        self.assertEqual((self.node.posts, self.node.calls), (1, ['eth_getTransactionCount']))
+
+    @override_settings(ESTIMATE_GAS=True)
+    def test_gas_limit_is_estimated_in_the_same_batch(self):
+        transaction = self.prepare_register()
+
+        self.assertEqual(self.node.posts, 1)
+        self.assertIn('eth_estimateGas', self.node.calls)
+        self.assertEqual(transaction['gas'], hex(int(100000 * 1.2)))
+
+    @override_settings(ESTIMATE_GAS=True)
+    def test_failed_estimate_falls_back_to_default_gas_limit(self):
+        self.node.errors['eth_estimateGas'] = 'execution reverted: Already registered'
+
+        transaction = self.prepare_register()
+
+        self.assertEqual(transaction['gas'], hex(2000000))
+
+    def test_nonce_error_is_raised(self):
+        self.node.errors['eth_getTransactionCount'] = 'header not found'
+
+        with self.assertRaises(ValueError):
+            self.prepare_register()
+
+
+class FakeEth:
+    def __init__(self):
+        self.gas_price_calls = 0
+        self.next_price = 100
+
+    @property
+    def gas_price(self):
+        self.gas_price_calls += 1
+        return self.next_price
+
+    def fee_history(self, block_count, newest_block, percentiles):
+        return {
+            'baseFeePerGas': [10, 20, 30, 40],
+            'reward': [[1], [2], [6]][:block_count],
+        }
+
+
+class GasPriceOracleTests(TestCase):
+    def setUp(self):
+        self.w3 = MagicMock(eth=FakeEth())
+        self.now = 1000.0
+        clock = patch('myapp.services.blockchain.time.monotonic', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def test_price_is_cached_for_the_ttl(self):
+        oracle = GasPriceOracle(self.w3, ttl=15)
+
+        self.assertEqual([oracle.get() for _ in range(5)], [100] * 5)
+
+        self.assertEqual(self.w3.eth.gas_price_calls, 1)
+        metrics = oracle.metrics()
+        self.assertEqual((metrics['misses'], metrics['hits']), (1, 4))
+        self.assertEqual(metrics['hit_ratio'], 0.8)
+
+    def test_stale_price_is_served_while_refreshing_in_background(self):
+        oracle = GasPriceOracle(self.w3, ttl=15)
+        oracle.get()
+        self.w3.eth.next_price = 120
+        self.now += 20
+
+        with patch('myapp.services.blockchain.threading.Thread') as thread:
+            self.assertEqual(oracle.get(), 100)
+            self.assertEqual(oracle.get(), 100)
+        # One refresh for both stale lookups, run here instead of in a thread
+        thread.assert_called_once()
+        thread.call_args.kwargs['target']()
+
+        self.assertEqual(oracle.get(), 120)
+        self.assertEqual(oracle.metrics()['stale_hits'], 2)
+        self.assertFalse(oracle.refreshing)
+
+    def test_price_too_old_is_refetched_inline(self):
+        oracle = GasPriceOracle(self.w3, ttl=15)
+        oracle.get()
+        self.w3.eth.next_price = 120
+        self.now += 15 * 4
+
+        self.assertEqual(oracle.get(), 120)
+        self.assertEqual(oracle.metrics()['misses'], 2)
+
+    def test_failed_background_refresh_keeps_the_cached_price(self):
+        oracle = GasPriceOracle(self.w3, ttl=15)
+        oracle.get()
+        oracle.fetch = MagicMock(side_effect=ConnectionError('node down'))
+        self.now += 20
+
+        with patch('myapp.services.blockchain.threading.Thread') as thread:
+            self.assertEqual(oracle.get(), 100)
+        with self.assertLogs('myapp.services.blockchain', 'WARNING'):
+            thread.call_args.kwargs['target']()
+
+        self.assertEqual(oracle.metrics()['errors'], 1)
+        self.assertFalse(oracle.refreshing)
+
+    def test_smoothed_price_is_pending_base_fee_plus_mean_tip(self):
+        oracle = GasPriceOracle(self.w3, ttl=15, smoothing_blocks=3)
+
+        self.assertEqual(oracle.get(), 40 + 3)
+        self.assertEqual(self.w3.eth.gas_price_calls, 0)
+
+    def test_batched_fee_history_result_is_smoothed(self):
+        oracle = GasPriceOracle(self.w3, ttl=15, smoothing_blocks=3)
+        self.assertEqual(oracle.rpc_call(), ('eth_feeHistory', ['0x3', 'latest', [50]]))
+
+        oracle.store_rpc_result({
+            'baseFeePerGas': ['0xa', '0x14', '0x1e', '0x28'],
+            'reward': [['0x1'], ['0x2'], ['0x6']],
+        })
+
+        self.assertEqual(oracle.get(), 40 + 3)
+
+
+class AsyncBlockchainServiceTests(StubNodeMixin, TestCase):
+    async def test_verifications_run_concurrently_on_one_loop(self):
+        self.node.delay = 0.2
+        service = await get_async_blockchain_service()
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(
+            service.verify_transaction('0x' + f'{i:064x}') for i in range(50)
+        ))
+        elapsed = time.perf_counter() - started
+
+        self.assertEqual({result['status'] for result in results}, {'success'})
+        # 50 serial calls would take 10s
+        self.assertLess(elapsed, 3)
+
+    async def test_unknown_hash_is_not_found_and_unmined_one_pending(self):
+        self.node.receipts = {}
+        service = await get_async_blockchain_service()
+
+        pending = await service.verify_transaction('0x' + 'a' * 64)
+        self.node.results['eth_getTransactionByHash'] = None
+        unknown = await service.verify_transaction('0x' + 'a' * 64)
+
+        self.assertEqual(pending['status'], 'pending')
+        self.assertEqual(unknown['status'], 'not_found')
+
+    async def test_prepare_reads_nonce_and_gas_price(self):
+        service = await get_async_blockchain_service()
+        self.node.posts = 0
+
+        transaction = await service.build_upgrade_transaction(
+            '0x0000000000000000000000000000000000000002', 2, settings.ROOT_USER_ADDRESS
+        )
+
+        self.assertEqual(transaction['nonce'], '0x5')
+        self.assertEqual(transaction['gasPrice'], '0x3b9aca00')
+        self.assertEqual(transaction['value'], hex(150 * 10 ** 18))
+        self.assertEqual(self.node.posts, 1)
+
+    async def test_unreachable_node_raises_connection_error(self):
+        with override_settings(WEB3_PROVIDER_URL='http://127.0.0.1:1'):
+            with self.assertRaisesMessage(ConnectionError, 'Cannot connect to Ethereum node'):
+                await get_async_blockchain_service()
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.root_profile = UserProfile.objects.create(
+            wallet_address=settings.ROOT_USER_ADDRESS,
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        invalidate_company_wallet()
+        self.user1_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            referrer_profile=self.root_profile
+        )
+        Level.objects.create(level_number=2, price=150, min_direct_referrals=0, min_referral_depth=0)
+        self.tx_hash = '0x' + '9' * 64
+
+    def authorization(self, profile):
+        tokens = Web3AuthBackend.generate_tokens(profile.wallet_address)
+        return {'Authorization': f'Bearer {tokens["access_token"]}'}
+
+    def blockchain_service(self):
+        service = MagicMock()
+        service.verify_transaction = AsyncMock(return_value={
+            'status': 'success',
+            'transaction_hash': self.tx_hash,
+        })
+        return AsyncMock(return_value=service)
+
+    async def test_upgrade_awaits_verification(self):
+        headers = await sync_to_async(self.authorization)(self.user1_profile)
+        with patch('myapp.async_views.get_async_blockchain_service', self.blockchain_service()):
+            response = await self.async_client.post(
+                reverse('async-upgrade'),
+                {
+                    'wallet_address': self.user1_profile.wallet_address,
+                    'transaction_hash': self.tx_hash,
+                },
+                content_type='application/json',
+                headers=headers,
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        self.assertEqual(response.json()['new_level'], 2)
+        profile = await UserProfile.objects.aget(pk=self.user1_profile.pk)
+        self.assertEqual(profile.current_level, 2)
+
+    async def test_registration_awaits_verification(self):
+        profile = await UserProfile.objects.acreate(
+            wallet_address='0x0000000000000000000000000000000000000003',
+            referrer=self.user1_profile,
+            username='newuser',
+            phone_number='123456789',
+            country='NP',
+        )
+        await sync_to_async(ReferralService.create_referral_relationships)(
+            profile, self.user1_profile
+        )
+        headers = await sync_to_async(self.authorization)(profile)
+        with patch('myapp.async_views.get_async_blockchain_service', self.blockchain_service()):
+            response = await self.async_client.post(
+                reverse('async-register'),
+                {'wallet_address': profile.wallet_address, 'transaction_hash': self.tx_hash},
+                content_type='application/json',
+                headers=headers,
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
+        self.assertEqual(
+            await Transaction.objects.filter(transaction_hash=self.tx_hash).acount(), 3
+        )
+
+    async def test_requires_authentication(self):
+        response = await self.async_client.post(
+            reverse('async-upgrade'),
+            {'wallet_address': self.user1_profile.wallet_address},
+            content_type='application/json',
+        )
+
+        self.assertIn(
+            response.status_code, (status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN)
+        )
+
+
+class ConfirmationTrackerTests(StubNodeMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.root_profile = UserProfile.objects.create(
+            wallet_address=settings.ROOT_USER_ADDRESS,
+            current_level=19,
+            is_registered_on_chain=True
+        )
+        invalidate_company_wallet()
+        self.user1_profile = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000002',
+            referrer_profile=self.root_profile
+        )
+        Level.objects.create(level_number=2, price=150, min_direct_referrals=0, min_referral_depth=0)
+        self.tx_hash = '0x' + 'c' * 64
+        self.node.receipts = {}
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user1_profile)
+
+    def upgrade(self):
+        return self.client.post(
+            reverse('upgrade-list'),
+            {
+                'wallet_address': self.user1_profile.wallet_address,
+                'target_level': 2,
+                'transaction_hash': self.tx_hash,
+            },
+            format='json',
+        )
+
+    def track(self, **options):
+        out = StringIO()
+        call_command('track_confirmations', once=True, stdout=out, **options)
+        return out.getvalue()
+
+    def mine(self, tx_hash, block='0x10', status='0x1'):
+        self.node.receipts[tx_hash] = {'status': status, 'blockNumber': block}
+
+    def test_submit_returns_without_waiting_for_receipt(self):
+        service = get_blockchain_service()
+
+        result = service.submit_transaction('0x' + '01' * 100)
+
+        self.assertEqual(result, {'status': 'pending', 'transaction_hash': '0x' + 'ab' * 32})
+        self.assertEqual(self.node.calls, ['web3_clientVersion', 'eth_sendRawTransaction'])
+
+    def test_pending_upgrade_is_settled_by_tracker(self):
+        response = self.upgrade()
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED, response.data)
+        self.assertEqual(response.data['status'], 'PENDING')
+        # Resubmitting the hash while it is unmined keeps the one row
+        self.assertEqual(self.upgrade().status_code, status.HTTP_202_ACCEPTED)
+        pending = Transaction.objects.get(transaction_hash=self.tx_hash)
+        self.assertEqual(pending.status, 'PENDING')
+        self.user1_profile.refresh_from_db()
+        self.assertEqual(self.user1_profile.current_level, 1)
+
+        self.assertIn('still pending 1', self.track())
+
+        self.mine(self.tx_hash)
+        self.assertIn('Confirmed 1, failed 0', self.track())
+
+        pending.refresh_from_db()
+        self.assertEqual(pending.status, 'CONFIRMED')
+        self.user1_profile.refresh_from_db()
+        self.assertEqual(self.user1_profile.current_level, 2)
+        self.assertEqual(Transaction.objects.filter(transaction_hash=self.tx_hash).count(), 3)
+        self.assertTrue(DailyEarnings.objects.filter(transaction_type='UPGRADE').exists())
+
+        # The client polling with the hash now gets the final result
+        self.node.calls.clear()
+        replay = self.upgrade()
+        self.assertEqual(replay.status_code, status.HTTP_200_OK)
+        self.assertEqual(replay.data['new_level'], 2)
+        self.assertEqual(self.node.calls, [])
+
+    def test_hash_pending_for_another_wallet_is_refused(self):
+        other = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000003',
+            referrer_profile=self.root_profile
+        )
+        pending = record_pending(other, 'UPGRADE', 2, 150, self.tx_hash)
+
+        response = self.upgrade()
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT, response.data)
+        self.assertEqual(
+            list(Transaction.objects.filter(transaction_hash=self.tx_hash)), [pending]
+        )
+        pending.refresh_from_db()
+        self.assertEqual((pending.user, pending.status), (other, 'PENDING'))
+
+    def test_hash_unknown_to_the_node_is_not_recorded(self):
+        self.node.results['eth_getTransactionByHash'] = None
+
+        response = self.upgrade()
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, response.data)
+        self.assertEqual(response.data['details']['status'], 'not_found')
+        self.assertFalse(Transaction.objects.filter(transaction_hash=self.tx_hash).exists())
+
+    def test_receipts_are_read_in_batches(self):
+        self.upgrade()
+        self.node.posts = 0
+        self.node.calls.clear()
+
+        self.track(batch_size=100)
+
+        self.assertEqual(self.node.posts, 1)
+        self.assertEqual(sorted(self.node.calls), ['eth_blockNumber', 'eth_getTransactionReceipt'])
+
+    @override_settings(CONFIRMATION_BLOCKS=3)
+    def test_waits_for_confirmation_depth(self):
+        self.mine(self.tx_hash, block='0x10')
+        self.node.results['eth_blockNumber'] = '0x11'
+
+        # Two confirmations out of three: the view also answers 202
+        self.assertEqual(self.upgrade().status_code, status.HTTP_202_ACCEPTED)
+        self.assertIn('Confirmed 0, failed 0, still pending 1', self.track())
+
+        self.node.results['eth_blockNumber'] = '0x12'
+        self.assertIn('Confirmed 1', self.track())
+        self.assertEqual(
+            Transaction.objects.get(transaction_hash=self.tx_hash, recipient=None).status,
+            'CONFIRMED',
+        )
+
+    def test_reverted_transaction_is_failed(self):
+        self.upgrade()
+        self.mine(self.tx_hash, status='0x0')
+
+        self.assertIn('failed 1', self.track())
+
+        self.assertEqual(Transaction.objects.get(transaction_hash=self.tx_hash).status, 'FAILED')
+        self.user1_profile.refresh_from_db()
+        self.assertEqual(self.user1_profile.current_level, 1)
+        self.assertEqual(self.upgrade().status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    def test_row_failing_to_settle_does_not_block_later_rows(self):
+        other = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000003',
+            referrer_profile=self.root_profile
+        )
+        other_hash = '0x' + 'e' * 64
+        self.upgrade()
+        record_pending(other, 'UPGRADE', 2, 150, other_hash)
+        self.mine(self.tx_hash)
+        self.mine(other_hash)
+
+        def settle(profile, *args, **kwargs):
+            if profile.pk == self.user1_profile.pk:
+                raise Level.DoesNotExist('Level matching query does not exist.')
+            return settle_upgrade(profile, *args, **kwargs)
+
+        with patch('myapp.services.confirmations.settle_upgrade', side_effect=settle):
+            with self.assertLogs('myapp.services.confirmations', 'ERROR'):
+                self.assertIn('Confirmed 1, failed 0, still pending 0, errors 1', self.track())
+
+            self.assertEqual(Transaction.objects.get(transaction_hash=self.tx_hash).status, 'PENDING')
+            self.assertEqual(
+                Transaction.objects.get(transaction_hash=other_hash, recipient=None).status,
+                'CONFIRMED'
+            )
+
+            # Given up on like an unmined transaction once it is too old
+            with self.assertLogs('myapp.services.confirmations', 'ERROR'):
+                self.assertIn('failed 1', self.track(timeout=-1))
+        self.assertEqual(Transaction.objects.get(transaction_hash=self.tx_hash).status, 'FAILED')
+
+    def test_receipt_error_skips_only_its_row(self):
+        other = ReferralService.register_user(
+            wallet_address='0x0000000000000000000000000000000000000003',
+            referrer_profile=self.root_profile
+        )
+        other_hash = '0x' + 'e' * 64
+        self.upgrade()
+        record_pending(other, 'UPGRADE', 2, 150, other_hash)
+        self.mine(other_hash)
+        self.node.errors[self.tx_hash] = 'header not found'
+
+        with self.assertLogs('myapp.services.confirmations', 'ERROR'):
+            self.assertIn('Confirmed 1, failed 0, still pending 0, errors 1', self.track())
+
+        self.assertEqual(Transaction.objects.get(transaction_hash=self.tx_hash).status, 'PENDING')
+        self.assertEqual(
+            Transaction.objects.get(transaction_hash=other_hash, recipient=None).status,
+            'CONFIRMED'
+        )
+
+    def test_unmined_transaction_times_out(self):
+        self.upgrade()
+        Transaction.objects.filter(transaction_hash=self.tx_hash).update(
+            created_at=timezone.now() - timedelta(hours=2)
+        )
+
+        self.assertIn('still pending 1', self.track(timeout=3 * 3600))
+        self.assertIn('failed 1', self.track(timeout=3600))
+
+        self.assertEqual(Transaction.objects.get(transaction_hash=self.tx_hash).status, 'FAILED')
+
+    def test_signed_registration_is_settled_by_tracker(self):
+        profile = UserProfile.objects.create(
+            wallet_address='0x0000000000000000000000000000000000000003',
+            referrer=self.user1_profile,
+            username='newuser',
+            phone_number='123456789',
+            country='NP',
+        )
+        ReferralService.create_referral_relationships(profile, self.user1_profile)
+        self.client.force_authenticate(user=profile)
+
+        response = self.client.post(
+            reverse('register-list'),
+            {'wallet_address': profile.wallet_address, 'signed_transaction': '0x' + '01' * 100},
+            format='json',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED, response.data)
+        tx_hash = response.data['transaction_hash']
+        self.assertEqual(tx_hash, '0x' + 'ab' * 32)
+        self.assertNotIn('eth_getTransactionReceipt', self.node.calls)
+
+        self.mine(tx_hash)
+        self.assertIn('Confirmed 1', self.track())
+
+        profile.refresh_from_db()
+        self.assertTrue(profile.is_registered_on_chain)
+        self.assertEqual(profile.current_level, 1)
+        registration = Transaction.objects.get(transaction_type='REGISTRATION', user=profile)
+        self.assertEqual(registration.pk, response.data['transaction_id'])
+        self.assertEqual(registration.status, 'CONFIRMED')
+        self.assertEqual(Transaction.objects.filter(transaction_hash=tx_hash).count(), 3)
+        self.user1_profile.refresh_from_db()
+        self.assertEqual(self.user1_profile.direct_referrals_count, 1)
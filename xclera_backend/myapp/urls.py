@@ -5,6 +5,7 @@ from .views import (
     RegistrationView, UpgradeLevelView, LoginView
 )
 from .auth_views import NonceView, AuthenticateView, VerifyTokenView,RefreshTokenView
+from .async_views import AsyncRegistrationView, AsyncUpgradeLevelView
 
 router = DefaultRouter()
 router.register(r'profiles', UserProfileViewSet)
@@ -16,6 +17,10 @@ router.register(r'login', LoginView, basename='login')
 
 
 urlpatterns = [
+    # Async variants of the registration and upgrade endpoints, for ASGI servers
+    path('api/async/register/', AsyncRegistrationView.as_view(), name='async-register'),
+    path('api/async/upgrade/', AsyncUpgradeLevelView.as_view(), name='async-upgrade'),
+
     # API endpoints
     path('api/', include(router.urls)),
     
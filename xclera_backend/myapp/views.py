@@ -2,9 +2,16 @@ from rest_framework import viewsets, status
 from rest_framework import permissions
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 from django.db import transaction
 from blockchain.settings import ROOT_USER_ADDRESS
-from .models import UserProfile, Level, Transaction, ReferralRelationship
+from .models import (
+    UserProfile,
+    Level,
+    Transaction,
+    ReferralRelationship,
+    DownlineLevelCount,
+)
 from .serializers import (
     LoginSerializer,
     UserProfileSerializer,
@@ -13,12 +20,33 @@ from .serializers import (
     ReferralRelationshipSerializer,
     ProfileUpdateSerializer,
 )
-from .services.blockchain import BlockchainService
-from .services.referral import ReferralService, get_company_wallet_profile
+from .pagination import DownlinePagination, TransactionPagination
+from .services.blockchain import get_blockchain_service
+from .services.referral import ReferralService
+from .services import referral_graph
+from .services.referral_storage import get_referral_storage
+from .services.earnings import earnings_totals
+from .services.level_catalog import get_level_catalog
+from .services.idempotency import stored_result
+from .services.ledger import (
+    EXPORT_FORMATS,
+    filter_transactions,
+    record_pending,
+    stream_ledger,
+)
+from .services.settlement import (
+    REGISTRATION_TOTAL_FEE,
+    settle_registration,
+    settle_upgrade,
+)
 from django.utils.dateparse import parse_date
-from datetime import timedelta, datetime
+from django.utils.http import parse_etags
+from datetime import timedelta
 from django.utils import timezone
-from django.db.models import Q,Sum
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+import json
 
 
 class LoginView(viewsets.ViewSet):
@@ -84,41 +112,14 @@ class LoginView(viewsets.ViewSet):
                     current_level=0,  # Level 0 until officially registered
                     is_registered_on_chain=False,
                 )
+                referral_graph.track_new_profile(profile)
 
                 # Establish referral relationships right away for Level 0 users
                 if referrer_profile:
-                    # Create direct referral relationship (Level 1)
-                    ReferralRelationship.objects.create(
-                        user=profile, upline=referrer_profile, level=1
+                    ReferralService.create_referral_relationships(
+                        profile, referrer_profile
                     )
 
-                    # Build referral tree by adding all uplines at their respective levels
-                    current_upline = referrer_profile
-                    level = 2
-                    processed_uplines = set()
-
-                    while current_upline and current_upline.referrer:
-                        # Create relationship to this upline
-                        if (
-                            current_upline.referrer.id in processed_uplines
-                            or current_upline.referrer.pk == profile.pk
-                        ):
-                            break
-                        processed_uplines.add(current_upline.referrer.id)
-                        if not ReferralRelationship.objects.filter(
-                            user=profile, upline=current_upline.referrer
-                        ).exists():
-                            ReferralRelationship.objects.create(
-                                user=profile,
-                                upline=current_upline.referrer,
-                                level=level,
-                            )
-
-                        # Move up the tree
-                        current_upline = current_upline.referrer
-                        level += 1
-
-
                 return Response(
                     {
                         "message": "New profile created",
@@ -167,47 +168,25 @@ class UserProfileViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=["get"])
     def transactions(self, request, pk=None):
-        """Get transactions for a user with filtering support"""
+        """
+        Get transactions for a user, newest first, paginated by
+        (created_at, id) with the same filters as /api/transactions/
+        """
         profile = self.get_object()
-        
+        paginator = TransactionPagination()
+
         # Only get transactions where the current user is the primary user (not as recipient)
         # For a complete financial picture, we only need the transactions where the user
         # is the main actor (paying or receiving)
-        queryset = Transaction.objects.filter(user=profile).order_by("-created_at")
-        
-        # Apply filters
-        transaction_type = request.query_params.get("transaction_type", None)
-        if transaction_type:
-            queryset = queryset.filter(transaction_type=transaction_type)
-        
-        status = request.query_params.get("status", None)
-        if status:
-            queryset = queryset.filter(status=status)
-        
-        from_date = request.query_params.get("from_date", None)
-        to_date = request.query_params.get("to_date", None)
-        
-        if from_date:
-            try:
-                from_datetime = datetime.strptime(from_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
-                queryset = queryset.filter(created_at__gte=from_datetime)
-            except ValueError:
-                pass  # Invalid date format, ignore filter
-        
-        if to_date:
-            try:
-                to_datetime = datetime.strptime(to_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59, tzinfo=timezone.utc)
-                queryset = queryset.filter(created_at__lte=to_datetime)
-            except ValueError:
-                pass  # Invalid date format, ignore filter
-        
-        level = request.query_params.get("level", None)
-        if level:
-            queryset = queryset.filter(level=level)
-                
+        queryset = filter_transactions(
+            Transaction.objects.filter(user=profile),
+            paginator.get_filter_params(request),
+        ).select_related("user", "recipient")
+
+        page = paginator.paginate_queryset(queryset, request, view=self)
         # Important: Pass the request in the context so the serializer can determine the transaction direction
-        serializer = TransactionSerializer(queryset, many=True, context={'request': request})
-        return Response(serializer.data)
+        serializer = TransactionSerializer(page, many=True, context={"request": request})
+        return paginator.get_paginated_response(serializer.data)
 
     @action(detail=True, methods=["get"])
     def dashboard_stats(self, request, pk=None):
@@ -235,30 +214,14 @@ class UserProfileViewSet(viewsets.ModelViewSet):
             referrer=profile, date_registered__gte=period_start
         ).count()
 
-        # Calculate total team size - get unique users in downline
-        # Using distinct() to avoid counting the same user multiple times
-        team_size = UserProfile.objects.filter(
-            uplines__upline=profile
-        ).distinct().count()
+        # Total team size is kept up to date as downlines join
+        team_size = profile.team_size
 
         # Verify with profile's direct_referrals_count - this should match or be investigated
         direct_referrals = profile.direct_referrals_count
 
-        # Calculate accumulated earnings (rewards received)
-        earnings = (
-            Transaction.objects.filter(
-                user=profile, transaction_type="REWARD"
-            ).aggregate(total=Sum("amount"))["total"]
-            or 0
-        )
-
-        # Calculate earnings in the selected period
-        period_earnings = (
-            Transaction.objects.filter(
-                user=profile, transaction_type="REWARD", created_at__gte=period_start
-            ).aggregate(total=Sum("amount"))["total"]
-            or 0
-        )
+        # Accumulated and period earnings (rewards received), from the daily rollup
+        earnings, period_earnings = earnings_totals(profile, period_start)
 
         return Response(
             {
@@ -274,19 +237,110 @@ class UserProfileViewSet(viewsets.ModelViewSet):
     def uplines(self, request, pk=None):
         """Get all uplines for a user"""
         profile = self.get_object()
-        relationships = ReferralRelationship.objects.filter(user=profile).order_by(
-            "level"
-        )
+        relationships = get_referral_storage().uplines(profile)
         return Response(ReferralRelationshipSerializer(relationships, many=True).data)
 
     @action(detail=True, methods=["get"])
     def downlines(self, request, pk=None):
-        """Get all downlines for a user"""
+        """
+        Get downlines for a user, paginated by (level, id)
+
+        Supports ?max_depth=N to limit how deep to go and ?stream=ndjson to
+        stream every downline as newline-delimited JSON instead of pages.
+        """
         profile = self.get_object()
-        relationships = ReferralRelationship.objects.filter(upline=profile).order_by(
-            "level"
+        paginator = DownlinePagination()
+        filters = paginator.get_filter_params(request)
+
+        max_depth = filters.get("max_depth")
+        try:
+            max_depth = int(max_depth) if max_depth else None
+        except ValueError:
+            return Response(
+                {"error": "max_depth must be an integer"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        storage = get_referral_storage()
+        if not storage.indexes_downlines:
+            return self.keyed_downlines(request, profile, storage, paginator, max_depth)
+
+        relationships = ReferralRelationship.objects.filter(
+            upline=profile
+        ).select_related("user", "upline")
+        if max_depth is not None:
+            relationships = relationships.filter(level__lte=max_depth)
+
+        if request.query_params.get("stream") == "ndjson":
+            rows = (
+                json.dumps(
+                    ReferralRelationshipSerializer(relationship).data,
+                    cls=DjangoJSONEncoder,
+                )
+                + "\n"
+                for relationship in paginator.iterate(relationships)
+            )
+            return StreamingHttpResponse(rows, content_type="application/x-ndjson")
+
+        page = paginator.paginate_queryset(relationships, request, view=self)
+        return paginator.get_paginated_response(
+            ReferralRelationshipSerializer(page, many=True).data
+        )
+
+    def keyed_downlines(self, request, profile, storage, paginator, max_depth):
+        """
+        Downlines for storages without a per-pair table, paginated by
+        (level, user id) over the keys the storage lists (from the in-memory
+        referral graph or a recursive query), one page of keys at a time
+        """
+        if request.query_params.get("stream") == "ndjson":
+            keys = storage.downline_keys(profile, max_depth)
+            rows = (
+                json.dumps(
+                    ReferralRelationshipSerializer(relationship).data,
+                    cls=DjangoJSONEncoder,
+                )
+                + "\n"
+                for start in range(0, len(keys), 1000)
+                for relationship in storage.downline_rows(
+                    profile, keys[start : start + 1000]
+                )
+            )
+            return StreamingHttpResponse(rows, content_type="application/x-ndjson")
+
+        keys = paginator.paginate_keys(
+            lambda after, limit: storage.downline_keys(profile, max_depth, after, limit),
+            request,
+        )
+        page = storage.downline_rows(profile, keys)
+        return paginator.get_paginated_response(
+            ReferralRelationshipSerializer(page, many=True).data
+        )
+
+    @action(detail=True, methods=["get"])
+    def downline_histogram(self, request, pk=None):
+        """Get the number of downlines a user has at each level of depth"""
+        profile = self.get_object()
+        level_counts = DownlineLevelCount.objects.filter(
+            upline=profile, count__gt=0
+        ).order_by("level")
+
+        max_depth = request.query_params.get("max_depth")
+        if max_depth:
+            try:
+                level_counts = level_counts.filter(level__lte=int(max_depth))
+            except ValueError:
+                return Response(
+                    {"error": "max_depth must be an integer"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+        return Response(
+            {
+                "levels": list(level_counts.values("level", "count")),
+                "team_size": profile.team_size,
+            }
         )
-        return Response(ReferralRelationshipSerializer(relationships, many=True).data)
 
     @action(detail=False, methods=["get"])
     def by_wallet(self, request):
@@ -309,24 +363,65 @@ class UserProfileViewSet(viewsets.ModelViewSet):
 
 
 class LevelViewSet(viewsets.ReadOnlyModelViewSet):
-    """API endpoint for viewing level information"""
+    """
+    API endpoint for viewing level information
+
+    Served from the in-process level catalog without database queries, with
+    an ETag so clients can revalidate with If-None-Match.
+    """
 
     queryset = Level.objects.all().order_by("level_number")
     serializer_class = LevelSerializer
 
+    def not_modified(self, request, catalog):
+        if catalog.etag in parse_etags(request.headers.get("If-None-Match", "")):
+            return Response(
+                status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": catalog.etag}
+            )
+        return None
+
+    def list(self, request, *args, **kwargs):
+        catalog = get_level_catalog()
+        not_modified = self.not_modified(request, catalog)
+        if not_modified is not None:
+            return not_modified
+
+        page = self.paginate_queryset(list(catalog.levels))
+        response = self.get_paginated_response(self.get_serializer(page, many=True).data)
+        response["ETag"] = catalog.etag
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        catalog = get_level_catalog()
+        try:
+            level = catalog.by_pk[int(kwargs["pk"])]
+        except (KeyError, ValueError):
+            raise NotFound()
+        not_modified = self.not_modified(request, catalog)
+        if not_modified is not None:
+            return not_modified
+
+        return Response(self.get_serializer(level).data, headers={"ETag": catalog.etag})
+
 
 class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
-    """API endpoint for viewing transactions with filtering"""
+    """
+    API endpoint for viewing transactions with filtering, newest first and
+    paginated by (created_at, id)
+    """
 
     queryset = Transaction.objects.all().order_by("-created_at")
     serializer_class = TransactionSerializer
+    pagination_class = TransactionPagination
 
     def get_queryset(self):
         """Allow filtering by various parameters"""
-        queryset = Transaction.objects.all().order_by("-created_at")
+        queryset = Transaction.objects.select_related("user", "recipient")
+        # Filters come from the cursor when paging on
+        filters = self.paginator.get_filter_params(self.request)
 
         # Filter by wallet address if provided
-        wallet_address = self.request.query_params.get("wallet_address", None)
+        wallet_address = filters.get("wallet_address")
         if wallet_address:
             try:
                 profile = UserProfile.objects.get(wallet_address=wallet_address)
@@ -334,340 +429,372 @@ class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
             except UserProfile.DoesNotExist:
                 return Transaction.objects.none()
 
-        # Filter by transaction type
-        transaction_type = self.request.query_params.get("transaction_type", None)
-        if transaction_type:
-            queryset = queryset.filter(transaction_type=transaction_type)
+        return filter_transactions(queryset, filters)
 
-        # Filter by status
-        status = self.request.query_params.get("status", None)
-        if status:
-            queryset = queryset.filter(status=status)
+    @action(detail=False, methods=["get"])
+    def export(self, request):
+        """
+        Stream every transaction matching the list filters as CSV, or as
+        NDJSON with ?stream=ndjson, in id order
+        """
+        output_format = request.query_params.get("stream", "csv")
+        if output_format not in EXPORT_FORMATS:
+            return Response(
+                {"error": f"stream must be one of: {', '.join(EXPORT_FORMATS)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-        # Filter by date range
-        from_date = self.request.query_params.get("from_date", None)
-        to_date = self.request.query_params.get("to_date", None)
+        response = StreamingHttpResponse(
+            stream_ledger(self.get_queryset(), output_format),
+            content_type=EXPORT_FORMATS[output_format],
+        )
+        response["Content-Disposition"] = (
+            f'attachment; filename="transactions.{output_format}"'
+        )
+        return response
 
-        if from_date:
-            # Convert string to datetime (assumes YYYY-MM-DD format)
-            from_datetime = datetime.strptime(from_date, "%Y-%m-%d").replace(
-                tzinfo=timezone.utc
-            )
-            queryset = queryset.filter(created_at__gte=from_datetime)
 
-        if to_date:
-            # Convert string to datetime and set to end of day
-            to_datetime = datetime.strptime(to_date, "%Y-%m-%d").replace(
-                hour=23, minute=59, second=59, tzinfo=timezone.utc
-            )
-            queryset = queryset.filter(created_at__lte=to_datetime)
+def replayed_response(request, operation):
+    """
+    Stored response when the submitted transaction hash was already
+    processed by this operation, so retries skip the RPC node and the
+    ledger writes; None for a new hash
+    """
+    transaction_hash = request.data.get("transaction_hash")
+    if not transaction_hash:
+        return None
+    stored = stored_result(transaction_hash, operation)
+    if stored is None:
+        return None
 
-        # Filter by level
-        level = self.request.query_params.get("level", None)
-        if level:
-            queryset = queryset.filter(level=level)
+    user_id, status_code, data = stored
+    if user_id != request.user.pk:
+        return hash_conflict_response()
+    return Response(data, status=status_code)
 
-        return queryset
 
+def hash_conflict_response():
+    """409 for a transaction hash submitted by a wallet it doesn't belong to"""
+    return Response(
+        {"error": "Transaction hash was already used by another wallet"},
+        status=status.HTTP_409_CONFLICT,
+    )
 
-class RegistrationView(viewsets.ViewSet):
-    """API endpoint for registering new users (upgrading from Level 0 to Level 1)"""
 
-    permission_classes = [permissions.IsAuthenticated]  # Require authentication
+def wallet_error(request):
+    """Error response when the request names no wallet or another user's"""
+    wallet_address = request.data.get("wallet_address")
 
-    @transaction.atomic
-    def create(self, request):
-        # Extract wallet_address from the request
-        wallet_address = request.data.get("wallet_address")
+    if not wallet_address:
+        return Response(
+            {"error": "Wallet address is required"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
 
-        if not wallet_address:
-            return Response(
-                {"error": "Wallet address is required"},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+    # Verify that the authenticated user matches the requested wallet
+    if request.user.wallet_address != wallet_address:
+        return Response(
+            {"error": "Authenticated wallet doesn't match requested wallet"},
+            status=status.HTTP_403_FORBIDDEN,
+        )
+    return None
 
-        # Verify that the authenticated user matches the requested wallet
-        if request.user.wallet_address != wallet_address:
-            return Response(
-                {"error": "Authenticated wallet doesn't match requested wallet"},
-                status=status.HTTP_403_FORBIDDEN,
-            )
 
-        try:
-            # Get the user profile
-            profile = UserProfile.objects.get(wallet_address=wallet_address)
+def registration_candidate(wallet_address):
+    """
+    Return (profile, None) for a user who may register, with its referrer
+    loaded, or (None, error response)
+    """
+    try:
+        # Get the user profile along with its referrer
+        profile = UserProfile.objects.select_related("referrer").get(
+            wallet_address=wallet_address
+        )
+    except UserProfile.DoesNotExist:
+        return None, Response(
+            {"error": "User profile not found"}, status=status.HTTP_404_NOT_FOUND
+        )
 
-            # Check if user is already registered
-            if profile.is_registered_on_chain or profile.current_level > 0:
-                return Response(
-                    {
-                        "error": f"User is already registered and already at level {profile.current_level}"
-                    },
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
+    # Check if user is already registered
+    if profile.is_registered_on_chain or profile.current_level > 0:
+        return None, Response(
+            {
+                "error": f"User is already registered and already at level {profile.current_level}"
+            },
+            status=status.HTTP_400_BAD_REQUEST,
+        )
 
-            # Check if profile is complete
-            if not profile.is_profile_complete:
-                missing_fields = []
-                for field in ["username", "phone_number", "country"]:
-                    if not getattr(profile, field):
-                        missing_fields.append(field)
+    # Check if profile is complete
+    if not profile.is_profile_complete:
+        missing_fields = []
+        for field in ["username", "phone_number", "country"]:
+            if not getattr(profile, field):
+                missing_fields.append(field)
 
-                return Response(
-                    {
-                        "error": "Profile is incomplete",
-                        "missing_fields": missing_fields,
-                    },
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
+        return None, Response(
+            {
+                "error": "Profile is incomplete",
+                "missing_fields": missing_fields,
+            },
+            status=status.HTTP_400_BAD_REQUEST,
+        )
 
-            # Get referrer from the profile
-            referrer_profile = profile.referrer
-            if not referrer_profile:
-                return Response(
-                    {"error": "No referrer found for this user"},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
+    # Get referrer from the profile
+    if not profile.referrer:
+        return None, Response(
+            {"error": "No referrer found for this user"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    return profile, None
 
-            # Check the registration mode
-            # If  tx_hahs is provided, process a completed registration
-            if "transaction_hash" in request.data:
 
-                try:
-                    # Initialize blockchain service
-                    blockchain_service = BlockchainService()
+def complete_registration(profile, transaction_hash):
+    """Record a verified registration transaction and return the response"""
+    data, status_code = settle_registration(profile, transaction_hash)
+    return Response(data, status=status_code)
 
-                    # Submit the signed transaction
-                    tx_result = blockchain_service.verify_transaction(
-                        request.data["transaction_hash"]
-                    )
-                    if tx_result["status"] == "success":
-                        # Update the user's status
-                        profile.is_registered_on_chain = True
-                        profile.current_level = 1
-                        profile.save()
-
-                        # Constants for registration fees
-                        level_fee = 100  # 100 USDT to referrer
-                        service_fee = 15  # 15 USDT service fee
-                        total_fee = level_fee + service_fee  # 115 USDT total
-
-                        # Create main registration transaction record
-                        registration_tx = Transaction.objects.create(
-                            user=profile,
-                            transaction_type="REGISTRATION",
-                            amount=total_fee,  # 115 USDT total
-                            level=1,
-                            # No recipient for the registration transaction itself
-                            transaction_hash=tx_result["transaction_hash"],
-                            status="CONFIRMED",
-                        )
-
-                        # Create reward transaction for referrer (100 USDT)
-                        referrer_tx = Transaction.objects.create(
-                            user=referrer_profile,  # Referrer receives the reward
-                            transaction_type="REWARD",
-                            amount=level_fee,  # 100 USDT
-                            level=1,
-                            recipient=profile,  # New user is the source of reward
-                            transaction_hash=tx_result["transaction_hash"],
-                            status="CONFIRMED",
-                        )
-
-                        company_wallet_profile = get_company_wallet_profile()
-                        company_tx = Transaction.objects.create(
-                            user=company_wallet_profile,  # Company wallet receives the fee
-                            transaction_type="REWARD",
-                            amount=service_fee,  # 15 USDT service fee
-                            level=1,
-                            recipient=profile,  # New user is the source of fee
-                            transaction_hash=tx_result["transaction_hash"],
-                            status="CONFIRMED",
-                        )
-
-                        # Update referrer's direct referral count
-                        referrer_profile.direct_referrals_count += 1
-                        referrer_profile.save()
-
-                        # Update max_referral_depth for each upline
-                        ReferralService.update_referral_depths(profile)
-
-                        return Response(
-                            {
-                                "message": "Registration successful",
-                                "profile_id": profile.pk,
-                                "transaction_hash": tx_result["transaction_hash"],
-                                "current_level": profile.current_level,
-                            },
-                            status=status.HTTP_201_CREATED,
-                        )
-                    else:
-                        return Response(
-                            {
-                                "error": "Blockchain registration failed",
-                                "details": tx_result,
-                            },
-                            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                        )
-                except Exception as e:
-                    return Response(
-                        {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                    )
-            else:
-                # Just prepare the transaction for the frontend to sign
-                try:
-                    # Initialize blockchain service
-                    blockchain_service = BlockchainService()
 
-                    # Build the transaction for signing
-                    transaction = blockchain_service.build_register_transaction(
-                        user_wallet=wallet_address,
-                        referrer_wallet=referrer_profile.wallet_address,
-                    )
+def pending_registration(profile, transaction_hash):
+    """Record a submitted registration transaction as PENDING, see pending_response()"""
+    return pending_response(
+        profile,
+        record_pending(profile, "REGISTRATION", 1, REGISTRATION_TOTAL_FEE, transaction_hash),
+    )
 
-                    return Response(
-                        {
-                            "message": "Transaction prepared for signing",
-                            "transaction": transaction,
-                            "instructions": "Sign this transaction with your wallet and submit the signed transaction back to this endpoint",
-                        },
-                        status=status.HTTP_200_OK,
-                    )
-                except Exception as e:
-                    return Response(
-                        {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                    )
 
-        except UserProfile.DoesNotExist:
-            return Response(
-                {"error": "User profile not found"}, status=status.HTTP_404_NOT_FOUND
-            )
+def upgrade_candidate(wallet_address):
+    """
+    Return ((profile, target level, upline wallet), None) for a user who may
+    move up a level, or (None, error response)
+    """
+    try:
+        # Get user profile
+        profile = UserProfile.objects.get(wallet_address=wallet_address)
+    except UserProfile.DoesNotExist:
+        return None, Response(
+            {"error": "User profile not found"}, status=status.HTTP_404_NOT_FOUND
+        )
 
+    # Calculate the next level automatically
+    current_level = profile.current_level
+    target_level = current_level + 1
 
-class UpgradeLevelView(viewsets.ViewSet):
-    """API endpoint for upgrading user levels"""
+    # Check if target_level is valid (max is 19)
+    if target_level >= 19:
+        return None, Response(
+            {"error": "Already at maximum level"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
 
-    permission_classes = [permissions.IsAuthenticated]
+    # Check eligibility
+    eligible, message = ReferralService.check_level_upgrade_eligibility(
+        profile, target_level
+    )
+
+    if not eligible:
+        return None, Response({"error": message}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Find eligible upline
+    eligible_upline = ReferralService.find_eligible_upline(profile, target_level)
+    upline_wallet = (
+        eligible_upline.wallet_address if eligible_upline else ROOT_USER_ADDRESS
+    )
+    return (profile, target_level, upline_wallet), None
+
+
+def complete_upgrade(profile, target_level, transaction_hash):
+    """Record a verified upgrade transaction and return the response"""
+    data, status_code = settle_upgrade(profile, target_level, transaction_hash)
+    return Response(data, status=status_code)
+
+
+def pending_upgrade(profile, target_level, transaction_hash):
+    """Record a submitted upgrade transaction as PENDING, see pending_response()"""
+    return pending_response(
+        profile,
+        record_pending(
+            profile,
+            "UPGRADE",
+            target_level,
+            get_level_catalog().get(target_level).price,
+            transaction_hash,
+        ),
+    )
+
+
+def pending_response(profile, row):
+    """
+    202 for a transaction still waiting for confirmations
+
+    The confirmation tracker settles it in the background; clients poll by
+    resubmitting the hash, which returns the final result once settled, or
+    through /api/transactions/?transaction_hash=. A hash whose payment row
+    was recorded for another profile is refused with a 409, and that row is
+    left untouched.
+    """
+    if row.user_id != profile.pk:
+        return hash_conflict_response()
+    if row.status == "FAILED":
+        return failed_transaction_response(
+            row.transaction_type.lower(),
+            {"status": "failed", "transaction_hash": row.transaction_hash},
+        )
+    return Response(
+        {
+            "message": "Transaction submitted, waiting for confirmation",
+            "transaction_hash": row.transaction_hash,
+            "transaction_id": row.pk,
+            "status": row.status,
+        },
+        status=status.HTTP_202_ACCEPTED,
+    )
+
+
+def failed_transaction_response(action, tx_result):
+    # A hash the node never saw is the client's mistake, nothing is recorded
+    if tx_result.get("status") == "not_found":
+        return Response(
+            {
+                "error": "Transaction not found",
+                "details": tx_result,
+            },
+            status=status.HTTP_404_NOT_FOUND,
+        )
+    return Response(
+        {
+            "error": f"Blockchain {action} failed",
+            "details": tx_result,
+        },
+        status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+    )
+
+
+def prepared_transaction_response(transaction):
+    return Response(
+        {
+            "message": "Transaction prepared for signing",
+            "transaction": transaction,
+            "instructions": "Sign this transaction with your wallet and submit the signed transaction back to this endpoint",
+        },
+        status=status.HTTP_200_OK,
+    )
+
+
+class RegistrationView(viewsets.ViewSet):
+    """API endpoint for registering new users (upgrading from Level 0 to Level 1)"""
+
+    permission_classes = [permissions.IsAuthenticated]  # Require authentication
 
-    @transaction.atomic
     def create(self, request):
-        # Extract wallet_address from the request
-        wallet_address = request.data.get("wallet_address")
+        error = wallet_error(request)
+        if error is not None:
+            return error
 
-        if not wallet_address:
-            return Response(
-                {"error": "Wallet address is required"},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+        # A retried submission gets the stored result back
+        replay = replayed_response(request, "REGISTRATION")
+        if replay is not None:
+            return replay
 
-        # Verify that the authenticated user matches the requested wallet
-        if request.user.wallet_address != wallet_address:
-            return Response(
-                {"error": "Authenticated wallet doesn't match requested wallet"},
-                status=status.HTTP_403_FORBIDDEN,
-            )
+        profile, error = registration_candidate(request.data["wallet_address"])
+        if error is not None:
+            return error
 
         try:
-            # Get user profile
-            profile = UserProfile.objects.get(wallet_address=wallet_address)
-
-            # Calculate the next level automatically
-            current_level = profile.current_level
-            target_level = current_level + 1
+            # Shared per-process blockchain service
+            blockchain_service = get_blockchain_service()
 
-            # Check if target_level is valid (max is 19)
-            if target_level >= 19:
-                return Response(
-                    {"error": "Already at maximum level"},
-                    status=status.HTTP_400_BAD_REQUEST,
+            # Check the registration mode
+            # A signed transaction is relayed to the node and tracked as PENDING
+            if "signed_transaction" in request.data:
+                tx_result = blockchain_service.submit_transaction(
+                    request.data["signed_transaction"]
                 )
+                return pending_registration(profile, tx_result["transaction_hash"])
 
-            # Check eligibility
-            eligible, message = ReferralService.check_level_upgrade_eligibility(
-                profile, target_level
+            # If  tx_hahs is provided, process a completed registration
+            if "transaction_hash" in request.data:
+                # Verify the signed transaction
+                tx_result = blockchain_service.verify_transaction(
+                    request.data["transaction_hash"]
+                )
+                if tx_result["status"] == "pending":
+                    return pending_registration(profile, tx_result["transaction_hash"])
+                if tx_result["status"] != "success":
+                    return failed_transaction_response("registration", tx_result)
+                return complete_registration(profile, tx_result["transaction_hash"])
+
+            # Just prepare the transaction for the frontend to sign
+            return prepared_transaction_response(
+                blockchain_service.build_register_transaction(
+                    user_wallet=profile.wallet_address,
+                    referrer_wallet=profile.referrer.wallet_address,
+                )
+            )
+        except Exception as e:
+            return Response(
+                {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
-            if not eligible:
-                return Response({"error": message}, status=status.HTTP_400_BAD_REQUEST)
 
-            # Find eligible upline
-            eligible_upline = ReferralService.find_eligible_upline(
-                profile, target_level
-            )
-            upline_wallet = (
-                eligible_upline.wallet_address if eligible_upline else ROOT_USER_ADDRESS
-            )
+class UpgradeLevelView(viewsets.ViewSet):
+    """API endpoint for upgrading user levels"""
 
-            # Check the upgrade mode
-            # If transaction_hash  is provided, process a completed upgrade
-            if "transaction_hash" in request.data:
-                try:
-                    # Initialize blockchain service
-                    blockchain_service = BlockchainService()
+    permission_classes = [permissions.IsAuthenticated]
 
-                    # Submit the signed transaction
-                    tx_result = blockchain_service.verify_transaction(
-                        request.data["transaction_hash"]
-                    )
+    def create(self, request):
+        error = wallet_error(request)
+        if error is not None:
+            return error
 
-                    if tx_result["status"] == "success":
-                        # Update in Django database - ReferralService.upgrade_user_level will
-                        # handle updating the user's level and creating reward transactions
-                        upgrade_result = ReferralService.upgrade_user_level(
-                            profile=profile,
-                            target_level=target_level,
-                            transaction_hash=tx_result["transaction_hash"],
-                        )
-
-                        return Response(
-                            {
-                                "message": "Level upgrade successful",
-                                "new_level": target_level,
-                                "transaction_hash": tx_result["transaction_hash"],
-                                "upline_rewarded": upgrade_result["upline_rewarded"],
-                                "upline_reward": float(upgrade_result["upline_reward"]),
-                            },
-                            status=status.HTTP_200_OK,
-                        )
-                    else:
-                        return Response(
-                            {
-                                "error": "Blockchain upgrade failed",
-                                "details": tx_result,
-                            },
-                            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                        )
-                except Exception as e:
-                    return Response(
-                        {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                    )
-            else:
-                # Just prepare the transaction for the frontend to sign
-                try:
-                    # Initialize blockchain service
-                    blockchain_service = BlockchainService()
-
-                    # Build the transaction for signing
-                    transaction = blockchain_service.build_upgrade_transaction(
-                        user_wallet=profile.wallet_address,
-                        new_level=target_level,
-                        upline_wallet=upline_wallet,
-                    )
+        # A retried submission gets the stored result back
+        replay = replayed_response(request, "UPGRADE")
+        if replay is not None:
+            return replay
 
-                    return Response(
-                        {
-                            "message": "Transaction prepared for signing",
-                            "transaction": transaction,
-                            "instructions": "Sign this transaction with your wallet and submit the signed transaction back to this endpoint",
-                        },
-                        status=status.HTTP_200_OK,
-                    )
-                except Exception as e:
-                    return Response(
-                        {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        candidate, error = upgrade_candidate(request.data["wallet_address"])
+        if error is not None:
+            return error
+        profile, target_level, upline_wallet = candidate
+
+        try:
+            # Shared per-process blockchain service
+            blockchain_service = get_blockchain_service()
+
+            # Check the upgrade mode
+            # A signed transaction is relayed to the node and tracked as PENDING
+            if "signed_transaction" in request.data:
+                tx_result = blockchain_service.submit_transaction(
+                    request.data["signed_transaction"]
+                )
+                return pending_upgrade(
+                    profile, target_level, tx_result["transaction_hash"]
+                )
+
+            # If transaction_hash  is provided, process a completed upgrade
+            if "transaction_hash" in request.data:
+                # Verify the signed transaction
+                tx_result = blockchain_service.verify_transaction(
+                    request.data["transaction_hash"]
+                )
+                if tx_result["status"] == "pending":
+                    return pending_upgrade(
+                        profile, target_level, tx_result["transaction_hash"]
                     )
+                if tx_result["status"] != "success":
+                    return failed_transaction_response("upgrade", tx_result)
+                return complete_upgrade(
+                    profile, target_level, tx_result["transaction_hash"]
+                )
 
-        except UserProfile.DoesNotExist:
+            # Just prepare the transaction for the frontend to sign
+            return prepared_transaction_response(
+                blockchain_service.build_upgrade_transaction(
+                    user_wallet=profile.wallet_address,
+                    new_level=target_level,
+                    upline_wallet=upline_wallet,
+                )
+            )
+        except Exception as e:
             return Response(
-                {"error": "User profile not found"}, status=status.HTTP_404_NOT_FOUND
+                {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import django
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+# Setup Django environment
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(current_dir))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "blockchain.settings")
+django.setup()
+
+from myapp.models import UserProfile, ReferralRelationship  # noqa: E402
+from myapp.services.referral import ReferralService  # noqa: E402
+
+DEPTHS = (10, 100, 1000)
+SIGNUPS_PER_DEPTH = 20
+
+
+def build_chain(depth):
+    """Create a referral chain of the given depth and return its deepest profile"""
+    profile = UserProfile.objects.create(
+        wallet_address=f"0xbe{depth:06x}{0:032x}", current_level=19
+    )
+    chain = [profile]
+    for i in range(1, depth):
+        profile = UserProfile.objects.create(
+            wallet_address=f"0xbe{depth:06x}{i:032x}", referrer=profile, current_level=1
+        )
+        chain.append(profile)
+
+    # Only the tail needs closure rows for new signups to copy
+    ReferralRelationship.objects.bulk_create(
+        [
+            ReferralRelationship(user=profile, upline=upline, level=len(chain) - i - 1)
+            for i, upline in enumerate(chain[:-1])
+        ]
+    )
+    return profile
+
+
+def benchmark_registration():
+    """Measure register_user latency and query count at increasing tree depths."""
+    print(f"Benchmarking ReferralService.register_user on {connection.vendor}")
+    print(f"{'depth':>6} {'queries':>8} {'avg ms':>8}")
+
+    with transaction.atomic():
+        for depth in DEPTHS:
+            referrer = build_chain(depth)
+            elapsed = 0.0
+            for n in range(SIGNUPS_PER_DEPTH):
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    ReferralService.register_user(
+                        wallet_address=f"0xbf{depth:06x}{n:032x}",
+                        referrer_profile=referrer,
+                    )
+                    elapsed += time.perf_counter() - started
+            print(
+                f"{depth:>6} {len(queries):>8} "
+                f"{elapsed * 1000 / SIGNUPS_PER_DEPTH:>8.2f}"
+            )
+
+        # Never keep benchmark data around
+        transaction.set_rollback(True)
+
+
+if __name__ == "__main__":
+    benchmark_registration()
@@ -0,0 +1,138 @@
+import os
+import random
+import sys
+import time
+import django
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+# Setup Django environment
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(current_dir))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "blockchain.settings")
+django.setup()
+
+from myapp.models import UserProfile, ReferralRelationship, ReferralAncestry  # noqa: E402
+from myapp.services.referral import ReferralService  # noqa: E402
+from myapp.services.referral_storage import get_referral_storage  # noqa: E402
+
+USERS = int(os.getenv("BENCHMARK_USERS", "2000"))
+# New users pick a referrer among the most recent ones, which keeps the tree deep
+RECENT_REFERRERS = 10
+READS = 50
+# Table holding the upline chains of each storage; cte stores none
+STORAGE_TABLES = {
+    "closure": ReferralRelationship,
+    "packed": ReferralAncestry,
+    "cte": None,
+}
+if connection.vendor == "postgresql":
+    # The path lives on UserProfile itself, so there is no table to measure
+    STORAGE_TABLES["ltree"] = None
+
+
+def table_bytes(model):
+    """Data plus index size of a table, or None if the database cannot tell"""
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute("SELECT pg_total_relation_size(%s)", [table])
+        elif connection.vendor == "mysql":
+            cursor.execute(f"ANALYZE TABLE {connection.ops.quote_name(table)}")
+            cursor.fetchall()
+            cursor.execute(
+                "SELECT data_length + index_length FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name = %s",
+                [table],
+            )
+        elif connection.vendor == "sqlite":
+            try:
+                cursor.execute(
+                    "SELECT SUM(pgsize) FROM dbstat WHERE name = %s "
+                    "OR name IN (SELECT name FROM sqlite_master "
+                    "WHERE type = 'index' AND tbl_name = %s)",
+                    [table, table],
+                )
+            except Exception:
+                return None
+        else:
+            return None
+        return cursor.fetchone()[0]
+
+
+def build_tree(storage):
+    """Register USERS profiles under a fresh root and return signups per second"""
+    prefix = {"closure": "c", "packed": "d", "cte": "e", "ltree": "f"}[storage]
+    profiles = [
+        UserProfile.objects.create(
+            wallet_address=f"0x{prefix}{0:039x}", current_level=19
+        )
+    ]
+    rng = random.Random(42)
+    started = time.perf_counter()
+    for n in range(1, USERS):
+        profiles.append(
+            ReferralService.register_user(
+                wallet_address=f"0x{prefix}{n:039x}",
+                referrer_profile=rng.choice(profiles[-RECENT_REFERRERS:]),
+            )
+        )
+    elapsed = time.perf_counter() - started
+    return profiles, (USERS - 1) / elapsed
+
+
+def read_latency(profiles):
+    """Average milliseconds of an upline walk, an upline lookup and a downline listing"""
+    storage = get_referral_storage()
+    rng = random.Random(7)
+    sample = [rng.choice(profiles) for _ in range(READS)]
+    timings = []
+    for read in (
+        lambda profile: storage.ancestor_ids(profile.pk),
+        lambda profile: storage.upline_at(profile, 3),
+        lambda profile: storage.downline_keys(profile, max_depth=5),
+    ):
+        started = time.perf_counter()
+        for profile in sample:
+            read(profile)
+        timings.append((time.perf_counter() - started) * 1000 / READS)
+    return timings
+
+
+def benchmark_storage():
+    """
+    Compare signup throughput, read latency and table size of each
+    REFERRAL_STORAGE mode
+
+    Run against a scratch database: rows are committed so table sizes can be
+    measured, and deleted again afterwards.
+    """
+    print(f"Benchmarking referral storage with {USERS} users on {connection.vendor}")
+    print(
+        f"{'storage':>8} {'signups/s':>10} {'uplines ms':>11} {'upline_at ms':>13} "
+        f"{'downlines ms':>13} {'rows':>9} {'bytes':>12} {'bytes/user':>11}"
+    )
+
+    for storage, model in STORAGE_TABLES.items():
+        with override_settings(REFERRAL_STORAGE=storage):
+            with transaction.atomic():
+                profiles, rate = build_tree(storage)
+            try:
+                uplines_ms, upline_at_ms, downlines_ms = read_latency(profiles)
+                size = table_bytes(model) if model else 0
+                rows = model.objects.count() if model else 0
+                per_user = f"{size / USERS:>11.1f}" if size is not None else f"{'n/a':>11}"
+                print(
+                    f"{storage:>8} {rate:>10.1f} {uplines_ms:>11.2f} {upline_at_ms:>13.2f} "
+                    f"{downlines_ms:>13.2f} {rows:>9} "
+                    f"{size if size is not None else 'n/a':>12} {per_user}"
+                )
+            finally:
+                # Never keep benchmark data around
+                UserProfile.objects.filter(
+                    wallet_address__startswith=profiles[0].wallet_address[:3]
+                ).delete()
+
+
+if __name__ == "__main__":
+    benchmark_storage()